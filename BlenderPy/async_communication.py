@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:21:36 2026
+
+@author: Thibault
+"""
+
+import asyncio
+import socket
+import numpy as np
+from BlenderPy import sending_data
+from BlenderPy.sending_data import Communication, Material, Mesh, Object
+from BlenderPy.transport import (WINDOW, RemoteError, encode_message,
+                                 hello_message, probe_message, knows_hello,
+                                 server_info)
+
+class AsyncConnection:
+    '''A connection to the Blender Server built on asyncio streams. Several
+    requests can be in flight at the same time, up to window: the server
+    replies to every request with its ID, which matches the replies with
+    the requests'''
+
+    def __init__(self, reader, writer, window=WINDOW, client=None):
+        self.reader=reader
+        self.writer=writer
+        # the Communication whose settings write the messages
+        self.client=Communication.client(client)
+        # the command and the future of the requests waiting for their
+        # reply, by request ID. The future is None if nobody waits for it
+        self.pending=dict()
+        self.errors=[]
+        # what the server can do, known after the hello command
+        self.info=server_info()
+        # whether the server runs on the same machine
+        self.local=True
+        self._window=asyncio.Semaphore(window)
+        self._idle=asyncio.Event()
+        self._idle.set()
+        self._write_lock=asyncio.Lock()
+        self._reading=asyncio.ensure_future(self._read_answers())
+
+    @classmethod
+    async def open(cls, host, port, path=None, window=WINDOW, client=None):
+        '''Open a connection to the Blender Server, through the unix domain
+        socket at path if it is given, writing the messages with the
+        settings of client, or of the default Communication if it is None'''
+        if path is not None:
+            reader, writer=await asyncio.open_unix_connection(path)
+        else:
+            reader, writer=await asyncio.open_connection(host, port)
+            sock=writer.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # before the answers are read by the connection, since the add-ons
+        # older than hello answer the probe without its request ID
+        message=probe_message()
+        writer.write('{:010x}'.format(len(message)).encode()+message)
+        await writer.drain()
+        msglen=int((await reader.readexactly(10)).decode(), 16)
+        reply=Communication.client(client).decode(
+                await reader.readexactly(msglen))
+        if not knows_hello(reply):
+            # the replies are matched with the requests by their IDs
+            writer.close()
+            raise RemoteError('hello', 'the add-on of the Blender Server '
+                              'is older than the request IDs needed by '
+                              'AsyncCommunication', None)
+        conn=cls(reader, writer, window, client)
+        conn.local=(path is not None or host in ('localhost', '::1')
+                    or str(host).startswith('127.'))
+        await conn.hello()
+        return conn
+
+    async def hello(self):
+        '''Agree with the server on the protocol version, the codec of the
+        messages and the capabilities. The arrays never go through shared
+        memory, so the server is not asked to read a block'''
+        try:
+            reply=await self.request(hello_message(), 0, 'hello')
+            self.info=server_info(reply['content'])
+        except RemoteError:
+            # a server older than the hello command, while a lost
+            # connection fails the opening
+            self.info=server_info()
+
+    @property
+    def paths(self):
+        '''how the messages are written, from Communication.choose_paths'''
+        return self.client.choose_paths(self.info, self.local)
+
+    @property
+    def closed(self):
+        return self._reading.done()
+
+    async def request(self, data, request_id, command=None, answer=True):
+        '''Send encoded bytes with their length at the beginning
+
+        Parameters:
+            data: the bytes to send
+
+            request_id: the ID of the request, written in data
+
+            command: the name of the command, for the error messages
+
+            answer: whether to wait for the reply. If False, an error of
+            the command is kept in errors
+
+        Return:
+            the decoded reply, or None if answer is False
+        '''
+        future=None
+        registered=False
+        await self._window.acquire()
+        try:
+            async with self._write_lock:
+                if self.closed:
+                    raise ConnectionError('the Blender Server closed the connection')
+                if answer:
+                    future=asyncio.get_running_loop().create_future()
+                self.pending[request_id]=(command, future)
+                registered=True
+                self._idle.clear()
+                self.writer.write('{:010x}'.format(len(data)).encode())
+                self.writer.write(data)
+                await self.writer.drain()
+        except BaseException:
+            # once registered, the window is released with the reply,
+            # unless it will never come
+            if (not registered
+                or self.pending.pop(request_id, None) is not None):
+                self._window.release()
+            if not self.pending:
+                self._idle.set()
+            raise
+        if future is not None:
+            try:
+                reply=await future
+            except asyncio.CancelledError:
+                # the command is cancelled in Blender as well
+                self.cancel([request_id])
+                raise
+            if 'error' in reply:
+                raise RemoteError(command, reply['error'],
+                                  reply.get('traceback'))
+            return reply
+
+    def cancel(self, request_ids):
+        '''Ask the server to cancel requests waiting for their reply on
+        this connection. Their replies are errors
+
+        Parameters:
+            request_ids: the IDs of the requests
+
+        Return:
+            the number of requests whose cancellation was sent
+        '''
+        request_ids=[i for i in request_ids if i in self.pending]
+        if (not request_ids or self.closed
+            or 'cancel' not in self.info['capabilities']):
+            return 0
+        message=encode_message(dict({'command':'cancel',
+                                     'kwargs':dict({'request_ids':
+                                                    request_ids})}))
+        # written at once, without waiting, so that it cannot come between
+        # the length and the data of another message
+        self.writer.write('{:010x}'.format(len(message)).encode()+message)
+        return len(request_ids)
+
+    async def _read_answers(self):
+        try:
+            while True:
+                msglen=int((await self.reader.readexactly(10)).decode(), 16)
+                data=await self.reader.readexactly(msglen)
+                reply=self.client.decode(data)
+                if reply.get('id') not in self.pending or 'progress' in reply:
+                    continue
+                command, future=self.pending.pop(reply['id'])
+                self._window.release()
+                if future is None:
+                    if 'error' in reply:
+                        self.errors.append(RemoteError(
+                                command, reply['error'],
+                                reply.get('traceback')))
+                elif not future.cancelled():
+                    future.set_result(reply)
+                if not self.pending:
+                    self._idle.set()
+        except (asyncio.IncompleteReadError, OSError):
+            for command, future in self.pending.values():
+                error=ConnectionError('the Blender Server closed the '
+                                      'connection before answering to '
+                                      '{:}'.format(command))
+                if future is None:
+                    self.errors.append(error)
+                elif not future.cancelled():
+                    future.set_exception(error)
+            self.pending.clear()
+            self._idle.set()
+
+    async def wait_idle(self):
+        '''Wait until all the requests have been answered'''
+        await self._idle.wait()
+
+    async def close(self):
+        self._reading.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+class AsyncCommunication:
+    '''Asynchronous counterpart of Communication, with awaitable ask and
+    send. Several requests can be in flight on each connection. For example, to overlap the
+    triangulation of polygons with the upload of the previous meshes:
+
+        async def build(polygons):
+            comm=AsyncCommunication()
+            loop=asyncio.get_running_loop()
+            uploads=[]
+            for polygon in polygons:
+                points, cells=await loop.run_in_executor(
+                        None, Triangle.triangulate,
+                        polygon.points, polygon.holes)
+                uploads.append(asyncio.ensure_future(
+                        comm.create_mesh(cells=cells, points=points)))
+            meshes=await asyncio.gather(*uploads)
+            await comm.close()
+            return meshes
+    '''
+
+    def __init__(self, host=None, port=None, size=1, path=None,
+                 client=None):
+        '''
+        Parameters:
+            host: the address of the Blender Server. Default to the HOST of
+            sending_data
+
+            port: the port of the Blender Server. Default to the PORT of
+            sending_data
+
+            size: the maximum number of connections to open. The commands
+            sent on one connection are executed in order, but with several
+            connections a command can overtake a previous one
+
+            path: the path of the unix domain socket of the Blender Server.
+            Default to the SOCKET_PATH of sending_data
+
+            client: the Communication whose settings write the messages,
+            and which is given to the objects created, like the Mesh of
+            create_mesh. Default to a new Communication of the same server
+        '''
+        self.host=sending_data.HOST if host is None else host
+        self.port=sending_data.PORT if port is None else port
+        self.path=sending_data.SOCKET_PATH if path is None else path
+        if client is None:
+            client=Communication(self.host, self.port, self.path)
+        self.client=client
+        self.size=size
+        self.connections=[]
+        self._errors=[]
+        self._lock=None
+
+    async def _connection(self):
+        if self._lock is None:
+            self._lock=asyncio.Lock()
+        async with self._lock:
+            for conn in self.connections:
+                if conn.closed:
+                    self._errors.extend(conn.errors)
+            self.connections=[conn for conn in self.connections
+                              if not conn.closed]
+            idle=[conn for conn in self.connections if not conn.pending]
+            if idle:
+                return idle[0]
+            if len(self.connections)<self.size:
+                conn=await AsyncConnection.open(self.host, self.port,
+                                                self.path,
+                                                client=self.client)
+                self.connections.append(conn)
+                return conn
+            return min(self.connections, key=lambda conn: len(conn.pending))
+
+    async def send(self, message, **kwargs):
+        '''Send a message to the Blender Server, without waiting for an
+        answer. If the command fails, the error is raised by a later call
+        to send, ask or flush
+
+        Parameters:
+            message: string to send
+
+        Return:
+            the ID of the request, to cancel it
+        '''
+        self.check_errors()
+        request_id=next(Communication._ids)
+        conn=await self._connection()
+        paths=conn.paths
+        data=self.client.encode(message, kwargs, request_id=request_id,
+                                codec=paths['codec'], paths=paths)
+        await conn.request(data, request_id, message, answer=False)
+        return request_id
+
+    async def ask(self, message, **kwargs):
+        '''Ask a question to the Blender Server
+
+        Parameters:
+            message: the question to ask
+
+        Return:
+            the data
+        '''
+        self.check_errors()
+        request_id=next(Communication._ids)
+        conn=await self._connection()
+        paths=conn.paths
+        data=self.client.encode(message, kwargs, request_id=request_id,
+                                codec=paths['codec'], paths=paths)
+        reply=await conn.request(data, request_id, message)
+        self.check_errors()
+        return reply['content']
+
+    def cancel(self, request_id=None):
+        '''Cancel a command waiting for its answer, or all of them. A
+        cancelled ask raises a RemoteError, and cancelling the task
+        awaiting an ask cancels its command too
+
+        Parameters:
+            request_id: the ID returned by send, or None to cancel all the
+            commands waiting for their answer
+
+        Return:
+            the number of commands whose cancellation was sent
+        '''
+        return sum(conn.cancel([i for i in conn.pending
+                                if request_id is None or i==request_id])
+                   for conn in self.connections)
+
+    def check_errors(self):
+        '''Raise the first error of the commands sent without waiting for
+        their answer, if any. The following errors are in its others
+        attribute'''
+        errors, self._errors=self._errors, []
+        for conn in self.connections:
+            errors.extend(conn.errors)
+            conn.errors=[]
+        if errors:
+            errors[0].others=errors[1:]
+            raise errors[0]
+
+    async def flush(self):
+        '''Wait until the Blender Server has executed all the commands
+        sent, and raise the first error if some of them failed'''
+        for conn in list(self.connections):
+            await conn.wait_idle()
+        self.check_errors()
+
+    async def close(self):
+        '''Close all the connections'''
+        for conn in self.connections:
+            await conn.close()
+        self.connections=[]
+
+    async def delete_all(self):
+        '''Delete all objects, meshes, cameras, ...'''
+        assert await self.ask('delete_all')=="DONE"
+        self.client.clear_cache()
+        self.client.proxies.clear()
+
+    async def create_mesh(self, cells=None, points=None, thickness=None,
+                          name='mesh', subdivide=1):
+        '''Create a Mesh. See Mesh for the parameters
+
+        Returns:
+            the Mesh
+        '''
+        name_obj, name_msh=await self.ask('create_mesh',
+                                          name=name,
+                                          thickness=thickness,
+                                          subdivide=subdivide,
+                                          points=np.asarray(points,
+                                                            dtype=float),
+                                          cells=Mesh.format_cells(cells))
+        return Mesh.existing(name_obj, name_msh, client=self.client)
+
+    async def get_vertices(self, mesh):
+        '''Get the (local) vertices of a Mesh as a numpy array'''
+        return np.array(await self.ask('get_vertices',
+                                       name_msh=mesh.name_msh),
+                        dtype=float)
+
+    async def set_vertices(self, mesh, val):
+        '''Set the (local) vertices of a Mesh'''
+        await self.send('set_vertices', name_msh=mesh.name_msh,
+                        val=np.asarray(val, dtype=float))
+        # the same values as Mesh.vertices, once sent so that a read
+        # during the write does not cache the old ones again
+        self.client.invalidate(mesh._vertices_owner())
+
+    async def get_object_property(self, obj, key):
+        '''Get a property of an Object, like Object.properties[key]'''
+        res=await self.ask('get_object_property', key=key,
+                           parent_name='', parent_name_obj=obj.name_obj)
+        if isinstance(res, dict):
+            return self.client.proxies.get(
+                    ('OBJECT', res['name_obj']),
+                    lambda: Object(client=self.client, **res))
+        return res
+
+    async def set_object_property(self, obj, key, value):
+        '''Set a property of an Object, like Object.properties[key]=value'''
+        if hasattr(value, 'to_dict'):
+            value=value.to_dict()
+        await self.ask('set_object_property', key=key, value=value,
+                       parent_name='', parent_name_obj=obj.name_obj)
+        # the same values as Object.properties, once written so that a
+        # read during the write does not cache the old ones again
+        obj.properties._invalidate([key])
+
+    async def create_material(self, name='material', color='#FFFFFF',
+                              alpha=1., transmission=0,
+                              use_screen_refraction=False,
+                              refraction_depth=0., blend_method='OPAQUE',
+                              blend_method_shadow='OPAQUE',
+                              use_backface_culling=False, metallic=0.,
+                              **kwargs):
+        '''Create a new material with a Principled BSDF shader. See
+        Material for the parameters
+
+        Returns:
+            the name of the material
+        '''
+        material_name=await self.ask('create_material', name=name)
+        params=dict({'name':material_name,
+                     'color':Material.convert_color(color),
+                     'alpha':alpha, 'transmission':transmission,
+                     'use_screen_refraction':use_screen_refraction,
+                     'refraction_depth':refraction_depth,
+                     'blend_method':blend_method,
+                     'use_backface_culling':use_backface_culling,
+                     'blend_method_shadow':blend_method_shadow,
+                     'metallic':metallic})
+        params.update(kwargs)
+        await self.send('update_material', **params)
+        return material_name
+
+    async def assign_material(self, obj, material):
+        '''Assign a material to an Object
+
+        Parameters:
+            obj: the Object
+
+            material: a Material, a material name, or a list of them
+        '''
+        if isinstance(material, list):
+            name_mat=[getattr(mat, 'material_object', mat)
+                      for mat in material]
+        else:
+            name_mat=getattr(material, 'material_object', material)
+        await self.send('assign_material', name_obj=obj.name_obj,
+                        name_mat=name_mat)
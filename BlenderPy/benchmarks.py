@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:47:12 2026
+
+@author: Thibault
+"""
+
+import time
+import socket
+import threading
+import tracemalloc
+import numpy as np
+from BlenderPy import sending_data
+from BlenderPy.sending_data import Communication
+from BlenderPy.transport import (Connection, ConnectionPool, CODECS,
+                                 encode_message, decode_message)
+
+def time_round_trips(pool, message, repeat):
+    '''Time the round trips of an echo command through a ConnectionPool
+
+    Parameters:
+        pool: the ConnectionPool
+
+        message: the keyword arguments of the echo command
+
+        repeat: the number of round trips
+
+    Return:
+        the median duration of a round trip, in seconds
+    '''
+    # the requests are sequential, so they can all have the same ID
+    data=Communication.encode('echo', message, request_id=0,
+                              codec=pool.negotiate())
+    pool.exchange(data, 0)
+    durations=[]
+    for i in range(repeat):
+        start=time.perf_counter()
+        pool.exchange(data, 0)
+        durations.append(time.perf_counter()-start)
+    return float(np.median(durations))
+
+def benchmark_transports(path=None, host=None, port=None,
+                         sizes=(0, 1000, 1000000), repeat=20):
+    '''Compare the round trips through loopback TCP and through the unix
+    domain socket of a Blender Server listening on both. Each message
+    holds a float array of the given number of vertices.
+
+    Parameters:
+        path: the path of the unix domain socket of the Blender Server.
+        Default to the SOCKET_PATH of sending_data
+
+        host: the address of the Blender Server. Default to the HOST of
+        sending_data
+
+        port: the port of the Blender Server. Default to the PORT of
+        sending_data
+
+        sizes: the numbers of vertices of the messages
+
+        repeat: the number of round trips for each size
+
+    Return:
+        a list of dictionaries with the size, and the median durations
+        of a round trip through TCP and through the unix domain socket
+    '''
+    host=sending_data.HOST if host is None else host
+    port=sending_data.PORT if port is None else port
+    path=sending_data.SOCKET_PATH if path is None else path
+    pools=dict({'tcp':ConnectionPool(host, port, size=1,
+                                     decode=Communication.decode),
+                'unix':ConnectionPool(host, port, size=1, path=path,
+                                      decode=Communication.decode)})
+    results=[]
+    try:
+        for size in sizes:
+            message=dict({'points':np.random.rand(size, 3)})
+            result=dict({'size':size})
+            for name, pool in pools.items():
+                result[name]=time_round_trips(pool, message, repeat)
+            results.append(result)
+    finally:
+        for pool in pools.values():
+            pool.close()
+    return results
+
+def typical_messages(n_vertices=10000):
+    '''Build typical messages: the request of create_mesh, the reply of
+    get_vertices, and the request and reply of property calls
+
+    Parameters:
+        n_vertices: the number of vertices of the meshes
+
+    Return:
+        a dictionary of functions encoding the messages with a codec
+    '''
+    points=np.random.rand(n_vertices, 3)
+    cells=np.random.randint(0, n_vertices, size=(2*n_vertices, 3),
+                            dtype=np.int32)
+    vertices=points.astype(np.float32)
+    def request(command, binary, **kwargs):
+        def encode(codec):
+            binary_arrays=Communication.binary_arrays
+            Communication.binary_arrays=binary
+            try:
+                return Communication.encode(command, kwargs, request_id=1,
+                                            codec=codec)
+            finally:
+                Communication.binary_arrays=binary_arrays
+        return encode
+    def reply(content, binary=True):
+        return lambda codec: encode_message(dict({'id':1,
+                                                  'content':content}),
+                                            binary=binary, codec=codec)
+    return dict({
+        'create_mesh':request('create_mesh', True, name='mesh',
+                              thickness=None, subdivide=1, points=points,
+                              cells=cells),
+        'create_mesh (lists)':request('create_mesh', False, name='mesh',
+                                      thickness=None, subdivide=1,
+                                      points=points, cells=cells),
+        'get_vertices':reply(vertices),
+        'get_vertices (lists)':reply(vertices, binary=False),
+        'set_object_property':request('set_object_property', True,
+                                      key='location', value=[1., 2., 3.],
+                                      parent_name='',
+                                      parent_name_obj='Cube'),
+        'get_object_property':reply([1., 2., 3.])})
+
+def benchmark_codecs(n_vertices=10000, repeat=20):
+    '''Compare the encoding and decoding times of the available codecs on
+    typical messages, without any server. Like the messages written in json
+    by the server, the json messages are decoded with orjson when it is
+    installed
+
+    Parameters:
+        n_vertices: the number of vertices of the meshes
+
+        repeat: the number of encodings and decodings of each message
+
+    Return:
+        a list of dictionaries with the message, the codec, the size of the
+        encoded message in bytes, and the median encoding and decoding
+        durations in seconds
+    '''
+    results=[]
+    for name, encode in typical_messages(n_vertices).items():
+        for codec in CODECS:
+            encodings, decodings=[], []
+            for i in range(repeat):
+                start=time.perf_counter()
+                data=encode(codec)
+                encodings.append(time.perf_counter()-start)
+                start=time.perf_counter()
+                decode_message(data)
+                decodings.append(time.perf_counter()-start)
+            results.append(dict({'message':name, 'codec':codec,
+                                 'size':len(data),
+                                 'encode':float(np.median(encodings)),
+                                 'decode':float(np.median(decodings))}))
+    return results
+
+def benchmark_allocations(size=100*(1<<20)):
+    '''Measure the memory allocated by the client to encode, send, receive
+    and decode a message holding a float array, through a socket pair
+
+    Parameters:
+        size: the size of the array, in bytes
+
+    Return:
+        a dictionary with the size of the array and the peak of memory
+        allocated by each step, beyond the message it is given, in bytes
+    '''
+    array=np.random.rand(size//8)
+    sender, receiver=Connection(None, None), Connection(None, None)
+    sender.sock, receiver.sock=socket.socketpair()
+    results=dict({'size':array.nbytes})
+    tracemalloc.start()
+    try:
+        data=encode_message(dict({'content':array}))
+        results['encode']=tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        # the socket pair only buffers a few kB, so the frame is received
+        # while it is sent
+        thread=threading.Thread(target=sender.send_frame, args=(data,))
+        thread.start()
+        received=receiver.receive_frame()
+        thread.join()
+        results['transfer']=tracemalloc.get_traced_memory()[1]-len(data)
+        del data
+        tracemalloc.reset_peak()
+        decode_message(received)
+        results['decode']=(tracemalloc.get_traced_memory()[1]
+                           -len(received))
+    finally:
+        tracemalloc.stop()
+        sender.close()
+        receiver.close()
+    return results
+
+if __name__=='__main__':
+    import sys
+    print('{:>22} {:>8} {:>10} {:>12} {:>12}'.format('message', 'codec',
+                                                    'bytes', 'encode (ms)',
+                                                    'decode (ms)'))
+    for result in benchmark_codecs():
+        print('{:>22} {:>8} {:>10} {:>12.3f} {:>12.3f}'.format(
+                result['message'], result['codec'], result['size'],
+                1e3*result['encode'], 1e3*result['decode']))
+    allocations=benchmark_allocations()
+    print('allocations for {:.0f} MB: encode {:.0f} MB, transfer {:.0f} MB, '
+          'decode {:.0f} MB'.format(allocations['size']/2**20,
+                                    allocations['encode']/2**20,
+                                    allocations['transfer']/2**20,
+                                    allocations['decode']/2**20))
+    path=sys.argv[1] if len(sys.argv)>1 else None
+    print('{:>10} {:>12} {:>12}'.format('vertices', 'tcp (ms)', 'unix (ms)'))
+    for result in benchmark_transports(path=path):
+        print('{:>10} {:>12.3f} {:>12.3f}'.format(result['size'],
+                                                 1e3*result['tcp'],
+                                                 1e3*result['unix']))
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:12:08 2026
+
+@author: Thibault
+"""
+
+import os
+import time
+import socket
+import threading
+import subprocess
+from contextlib import contextmanager
+from BlenderPy.sending_data import Communication
+from BlenderPy.transport import RemoteError
+try:
+    import psutil
+except ImportError:
+    psutil=None
+
+# the Blender executable, or the BLENDER environment variable if it is set
+BLENDER=os.environ.get('BLENDER', 'blender')
+# the folder of the add-on, next to the BlenderPy package
+ADDON_PATH=os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'Blender_addon')
+# maximum time, in seconds, for Blender to start and answer
+STARTUP_TIMEOUT=60.
+# script run by Blender in background mode, serving the commands in its
+# main thread until the process is stopped
+SERVE_SCRIPT='''import sys
+sys.path.insert(0, {parent!r})
+from {package}.receiving_data import Server
+server=Server(host={host!r}, port={port!r}, path={path!r})
+server.connect(use_timers=False)
+server.serve_forever()
+'''
+
+def free_port(host='127.0.0.1'):
+    '''a TCP port on which nothing listens yet'''
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+def blender_command(port, host='127.0.0.1', path=None, blender=BLENDER,
+                    addon=ADDON_PATH):
+    '''The command starting Blender in background mode, with the Blender
+    Server of the add-on listening on a port
+
+    Parameters:
+        port: the port of the Blender Server
+
+        host: the address on which the Blender Server listens
+
+        path: the path of a unix domain socket on which the Blender Server
+        also listens, or None
+
+        blender: the Blender executable
+
+        addon: the folder of the add-on
+
+    Return:
+        the list of the arguments of the command
+    '''
+    addon=os.path.abspath(addon)
+    script=SERVE_SCRIPT.format(parent=os.path.dirname(addon),
+                               package=os.path.basename(addon),
+                               host=host, port=port, path=path)
+    return [blender, '--background', '--factory-startup',
+            '--python-expr', script]
+
+def process_memory(pid):
+    '''the resident memory of a process, in bytes, or None if it cannot be
+    measured on this system without psutil'''
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open('/proc/{:}/statm'.format(pid)) as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class BlenderInstance:
+    '''A Blender process started in background mode with the Blender
+    Server, and the Communication client talking to it'''
+
+    def __init__(self, port=None, host='127.0.0.1', command=None,
+                 startup_timeout=STARTUP_TIMEOUT, stdout=subprocess.DEVNULL):
+        '''
+        Parameters:
+            port: the port of the Blender Server. Default to a free port
+
+            host: the address of the Blender Server
+
+            command: a function giving the command starting the process
+            from the port, or None for blender_command. A stand-in server
+            script can be started instead of Blender
+
+            startup_timeout: the time in seconds given to the process to
+            answer the readiness ping
+
+            stdout: where the output of the process goes, as for
+            subprocess.Popen
+        '''
+        self.host=host
+        self.port=free_port(host) if port is None else port
+        self.command=blender_command if command is None else command
+        self.startup_timeout=startup_timeout
+        self.stdout=stdout
+        self.process=None
+        self.client=Communication(host, self.port)
+        # the number of jobs done, for the recycling of the instance
+        self.jobs=0
+
+    def start(self):
+        '''Start the process, without waiting for it to be ready'''
+        args=self.command(self.port)
+        self.process=subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                      stdout=self.stdout,
+                                      stderr=subprocess.STDOUT)
+        self.jobs=0
+
+    def ping(self, timeout=1.):
+        '''Whether the Blender Server answers an echo command within
+        timeout seconds'''
+        try:
+            with self.client.deadline(timeout):
+                self.client.ask('echo')
+            return True
+        except RemoteError:
+            # an add-on without echo, which answers anyway
+            return True
+        except OSError:
+            return False
+
+    def wait_ready(self, timeout=None):
+        '''Wait until the Blender Server answers the readiness ping
+
+        Parameters:
+            timeout: the time in seconds to wait, or None for
+            startup_timeout
+
+        Return:
+            the BlenderInstance
+        '''
+        timeout=self.startup_timeout if timeout is None else timeout
+        end=time.monotonic()+timeout
+        while True:
+            if not self.alive:
+                raise RuntimeError('Blender exited with the code {:} '
+                                   'before answering on port {:}'.format(
+                                           self.process.returncode,
+                                           self.port))
+            if self.ping(min(1., max(end-time.monotonic(), 0.01))):
+                return self
+            if time.monotonic()>end:
+                raise TimeoutError('Blender did not answer on port {:} '
+                                   'within {:} s'.format(self.port, timeout))
+            # a refused connection returns at once
+            time.sleep(0.1)
+
+    @property
+    def alive(self):
+        '''Whether the process is running'''
+        return self.process is not None and self.process.poll() is None
+
+    @property
+    def memory(self):
+        '''the resident memory of the process in bytes, or None'''
+        if not self.alive:
+            return None
+        return process_memory(self.process.pid)
+
+    def stop(self, timeout=5.):
+        '''Close the connections and stop the process, killing it if it
+        does not stop within timeout seconds'''
+        self.client.close()
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+class WarmPool:
+    '''A pool of Blender processes started in advance, to hide the
+    seconds taken by Blender to start. Each job takes a ready instance,
+    and gives it back when it is done. An instance is replaced by a new
+    one, started in the background, after max_jobs jobs or when its memory
+    exceeds max_memory bytes:
+
+        with WarmPool(size=2, max_jobs=20) as pool:
+            for frame in range(100):
+                with pool.job() as client:
+                    Scene(frame_current=frame, client=client)
+                    ...
+    '''
+
+    def __init__(self, size=2, max_jobs=None, max_memory=None,
+                 command=None, host='127.0.0.1',
+                 startup_timeout=STARTUP_TIMEOUT, stdout=subprocess.DEVNULL):
+        '''
+        Parameters:
+            size: the number of instances kept running
+
+            max_jobs: the number of jobs after which an instance is
+            replaced, or None
+
+            max_memory: the resident memory in bytes above which an
+            instance is replaced after its job, or None
+
+            command: a function giving the command starting an instance
+            from its port, or None for blender_command
+
+            host: the address of the Blender Servers
+
+            startup_timeout: the time in seconds given to an instance to
+            answer the readiness ping
+
+            stdout: where the output of the processes goes, as for
+            subprocess.Popen
+        '''
+        self.size=size
+        self.max_jobs=max_jobs
+        self.max_memory=max_memory
+        self.command=command
+        self.host=host
+        self.startup_timeout=startup_timeout
+        self.stdout=stdout
+        self.n_recycled=0
+        self._idle=[]
+        self._instances=[]
+        self._errors=[]
+        self._closed=False
+        self._condition=threading.Condition()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def _new_instance(self):
+        instance=BlenderInstance(host=self.host, command=self.command,
+                                 startup_timeout=self.startup_timeout,
+                                 stdout=self.stdout)
+        instance.start()
+        with self._condition:
+            self._instances.append(instance)
+        return instance
+
+    def _make_ready(self, instance):
+        # wait for an instance in a background thread, and make it
+        # available to the jobs
+        try:
+            instance.wait_ready()
+        except (RuntimeError, TimeoutError) as error:
+            self._discard(instance)
+            with self._condition:
+                self._errors.append(error)
+                self._condition.notify_all()
+            return
+        with self._condition:
+            if self._closed:
+                stop=True
+            else:
+                stop=False
+                self._idle.append(instance)
+                self._condition.notify_all()
+        if stop:
+            self._discard(instance)
+
+    def _discard(self, instance):
+        instance.stop()
+        with self._condition:
+            if instance in self._instances:
+                self._instances.remove(instance)
+
+    def start(self, wait=True):
+        '''Start the instances, all at the same time
+
+        Parameters:
+            wait: whether to wait until they are all ready
+        '''
+        instances=[self._new_instance() for i in range(self.size)]
+        threads=[threading.Thread(target=self._make_ready, args=(instance,),
+                                  daemon=True) for instance in instances]
+        for thread in threads:
+            thread.start()
+        if wait:
+            for thread in threads:
+                thread.join()
+            self._raise_errors()
+
+    def _raise_errors(self):
+        with self._condition:
+            errors, self._errors=self._errors, []
+        if errors:
+            raise errors[0]
+
+    def acquire(self, timeout=None):
+        '''Take a ready instance, waiting for one if needed. Prefer the
+        job context manager
+
+        Parameters:
+            timeout: the time in seconds to wait, or None to wait as long
+            as needed
+
+        Return:
+            the BlenderInstance, which must be given back with release
+        '''
+        with self._condition:
+            end=None if timeout is None else time.monotonic()+timeout
+            while not self._idle:
+                if self._errors:
+                    # an instance could not start, and none is ready
+                    raise self._errors.pop(0)
+                if self._closed:
+                    raise RuntimeError('the WarmPool is closed')
+                remaining=None if end is None else end-time.monotonic()
+                if remaining is not None and remaining<=0:
+                    raise TimeoutError('no Blender instance was ready '
+                                       'within {:} s'.format(timeout))
+                self._condition.wait(remaining)
+            return self._idle.pop(0)
+
+    def release(self, instance, failed=False):
+        '''Give back an instance after a job, replacing it if it did too
+        many jobs, uses too much memory, or if the job failed
+
+        Parameters:
+            instance: the BlenderInstance given by acquire
+
+            failed: whether the job failed, which may leave Blender in an
+            unknown state
+        '''
+        instance.jobs+=1
+        recycle=(failed or not instance.alive
+                 or (self.max_jobs is not None
+                     and instance.jobs>=self.max_jobs))
+        if not recycle and self.max_memory is not None:
+            memory=instance.memory
+            recycle=memory is not None and memory>self.max_memory
+        if not recycle:
+            with self._condition:
+                if not self._closed:
+                    self._idle.append(instance)
+                    self._condition.notify_all()
+                    return
+        self._discard(instance)
+        with self._condition:
+            if self._closed:
+                return
+            self.n_recycled+=1
+        # the replacement starts while the other instances keep working
+        threading.Thread(target=self._make_ready,
+                         args=(self._new_instance(),), daemon=True).start()
+
+    @contextmanager
+    def job(self, timeout=None):
+        '''Context manager giving the Communication client of a ready
+        instance, for one job. The commands sent are flushed at the end,
+        and the instance is replaced if it stopped answering
+
+        Parameters:
+            timeout: the time in seconds to wait for an instance, or None
+            to wait as long as needed
+        '''
+        instance=self.acquire(timeout)
+        try:
+            yield instance.client
+            instance.client.flush()
+        except BaseException as error:
+            # the timeouts and lost connections leave Blender in an
+            # unknown state
+            self.release(instance, failed=isinstance(error, OSError))
+            raise
+        self.release(instance)
+
+    @property
+    def instances(self):
+        '''the running BlenderInstances, busy or not'''
+        with self._condition:
+            return list(self._instances)
+
+    def close(self):
+        '''Stop all the instances'''
+        with self._condition:
+            self._closed=True
+            self._idle=[]
+            instances=list(self._instances)
+            self._condition.notify_all()
+        for instance in instances:
+            self._discard(instance)
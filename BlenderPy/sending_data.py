@@ -5,74 +5,1457 @@ Created on Wed Aug 26 09:56:27 2020
 @author: Thibault
 """
 
-import socket
 import json
 import time
+import queue
+import weakref
+import threading
+import itertools
+from copy import deepcopy
 from BlenderPy.parsing import Expression
+from BlenderPy.transport import (Connection, ConnectionPool, TransferStats,
+                                 COMPRESSIONS, COMPRESSION_THRESHOLD,
+                                 INTERACTIVE, NORMAL, BULK, CONNECT_TIMEOUT,
+                                 PROTOCOL_VERSION, CAPABILITIES,
+                                 encode_message, decode_message, compress,
+                                 decompress, release_shared_memory,
+                                 RemoteError, CommandTimeout)
 import numpy as np
 HOST = '127.0.0.1'
 PORT = 20000
+# path of the unix domain socket of the Blender Server, to use instead of
+# TCP when Blender runs on the same machine, or None
+SOCKET_PATH = None
 
-def delete_all():
-    '''Delete all objects, meshes, cameras, ...'''
-    assert Communication.ask('delete_all')=="DONE"
+def _cache_key(value):
+    # a hashable form of the names and keys of the cached values, or None
+    # for the BatchResults and arrays
+    try:
+        return json.dumps(value, sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+
+# the properties of an object whose change moves its children and the
+# objects constrained by it
+_TRANSFORMS=('location', 'rotation_euler', 'rotation_quaternion',
+             'rotation_axis_angle', 'rotation_mode', 'scale', 'delta_location',
+             'delta_rotation_euler', 'delta_rotation_quaternion',
+             'delta_scale', 'matrix_world', 'matrix_basis', 'matrix_local',
+             'matrix_parent_inverse', 'parent', 'constraints')
+
+# the cached values of the datablocks of each type, as the first item of
+# their owner, and the path of the name of the datablock in the owner, or
+# None for all of them
+_DATABLOCK_OWNERS=dict({
+        'OBJECT':[(('object_property', 'modifier_property',
+                    'constraint_property'), (2,))],
+        'MESH':[(('vertices',), (1,))],
+        'LIGHT':[(('light_property',), (1,))],
+        'CAMERA':[(('camera_property',), (1,))],
+        'MATERIAL':[(('shadernode_input', 'shadernode_output',
+                      'shadernode_property'), (2,)),
+                    # the sockets keep the material in their parameters
+                    (('shadersocket_property',), (3, 'material_name'))],
+        'SCENE':[(('scene_property',), None)]})
+
+def _owner_name(parts, path):
+    # the name of the datablock in an owner, or None if it has none there
+    for key in path:
+        try:
+            parts=parts[key]
+        except (IndexError, KeyError, TypeError):
+            return None
+    return parts
+
+def _is_partial(key, value):
+    # the location can be set one coordinate at a time
+    return key=='location' and isinstance(value, dict)
+
+def _merge_write(key, previous, value):
+    # the value of a property set twice, or read after setting some of its
+    # coordinates
+    if not _is_partial(key, value):
+        return value
+    if isinstance(previous, dict):
+        merged=dict(previous)
+        merged.update(value)
+        return merged
+    merged=list(previous)
+    for coordinate, v in value.items():
+        merged['xyz'.index(coordinate)]=v
+    return merged
+
+def _set_properties(commands):
+    # the set_properties command doing the set commands of the same object
+    message, kwargs=commands[0]
+    kwargs=dict(kwargs)
+    del kwargs['key'], kwargs['value']
+    kwargs.update(dict({'func':message[len('set_'):],
+                        'keys':[command[1]['key'] for command in commands],
+                        'values':[command[1]['value']
+                                  for command in commands]}))
+    return ('set_properties', kwargs)
+
+def _name(name):
+    # the name given by a batch, or the name itself
+    return name.value if isinstance(name, BatchResult) else name
+
+def _rename_object(client, name_obj, name, proxies=()):
+    # rename an object in Blender, and give its new name to the proxies
+    # registered for it and to the given ones
+    if client.active_paths()['rename']:
+        new_name=client.ask('rename', datablock='objects', name=name_obj,
+                            new_name=name)
+    else:
+        # a server older than rename, which does not tell the suffix added
+        # to a name already used
+        client.ask('set_object_property', key='name', value=name,
+                   parent_name='', parent_name_obj=name_obj)
+        new_name=name
+    old_name=_name(name_obj)
+    moved=client.proxies.rename(old_name, new_name, ('OBJECT',))
+    for proxy in moved+list(proxies):
+        if _name(proxy.name_obj)==old_name:
+            proxy._renamed(new_name)
+    return new_name
+
+def delete_all(client=None):
+    '''Delete all objects, meshes, cameras, ...
     
-class Communication:
-    '''A static class for communicating with the server'''
+    Parameters:
+        client: the Communication of the Blender Server, or None for the
+        default one
+    '''
+    client=Communication.client(client)
+    assert client.ask('delete_all')=="DONE"
+    client.clear_cache()
+    client.proxies.clear()
+    
+class BatchResult:
+    '''The future result of a command queued in a Batch. Indexing it gives
+    the future result of the indexed item, so that a command can take as
+    argument the result of a previous command of the same batch, for
+    example the name of a newly created ShaderNode.
+    
+    Reading value, iterating over it or printing it flushes the batch. Two
+    BatchResult are only equal if they are the same object.'''
+    
+    def __init__(self, batch, segment, index, path=()):
+        self._batch=batch
+        self._segment=segment
+        self._index=index
+        self._path=path
+    
+    def __getitem__(self, key):
+        return BatchResult(self._batch, self._segment, self._index,
+                           self._path+(key,))
+    
+    def __iter__(self):
+        return iter(self.value)
+    
+    def __str__(self):
+        return str(self.value)
+    
+    def __repr__(self):
+        if self._segment.done:
+            return 'BatchResult({:})'.format(repr(self.value))
+        return 'BatchResult(pending)'
+    
+    @property
+    def value(self):
+        '''the actual result, flushing the batch if needed'''
+        if not self._segment.done:
+            self._batch.flush()
+        return self._lookup()
+    
+    def _lookup(self):
+        res=self._segment.results[self._index]
+        for key in self._path:
+            res=res[key]
+        return res
+    
+    def to_message(self):
+        '''what should be sent to the server in place of this result: a
+        reference to a command of the batch being sent, or the value'''
+        if self._segment.done or self._segment is not self._batch.segment:
+            return self.value
+        if self._index<len(self._segment.results or []):
+            # a server without the batch command executes the commands one
+            # by one, so the result is already known
+            return self._lookup()
+        return dict({'__result__':self._index, 'path':list(self._path)})
 
-    @staticmethod
-    def send(message, **kwargs):
-        '''Send a message to the Blender Server
+class _Segment:
+    
+    def __init__(self):
+        self.commands=[]
+        self.results=None
+        self.done=False
+
+class Batch:
+    '''Context manager returned by Communication.batch. Inside it, the
+    commands are queued and sent in a single message when leaving it, or
+    when a result is needed before'''
+    
+    def __init__(self, client):
+        self.client=client
+        self.segment=_Segment()
+        self.depth=0
+        self.n_commands=0
+        self.n_round_trips=0
+    
+    def __enter__(self):
+        if self.depth==0:
+            self.client._local.batch=self
+        self.depth+=1
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth-=1
+        if self.depth==0:
+            self.client._local.batch=None
+            if exc_type is None:
+                self.flush()
+            else:
+                self.segment=_Segment()
+    
+    def add(self, message, kwargs):
+        '''Queue a command
         
-        Take a message, format it, encode it with its length at the
-        beginning, and send it to the Blender server.
+        Parameters:
+            message: the command
+            
+            kwargs: its arguments
+        
+        Returns:
+            a BatchResult for its answer
+        '''
+        self.segment.commands.append(dict({'command':message,
+                                           'kwargs':kwargs}))
+        self.n_commands+=1
+        return BatchResult(self, self.segment, len(self.segment.commands)-1)
+    
+    def flush(self):
+        '''Send all the queued commands in one message, and wait for their
+        answers
+        
+        Returns:
+            the list of answers
+        '''
+        segment=self.segment
+        if len(segment.commands)==0:
+            return []
+        if self.client.active_paths()['batch']:
+            segment.results=self.client.request('batch',
+                                                dict({'commands':
+                                                      segment.commands}))
+        else:
+            # a server older than the batch command
+            segment.results=[]
+            for command in segment.commands:
+                segment.results.append(self.client.request(
+                        command['command'], command['kwargs']))
+        segment.done=True
+        self.segment=_Segment()
+        self.n_round_trips+=1
+        return segment.results
+
+class Priority:
+    '''Context manager returned by Communication.priority, giving a
+    priority to the commands sent by the current thread inside it'''
+    
+    def __init__(self, client, priority):
+        self.client=client
+        self.priority=priority
+        self.previous=NORMAL
+    
+    def __enter__(self):
+        self.previous=self.client.current_priority()
+        self.client._local.priority=self.priority
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self.client._local.priority=self.previous
+        return False
+
+class Deadline:
+    '''Context manager returned by Communication.deadline, limiting the
+    time taken by the commands sent by the current thread inside it'''
+    
+    def __init__(self, client, seconds):
+        self.client=client
+        self.seconds=seconds
+        self.previous=None
+    
+    def __enter__(self):
+        self.previous=self.client.current_deadline()
+        deadline=time.monotonic()+self.seconds
+        if self.previous is not None:
+            deadline=min(deadline, self.previous)
+        self.client._local.deadline=deadline
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self.client._local.deadline=self.previous
+        return False
+
+class Cached:
+    '''Context manager returned by Communication.cached, serving the
+    properties read again by the current thread from memory while inside
+    it. The cache is cleared when the outermost one ends'''
+    
+    def __init__(self, client):
+        self.client=client
+    
+    def __enter__(self):
+        self.client._local.cached=getattr(self.client._local, 'cached', 0)+1
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self.client._local.cached-=1
+        if self.client._local.cached==0 and not self.client.caching:
+            self.client.clear_cache()
+        return False
+
+class Deferred:
+    '''Context manager returned by Communication.deferred, keeping the
+    properties set by the current thread inside it until they are needed.
+    The writes left are sent when the outermost one ends, or forgotten if
+    it ends with an exception, like a Batch'''
+    
+    def __init__(self, client):
+        self.client=client
+    
+    def __enter__(self):
+        local=self.client._local
+        local.deferred=getattr(local, 'deferred', 0)+1
+        if local.deferred==1:
+            local.writes=dict()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        local=self.client._local
+        local.deferred-=1
+        if local.deferred==0:
+            if exc_type is None:
+                self.client.flush_writes()
+            local.writes=None
+        return False
+
+class Stream:
+    '''Iterator returned by Communication.stream, giving the progress of
+    a long command while Blender executes it. Each progress is a
+    dictionary with the request ID, the number of steps done, their total
+    if it is known, the elapsed time in seconds, and a partial result for
+    some commands. The first one is sent when the command starts. The
+    answer is in result once the iteration is over:
+        
+        stream=Communication.stream('cut_mesh', name_msh=name,
+                                    planes_co=points, planes_no=normals)
+        for progress in stream:
+            if progress['elapsed']>60:
+                stream.cancel()
+        print(stream.result)
+    '''
+    
+    def __init__(self, client, message, kwargs):
+        self.client=client
+        self.message=message
+        self.result=None
+        self.request_id=None
+        self._error=None
+        self._cancelled=False
+        self._events=queue.Queue()
+        self._thread=threading.Thread(target=self._run, args=(kwargs,),
+                                      daemon=True)
+        self._thread.start()
+    
+    def _run(self, kwargs):
+        try:
+            self.result=self.client.request(self.message, kwargs,
+                                            progress=self._progress)
+        except BaseException as error:
+            self._error=error
+        finally:
+            self._events.put(None)
+    
+    def _progress(self, progress):
+        first=self.request_id!=progress['id']
+        self.request_id=progress['id']
+        if first and self._cancelled:
+            self.client.cancel(self.request_id)
+        self._events.put(progress)
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        progress=self._events.get()
+        if progress is None:
+            # the following calls stop as well
+            self._events.put(None)
+            self._thread.join()
+            error, self._error=self._error, None
+            if error is not None:
+                raise error
+            raise StopIteration
+        return progress
+    
+    def cancel(self):
+        '''Cancel the command. The iteration then raises a RemoteError'''
+        self._cancelled=True
+        if self.request_id is not None:
+            self.client.cancel(self.request_id)
+    
+    def wait(self):
+        '''Wait for the end of the command, skipping its progress
+
+        Return:
+            the answer
+        '''
+        for progress in self:
+            pass
+        return self.result
+
+class Subscription:
+    '''Iterator returned by Communication.subscribe, giving the changes
+    made in Blender by its interface, its animation or any client, as they
+    happen. Each event is a dictionary with the list of the datablocks
+    updated, each one with its type like 'OBJECT' or 'MESH', its name, and
+    the kinds of changes among 'transform', 'geometry' and 'shading', and
+    with the frame if it changed:
+        
+        with Communication.subscribe() as changes:
+            for event in changes:
+                for update in event.get('updates', []):
+                    print(update['type'], update['name'])
+    
+    The events are received by a thread, with a connection of their own,
+    which also forgets the values cached by the client for the datablocks
+    updated, so that the cache follows the changes made in Blender.
+    Blender only reports the changes once it has evaluated them, which it
+    does when its interface is redrawn.
+    '''
+    
+    def __init__(self, client, callback=None, events=None, invalidate=True):
+        self.client=client
+        self.callback=callback
+        self.invalidate=invalidate
+        self._events=queue.Queue()
+        self._error=None
+        self._closed=False
+        pool=client.get_pool()
+        deadline=client.request_deadline()
+        info=pool.hello(deadline)
+        if 'subscribe' not in info['capabilities']:
+            raise RemoteError('subscribe', 'the add-on of the Blender Server '
+                              'does not notify its changes', None)
+        paths=client.choose_paths(info, pool.is_local)
+        self.request_id=next(client._ids)
+        self.connection=Connection(pool.host, pool.port, pool.path,
+                                   client.connect_timeout)
+        self.connection.connect()
+        self.connection.deadline=deadline
+        try:
+            self.connection.send_frame(client.encode(
+                    'subscribe', dict({'events':events}),
+                    request_id=self.request_id, codec=paths['codec'],
+                    paths=paths))
+            data=self.connection.receive_frame()
+            if data is None:
+                raise ConnectionError('the Blender Server closed the '
+                                      'connection')
+            reply=client.decode(data)
+        except BaseException:
+            self.connection.close()
+            raise
+        if 'error' in reply:
+            self.connection.close()
+            raise RemoteError('subscribe', reply['error'],
+                              reply.get('traceback'))
+        self.events=reply['content']['events']
+        self.connection.deadline=None
+        self._thread=threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+    
+    def _run(self):
+        try:
+            while True:
+                data=self.connection.receive_frame()
+                if data is None:
+                    break
+                reply=self.client.decode(data)
+                if 'progress' not in reply:
+                    raise RemoteError('subscribe', reply.get('error'),
+                                      reply.get('traceback'))
+                event=reply['progress']
+                if self.invalidate:
+                    self.client.invalidate_changes(event)
+                if self.callback is not None:
+                    self.callback(event)
+                self._events.put(event)
+        except BaseException as error:
+            if not self._closed:
+                self._error=error
+        finally:
+            self._events.put(None)
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        event=self._events.get()
+        if event is None:
+            # the following calls stop as well
+            self._events.put(None)
+            error, self._error=self._error, None
+            if error is not None:
+                raise error
+            raise StopIteration
+        return event
+    
+    def close(self):
+        '''Stop receiving the changes. The iteration then stops'''
+        self._closed=True
+        self.connection.shutdown()
+        self._thread.join()
+        self.connection.close()
+
+class ProxyRegistry:
+    '''The proxies of the datablocks of a Blender Server, like its Objects,
+    Materials and ShaderNodes, by kind and names, so that the same
+    datablock is always given by the same proxy:
+        
+        constraint.properties['target'] is target
+    
+    A key is the kind of the datablock followed by its names, like
+    ('OBJECT', 'mesh.001') or ('SHADERNODE', 'material', 'Emission'). The
+    proxies are held by weak references, and leave the registry once
+    nothing else uses them. A proxy whose name is the result of a batch is
+    registered once the batch is sent.
+    '''
+    
+    def __init__(self):
+        self._proxies=weakref.WeakValueDictionary()
+        # the keys holding names of batches not sent yet, with their proxy
+        self._pending=[]
+        self._lock=threading.Lock()
+        self.hits=0
+        self.misses=0
+    
+    def __len__(self):
+        return len(self._proxies)
+    
+    def _resolve(self):
+        # register the proxies whose names have been given since
+        with self._lock:
+            pending, self._pending=self._pending, []
+        waiting=[]
+        for key, ref in pending:
+            proxy=ref()
+            if proxy is None:
+                continue
+            results=[name for name in key if isinstance(name, BatchResult)
+                     and not name._segment.done]
+            if not results:
+                self.register(tuple(name._lookup()
+                                    if isinstance(name, BatchResult)
+                                    else name for name in key), proxy)
+            elif all(res._segment is res._batch.segment for res in results):
+                waiting.append((key, ref))
+            # the other ones were queued in a batch left by an exception
+        with self._lock:
+            self._pending.extend(waiting)
+    
+    def find(self, key):
+        '''the proxy registered for a key, or None'''
+        self._resolve()
+        with self._lock:
+            return self._proxies.get(tuple(key))
+    
+    def get(self, key, factory):
+        '''Get the proxy of a datablock, making it if there is none
         
         Parameters:
-            message: string to send
+            key: the kind of the datablock followed by its names
+            
+            factory: a function making the proxy
         
         Return:
-            None
+            the registered proxy, or the one made by factory
+        '''
+        key=tuple(key)
+        proxy=self.find(key)
+        if proxy is not None:
+            with self._lock:
+                self.hits+=1
+            return proxy
+        proxy=factory()
+        with self._lock:
+            self.misses+=1
+        return self.register(key, proxy)
+    
+    def register(self, key, proxy):
+        '''Register the proxy of a datablock. A proxy already registered
+        for the same key stays, unless the new one is more specific, like a
+        Mesh for an Object
+        
+        Parameters:
+            key: the kind of the datablock followed by its names
+            
+            proxy: the proxy
+        
+        Return:
+            the proxy registered for the key
+        '''
+        key=tuple(key)
+        if any(isinstance(name, BatchResult) for name in key):
+            with self._lock:
+                self._pending.append((key, weakref.ref(proxy)))
+            return proxy
+        if not all(isinstance(name, str) for name in key):
+            return proxy
+        with self._lock:
+            existing=self._proxies.get(key)
+            if (existing is None or (type(proxy) is not type(existing)
+                                     and isinstance(proxy, type(existing)))):
+                self._proxies[key]=proxy
+                return proxy
+            return existing
+    
+    def forget(self, key):
+        '''Remove the proxies whose key starts with the given one, after
+        removing their datablock from Blender'''
+        key=tuple(name._lookup() if isinstance(name, BatchResult)
+                  and name._segment.done else name for name in key)
+        self._resolve()
+        with self._lock:
+            for other in list(self._proxies.keys()):
+                if other[:len(key)]==key:
+                    self._proxies.pop(other, None)
+            self._pending=[(other, ref) for other, ref in self._pending
+                           if other[:len(key)]!=key]
+    
+    def rename(self, name, new_name, kinds):
+        '''Register under their new name the proxies of a renamed
+        datablock, and of the datablocks found through it, like the
+        ShaderNodes of a Material
+        
+        Parameters:
+            name: the old name
+            
+            new_name: the new name
+            
+            kinds: the kinds of the keys whose first name is the old name
+        
+        Return:
+            the list of the proxies moved
+        '''
+        if isinstance(name, BatchResult):
+            name=name.value
+        self._resolve()
+        moved=[]
+        with self._lock:
+            for key in list(self._proxies.keys()):
+                if key[0] in kinds and key[1]==name:
+                    proxy=self._proxies.pop(key, None)
+                    if proxy is not None:
+                        self._proxies[(key[0], new_name)+key[2:]]=proxy
+                        moved.append(proxy)
+        return moved
+    
+    def clear(self):
+        '''Forget all the proxies'''
+        with self._lock:
+            self._proxies.clear()
+            self._pending=[]
+    
+    def stats(self):
+        '''Get the number of proxies given again from the registry (hits),
+        the number made (misses), and the number registered (proxies)'''
+        return dict({'hits':self.hits, 'misses':self.misses,
+                     'proxies':len(self)})
+
+class clientmethod:
+    '''Decorator of the methods of Communication, which are called on a
+    client, or on the class to use the default client'''
+    
+    def __init__(self, function):
+        self.function=function
+        self.__doc__=function.__doc__
+    
+    def __get__(self, instance, owner):
+        if instance is None:
+            instance=owner.default()
+        return self.function.__get__(instance, owner)
+
+class Communication:
+    '''A client of the Blender Server. The connections are kept open in
+    a ConnectionPool between calls, and can be used by several threads at
+    the same time.
+    
+    The methods can be called on the class, which uses the default
+    client, following HOST, PORT and SOCKET_PATH. A client of another
+    Blender Server is made with:
+        
+        client=Communication(host='192.168.1.10', port=20000)
+        mesh=Mesh(cells, points, client=client)
+    
+    The settings below are read from the client, and default to the ones
+    of the class.
+    
+    The first message to a Blender Server is the hello command, which
+    agrees on the protocol version and on what both sides can do. Then,
+    every message takes the fastest path the server supports, and falls
+    back to plain json lists for a server older than these paths.
+    active_paths() tells which ones are used.
+    
+    The messages larger than compression_threshold are compressed with one
+    of the methods of COMPRESSIONS. With compression set to 'auto', they
+    are only compressed when the server runs on another machine, and
+    compression can also be set to a method, or to None to never compress
+    the messages sent:
+        
+        Communication.compression='zlib'
+    
+    With shared_memory set to 'auto', the large numpy arrays of ask are
+    copied in shared memory blocks instead of being sent through the
+    socket, and the server answers the same way, if the server could read
+    a block created by this process during the hello command. True uses
+    shared memory with any server supporting it, and False never does.
+    
+    The Blender Server executes the commands of each connection in the
+    order they were received, and chooses by priority the connection whose
+    next command runs. A command with a higher priority waits for the
+    commands sent before by the same thread, but not for the ones of the
+    other threads. For example, to read a property while a script is
+    sending long commands from another thread:
+        
+        with Communication.priority(INTERACTIVE):
+            location=obj.location
+    
+    A command sent without waiting can be cancelled with the request ID
+    returned by send, and cancel() cancels all the commands waiting for
+    their answer. The long commands, like cut_mesh, can report their
+    progress while they run, with stream or ask_with_progress.
+    
+    The properties read through the objects, like mesh.location or
+    mesh.vertices, can be kept in memory to be read again without asking
+    Blender, which helps the layout code reading the same positions many
+    times:
+        
+        with Communication.cached():
+            b.zmax=s.zmax
+            c.center=s.center
+    
+    Writing a property through the objects forgets what was read from the
+    same object, and moving an object or changing a constraint forgets the
+    matrix_world read from every object. The changes made in Blender by
+    other means are only seen once the cache is cleared with
+    clear_cache(), or at the end of the block, unless the client subscribed to them with subscribe, which
+    forgets the values of the datablocks changed there. Setting caching to
+    True caches the reads outside of the blocks too, until clear_cache().
+    
+    The properties set on objects, lights, cameras and the scene can be
+    kept until they are needed, and then sent together in one message.
+    Several writes to the same property are merged, so that moving an
+    object along x, y and z sends its location once:
+        
+        with Communication.deferred():
+            mesh.x=1
+            mesh.y=2
+            mesh.zmin=0
+        print(Communication.write_stats())
+    
+    The writes are sent before any other command, like a keyframe, and
+    before reading a property of the object that they may change, so the
+    commands still see them. The ones left are sent at the end of the
+    block.
+    
+    The objects, materials, shader nodes and sockets given by the
+    properties are kept by the client in its proxies, a ProxyRegistry, so
+    that the same datablock is always given by the same object, whose name
+    follows Object.rename and Material.rename.
+    
+    A command not answered within timeout seconds, if it is not None,
+    raises a CommandTimeout and is cancelled. A deadline shared by several
+    commands is given with:
+        
+        with Communication.deadline(5):
+            vertices=mesh.vertices
+            location=mesh.location
+    
+    The read commands, whose name starts with get_, are retried up to
+    retries times after a timeout or a lost connection, waiting
+    retry_backoff seconds, then twice as long at each retry. A server not
+    accepting the connection within connect_timeout seconds raises a
+    ConnectionError.
+    '''
+    
+    _default=None
+    _default_lock=threading.Lock()
+    _ids=itertools.count(1)
+    binary_arrays=True
+    compression='auto'
+    compression_threshold=COMPRESSION_THRESHOLD
+    shared_memory='auto'
+    timeout=None
+    connect_timeout=CONNECT_TIMEOUT
+    retries=2
+    retry_backoff=0.1
+    caching=False
+    stats=TransferStats()
+    
+    def __init__(self, host=None, port=None, path=None):
         '''
-        message=Communication.parse(message, **kwargs)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            s.sendall(('{:010x}'.format(len(message))+message).encode())
+        Parameters:
+            host: the address of the Blender Server. Default to HOST
+            
+            port: the port of the Blender Server. Default to PORT
+            
+            path: the path of the unix domain socket of the Blender Server,
+            to use instead of TCP, or None. If host, port and path are all
+            None, the client follows HOST, PORT and SOCKET_PATH, even when
+            they change
+        '''
+        if host is None and port is None and path is None:
+            self.endpoint=None
+            # the clients following HOST and PORT count their transfers
+            # in the stats of the class
+            self.stats=Communication.stats
+        else:
+            self.endpoint=(HOST if host is None else host,
+                           PORT if port is None else port, path)
+            self.stats=TransferStats()
+        self._pools=dict()
+        self._pools_lock=threading.Lock()
+        # the batch, priority, deadline and cached blocks of each thread
+        self._local=threading.local()
+        # the values read, by object and then by property
+        self._cache=dict()
+        self._cache_lock=threading.Lock()
+        self.cache_hits=0
+        self.cache_misses=0
+        # the properties set while deferring, and the commands and
+        # messages sent for them
+        self._writes_lock=threading.Lock()
+        self.n_writes=0
+        self.n_write_commands=0
+        self.n_write_messages=0
+        # the proxies of the datablocks, by kind and name
+        self.proxies=ProxyRegistry()
+    
+    @classmethod
+    def default(cls):
+        '''the default client, used by the methods called on the class
+        and by the objects created without a client'''
+        if cls._default is None:
+            with cls._default_lock:
+                if cls._default is None:
+                    cls._default=Communication()
+        return cls._default
     
     @staticmethod
-    def receive_all(sock, n):
-        '''Receive a message of a given length from the server.
+    def client(client=None):
+        '''the given client, or the default one if it is None'''
+        return Communication.default() if client is None else client
+    
+    @clientmethod
+    def get_pool(self):
+        '''Get the ConnectionPool to the Blender Server, creating it if
+        needed. The default client uses the current HOST and PORT, or
+        SOCKET_PATH if it is set'''
+        key=self.endpoint
+        if key is None:
+            key=(HOST, PORT, SOCKET_PATH)
+        with self._pools_lock:
+            if key not in self._pools:
+                self._pools[key]=ConnectionPool(
+                        key[0], key[1], path=key[2],
+                        decode=self.decode,
+                        connect_timeout=self.connect_timeout)
+            return self._pools[key]
+    
+    @clientmethod
+    def choose_paths(self, info=None, local=True):
+        '''Choose how the messages are written and sent to a server, from
+        the settings of Communication and what the server supports
         
-        After having found its length, receive packets until
-        the amount of data is equal to this length
+        Parameters:
+            info: the dictionary of server_info given by the hello command,
+            or None for a server of the current protocol version
+            
+            local: whether the server runs on the same machine
+        
+        Return:
+            a dictionary with the codec of the messages, whether the arrays
+            are sent as binary, the compression method of the messages
+            sent, the compression methods accepted for the answers, whether
+            shared memory is used, and whether each of pipelining, batch,
+            priority, cancel, progress, properties and rename is supported
+        '''
+        if info is None:
+            info=dict({'version':PROTOCOL_VERSION, 'codec':'json',
+                       'capabilities':CAPABILITIES,
+                       'compressions':list(COMPRESSIONS),
+                       'shared_memory':False})
+        capabilities=info['capabilities']
+        common=[method for method in COMPRESSIONS
+                if 'compression' in capabilities
+                and method in info['compressions']]
+        compression=self.compression
+        if compression=='auto':
+            # compressing costs more than it saves through loopback
+            compressions=[] if local else list(COMPRESSIONS)
+            compression=common[0] if common and not local else None
+        else:
+            compressions=list(COMPRESSIONS)
+            if compression not in common:
+                compression=None
+        if 'compression' not in capabilities:
+            compressions=[]
+        shared_memory=self.shared_memory
+        if shared_memory=='auto':
+            shared_memory=info['shared_memory']
+        else:
+            shared_memory=(bool(shared_memory)
+                           and 'shared_memory' in capabilities)
+        return dict({'codec':info['codec'],
+                     'binary_arrays':(self.binary_arrays
+                                      and 'binary_arrays' in capabilities),
+                     'compression':compression,
+                     'compressions':compressions,
+                     'shared_memory':shared_memory,
+                     'pipelining':'pipelining' in capabilities,
+                     'batch':'batch' in capabilities,
+                     'priority':'priority' in capabilities,
+                     'cancel':'cancel' in capabilities,
+                     'progress':'progress' in capabilities,
+                     'properties':'properties' in capabilities,
+                     'rename':'rename' in capabilities})
+    
+    @clientmethod
+    def active_paths(self):
+        '''Tell how the messages are written and sent to the Blender
+        Server, saying hello to it if it was not done yet
+        
+        Return:
+            the dictionary of choose_paths, with the protocol version of the
+            server, and the transport, 'unix' or 'tcp'
+        '''
+        pool=self.get_pool()
+        info=pool.hello(self.request_deadline())
+        paths=self.choose_paths(info, pool.is_local)
+        paths['version']=info['version']
+        paths['transport']='tcp' if pool.path is None else 'unix'
+        return paths
+    
+    @clientmethod
+    def close(self):
+        '''Close all the idle connections to the Blender Server'''
+        with self._pools_lock:
+            for pool in self._pools.values():
+                pool.close()
+    
+    @clientmethod
+    def batch(self):
+        '''Queue the commands sent in the current thread and send them in
+        a single message. Commands that do not need their answer (send,
+        ask_later) are queued, while ask sends the queue with its question,
+        so that its answer can be returned. For example:
+            
+            with Communication.batch() as batch:
+                material=MetallicMaterial()
+            print(batch.n_commands, batch.n_round_trips)
+        
+        Return:
+            the Batch context manager, which is the current one if batch is
+            called inside another batch
+        '''
+        batch=self.current_batch()
+        if batch is None:
+            batch=Batch(self)
+        return batch
+    
+    @clientmethod
+    def current_batch(self):
+        '''the Batch of the current thread, or None'''
+        return getattr(self._local, 'batch', None)
+    
+    @clientmethod
+    def priority(self, priority):
+        '''Give a priority to the commands sent by the current thread. The
+        commands with a lower priority are executed before the ones of the
+        other threads, but after the ones sent before by the same thread
         
         Parameters:
-            sock: socket to read from
-            n: expected length of the data
+            priority: INTERACTIVE, NORMAL or BULK
         
         Return:
-            data: the raw data
-        '''
-        data = bytearray()
-        i=1
-        while len(data) < n:
-            packet = sock.recv(n - len(data))
-            if not packet:
-                return None
-            data.extend(packet)
-            i+=1
-        return data  
+            the Priority context manager
+        '''
+        return Priority(self, priority)
+    
+    @clientmethod
+    def current_priority(self):
+        '''the priority of the commands sent by the current thread'''
+        return getattr(self._local, 'priority', NORMAL)
+    
+    @clientmethod
+    def deadline(self, seconds):
+        '''Limit the time taken by the commands sent by the current thread.
+        A command not answered before the deadline raises a CommandTimeout
+        
+        Parameters:
+            seconds: the time given to all the commands sent inside the
+            context manager
+        
+        Return:
+            the Deadline context manager
+        '''
+        return Deadline(self, seconds)
+    
+    @clientmethod
+    def current_deadline(self):
+        '''the time.monotonic() before which the commands sent by the
+        current thread must be answered, or None'''
+        return getattr(self._local, 'deadline', None)
+    
+    @clientmethod
+    def request_deadline(self):
+        '''the deadline of a command sent now, from the current deadline
+        and the timeout, or None if there is none'''
+        deadline=self.current_deadline()
+        if self.timeout is not None:
+            timeout=time.monotonic()+self.timeout
+            if deadline is None or timeout<deadline:
+                deadline=timeout
+        return deadline
+    
+    @clientmethod
+    def subscribe(self, callback=None, events=None, invalidate=True):
+        '''Receive the changes made in Blender, by its interface, its
+        animation or any client, as they happen
+        
+        Parameters:
+            callback: a function called with each event by the thread
+            receiving them, or None
+            
+            events: the list of the events to receive, among 'update' and
+            'frame', or None for all of them
+            
+            invalidate: whether the events make the client forget the
+            values cached for the datablocks updated
+        
+        Return:
+            the Subscription, to iterate over the events, and to close
+        '''
+        return Subscription(self, callback, events, invalidate)
+    
+    @clientmethod
+    def cached(self):
+        '''Keep the properties read by the current thread in memory, and
+        read them again from there while inside the context manager
+        
+        Return:
+            the Cached context manager
+        '''
+        return Cached(self)
+    
+    @clientmethod
+    def is_caching(self):
+        '''Whether the properties read now by the current thread are
+        cached'''
+        return self.caching or getattr(self._local, 'cached', 0)>0
+    
+    @clientmethod
+    def cached_read(self, owner, key, read, copy=True):
+        '''Read a value through the cache if caching, or with read
+        otherwise
+        
+        Parameters:
+            owner: what the value belongs to, like ('object_property', '',
+            name_obj). All the values of an owner are forgotten together
+            
+            key: the key of the value for this owner
+            
+            read: a function asking the value to Blender
+            
+            copy: whether to return copies of the cached value, which the
+            caller may modify
+        
+        Return:
+            the value
+        '''
+        if not self.is_caching():
+            return read()
+        owner, key=_cache_key(owner), _cache_key(key)
+        if owner is None or key is None:
+            # the names given by a batch are not known yet
+            return read()
+        with self._cache_lock:
+            values=self._cache.get(owner)
+            if values is not None and key in values:
+                self.cache_hits+=1
+                value=values[key]
+                return deepcopy(value) if copy else value
+            self.cache_misses+=1
+        value=read()
+        if isinstance(value, BatchResult):
+            return value
+        with self._cache_lock:
+            self._cache.setdefault(owner, dict())[key]=(
+                    deepcopy(value) if copy else value)
+        return value
+    
+    @clientmethod
+    def cached_read_many(self, owner, keys, read):
+        '''Like cached_read for several values of the same owner, asking
+        Blender only the ones not cached
+        
+        Parameters:
+            owner: what the values belong to
+            
+            keys: the list of the keys of the values
+            
+            read: a function asking Blender the list of the values of a
+            list of keys
+        
+        Return:
+            the list of the values
+        '''
+        if not self.is_caching():
+            return read(keys)
+        owner, ids=_cache_key(owner), [_cache_key(key) for key in keys]
+        if owner is None or None in ids:
+            return read(keys)
+        values=[None]*len(keys)
+        missing=[]
+        with self._cache_lock:
+            cached=self._cache.get(owner, dict())
+            for i, key_id in enumerate(ids):
+                if key_id in cached:
+                    values[i]=deepcopy(cached[key_id])
+                else:
+                    missing.append(i)
+            self.cache_hits+=len(keys)-len(missing)
+            self.cache_misses+=len(missing)
+        if missing:
+            answers=read([keys[i] for i in missing])
+            with self._cache_lock:
+                cached=self._cache.setdefault(owner, dict())
+                for i, value in zip(missing, answers):
+                    cached[ids[i]]=deepcopy(value)
+                    values[i]=value
+        return values
+    
+    @clientmethod
+    def invalidate(self, owner):
+        '''Forget the cached values of an owner, after writing to it
+        
+        Parameters:
+            owner: the owner given to cached_read
+        '''
+        self._invalidate_key(_cache_key(owner))
+    
+    @clientmethod
+    def invalidate_property(self, func, key):
+        '''Forget a property cached for every owner of a kind, after a
+        write that may change it on other objects than the one written
+        
+        Parameters:
+            func: the first item of the owners, like 'object_property'
+            
+            key: the key of the property
+        '''
+        key=_cache_key(key)
+        with self._cache_lock:
+            for owner, values in self._cache.items():
+                if json.loads(owner)[0]==func:
+                    values.pop(key, None)
+    
+    def _invalidate_key(self, owner):
+        with self._cache_lock:
+            if owner is None:
+                # a name given by a batch may be any of the cached ones
+                self._cache.clear()
+            else:
+                self._cache.pop(owner, None)
+    
+    @clientmethod
+    def invalidate_changes(self, event):
+        '''Forget the cached values of the datablocks changed in Blender
+        
+        Parameters:
+            event: an event given by subscribe
+        '''
+        if 'frame' in event:
+            # the animation may change any property
+            self.clear_cache()
+            return
+        for update in event.get('updates', []):
+            if update['type'] not in _DATABLOCK_OWNERS:
+                continue
+            with self._cache_lock:
+                for owner in list(self._cache):
+                    parts=json.loads(owner)
+                    for funcs, path in _DATABLOCK_OWNERS[update['type']]:
+                        if (parts[0] in funcs
+                            and (path is None or _owner_name(parts, path)
+                                 ==update['name'])):
+                            del self._cache[owner]
+                            break
+    
+    @clientmethod
+    def clear_cache(self):
+        '''Forget all the cached values, to read the changes made in
+        Blender by other means'''
+        with self._cache_lock:
+            self._cache.clear()
+    
+    @clientmethod
+    def cache_stats(self):
+        '''Get the number of reads served by the cache (hits) and sent to
+        Blender while caching (misses)
+        
+        Return:
+            a dictionary with the hits, the misses and the number of values
+            cached
+        '''
+        with self._cache_lock:
+            return dict({'hits':self.cache_hits,
+                         'misses':self.cache_misses,
+                         'values':sum(len(values)
+                                      for values in self._cache.values())})
+    
+    @clientmethod
+    def deferred(self):
+        '''Keep the properties set by the current thread on objects,
+        lights, cameras and the scene, and send them merged when they are
+        needed, or at the end of the context manager
+        
+        Return:
+            the Deferred context manager
+        '''
+        return Deferred(self)
+    
+    @clientmethod
+    def is_deferring(self):
+        '''Whether the properties set now by the current thread are kept
+        until they are needed'''
+        return getattr(self._local, 'writes', None) is not None
+    
+    @clientmethod
+    def defer_write(self, owner, key, message, kwargs):
+        '''Keep a property set inside a deferred block, merging it with
+        the previous writes of the same property
+        
+        Parameters:
+            owner: what the property belongs to, as for cached_read
+            
+            key: the key of the property
+            
+            message: the command setting it
+            
+            kwargs: the arguments of the command, with the value
+        
+        Return:
+            True if the write is kept, False if it must be sent now, like
+            the writes to the objects named by a BatchResult
+        '''
+        owner, key_id=_cache_key(owner), _cache_key(key)
+        if owner is None or key_id is None:
+            return False
+        # the caller may change its list before the write is sent
+        kwargs['value']=deepcopy(kwargs['value'])
+        writes=self._local.writes.setdefault(owner, dict())
+        if key_id in writes:
+            previous=writes[key_id][1]['value']
+            kwargs['value']=_merge_write(key, previous, kwargs['value'])
+        writes[key_id]=(message, kwargs)
+        with self._writes_lock:
+            self.n_writes+=1
+        return True
+    
+    @clientmethod
+    def deferred_read(self, owner, key, read):
+        '''Read a property, seeing the writes kept by the current thread
+        
+        Parameters:
+            owner: what the property belongs to, as for cached_read
+            
+            key: the key of the property
+            
+            read: a function asking the value to Blender, which sends the
+            writes kept first
+        
+        Return:
+            the value
+        '''
+        writes=getattr(self._local, 'writes', None)
+        if not writes:
+            return read()
+        owner, key_id=_cache_key(owner), _cache_key(key)
+        pending=writes.get(owner, dict())
+        if key_id not in pending:
+            return read()
+        message, kwargs=pending[key_id]
+        if not _is_partial(key, kwargs['value']):
+            return deepcopy(kwargs['value'])
+        if len(pending)>1:
+            # the other writes may change the rest of the value
+            return read()
+        # only some coordinates of the location were set, and Blender
+        # still has the others
+        self._local.writes=None
+        try:
+            base=read()
+        finally:
+            self._local.writes=writes
+        kwargs['value']=_merge_write(key, base, kwargs['value'])
+        return deepcopy(kwargs['value'])
+    
+    @clientmethod
+    def flush_writes(self):
+        '''Send the properties kept by the current thread, in a single
+        message if the server supports the batch command'''
+        writes=getattr(self._local, 'writes', None)
+        if not writes:
+            return
+        self._local.writes=dict()
+        properties=(any(len(pending)>1 for pending in writes.values())
+                    and self.active_paths()['properties'])
+        commands=[]
+        for pending in writes.values():
+            if properties and len(pending)>1:
+                # one command for all the properties of an object
+                commands.append(_set_properties(list(pending.values())))
+            else:
+                commands+=pending.values()
+        outer=self.current_batch() is not None
+        for owner in writes:
+            # the values read while the writes were kept are outdated
+            self._invalidate_key(owner)
+        if len(commands)==1:
+            self.ask_later(commands[0][0], **commands[0][1])
+        else:
+            with self.batch():
+                for message, kwargs in commands:
+                    self.ask_later(message, **kwargs)
+        if outer:
+            # sent with the message of the batch
+            messages=0
+        elif len(commands)>1 and not self.active_paths()['batch']:
+            messages=len(commands)
+        else:
+            messages=1
+        with self._writes_lock:
+            self.n_write_commands+=len(commands)
+            self.n_write_messages+=messages
+    
+    @clientmethod
+    def write_stats(self):
+        '''Get the number of properties set inside deferred blocks, of
+        the commands and messages sent for them, and of the messages saved
+        
+        Return:
+            a dictionary with the writes, commands, messages and saved
+            counters
+        '''
+        with self._writes_lock:
+            return dict({'writes':self.n_writes,
+                         'commands':self.n_write_commands,
+                         'messages':self.n_write_messages,
+                         'saved':self.n_writes-self.n_write_messages})
     
     @staticmethod
-    def ask(message, **kwargs):
+    def is_idempotent(message):
+        '''Whether a command can be sent again without changing its result,
+        which is the case of the commands only reading data'''
+        return message.startswith('get_')
+    
+    @clientmethod
+    def cancel(self, request_id=None):
+        '''Cancel a command waiting for its answer, or all of them. The
+        Blender Server skips it if it is waiting to be executed, or stops
+        it if it is a long command checking for its cancellation, like
+        cut_mesh. The cancelled commands fail with a RemoteError
+        
+        Parameters:
+            request_id: the ID returned by send, or None to cancel all the
+            commands waiting for their answer
+        
+        Return:
+            the number of commands whose cancellation was sent
+        '''
+        with self._pools_lock:
+            pools=list(self._pools.values())
+        return sum(pool.cancel(request_id) for pool in pools)
+    
+    @clientmethod
+    def send(self, message, **kwargs):
+        '''Send a message to the Blender Server
+        
+        Take a message, format it, encode it with its length at the
+        beginning, and send it to the Blender server without waiting for
+        the answer. If the command fails, the error is raised by a later
+        call to send, ask or flush. Inside a batch, the message is queued.
+        
+        Parameters:
+            message: string to send
+        
+        Return:
+            the ID of the request, to cancel it, or None inside a batch
+        '''
+        self.flush_writes()
+        batch=self.current_batch()
+        if batch is not None:
+            batch.add(message, kwargs)
+            return None
+        pool=self.get_pool()
+        pool.check_errors()
+        deadline=self.request_deadline()
+        paths=self.choose_paths(pool.hello(deadline), pool.is_local)
+        # without pipelining, the server does not know the request IDs
+        request_id=(next(self._ids) if paths['pipelining']
+                    else None)
+        pool.exchange(self.encode(message, kwargs, request_id=request_id,
+                                  codec=paths['codec'], paths=paths),
+                      request_id, message, answer=False, deadline=deadline)
+        # the lowest priority of the commands of this thread not answered
+        # yet, see _wait_sent
+        sent=getattr(self._local, 'sent_priority', None)
+        self._local.sent_priority=max(self.current_priority(),
+                                      NORMAL if sent is None else sent)
+        return request_id
+    
+    def _wait_sent(self, pool, deadline):
+        # a command with a higher priority than the ones sent before by
+        # this thread could go ahead of them if they went through another
+        # connection, and read what they have not written yet
+        sent=getattr(self._local, 'sent_priority', None)
+        if sent is not None and self.current_priority()<sent:
+            pool.flush(deadline)
+            self._local.sent_priority=None
+    
+    @clientmethod
+    def ask(self, message, **kwargs):
         '''Ask a question to the Blender Server.
         
-        Open a socket,encode properly the data to send like the 
-        send method with the length of the data at the beginning,
+        Take a connection from the pool, encode properly the data to send
+        like the send method with the length of the data at the beginning,
         then send the data, receive the beginning of the answer
-        which contains the length of the answer, and then call
-        receive_all to receive the data.
+        which contains the length of the answer, and then receive the data.
         Then, return the json extracted dictionnary that contain
-        the data.
+        the data. Inside a batch, the queued commands are sent together
+        with the question.
         
         Parameters:
             message: the question to ask
@@ -80,45 +1463,236 @@ class Communication:
         Return:
             the data
         '''
-        message=Communication.parse(message, **kwargs)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((HOST, PORT))
-            s.sendall(('{:010x}'.format(len(message))+message).encode())
-            raw_msglen = s.recv(10)
-            msglen = int(raw_msglen.decode(),16)
-            data=Communication.receive_all(s, msglen)
-            return json.loads(data)['content']
+        self.flush_writes()
+        batch=self.current_batch()
+        if batch is not None:
+            batch.add(message, kwargs)
+            return batch.flush()[-1]
+        return self.request(message, kwargs)
+    
+    @clientmethod
+    def ask_with_progress(self, message, callback, **kwargs):
+        '''Like ask, calling a function with the progress messages of the
+        command while it runs. Raising an exception in the function
+        cancels the command, and the exception is raised by
+        ask_with_progress
+        
+        Parameters:
+            message: the question to ask
+            
+            callback: a function taking the progress, a dictionary like the
+            ones given by stream
+        
+        Return:
+            the data
+        '''
+        self.flush_writes()
+        if self.current_batch() is not None:
+            return self.ask(message, **kwargs)
+        return self.request(message, kwargs, progress=callback)
+    
+    @clientmethod
+    def stream(self, message, **kwargs):
+        '''Send a command, and iterate over its progress while it runs
+        
+        Parameters:
+            message: the name of the command
+        
+        Return:
+            a Stream
+        '''
+        self.flush_writes()
+        return Stream(self, message, kwargs)
+    
+    @clientmethod
+    def request(self, message, kwargs, progress=None):
+        '''Send a command and wait for its answer, raising a RemoteError
+        if it failed, or the errors of the previous commands sent without
+        waiting. A read command is retried after a timeout or a lost
+        connection
+        
+        Parameters:
+            message: the name of the command
+            
+            kwargs: the arguments of the command
+            
+            progress: a function called with the progress messages of the
+            command, or None to receive only its answer
+        
+        Return:
+            the answer
+        '''
+        pool=self.get_pool()
+        pool.check_errors()
+        attempt=0
+        while True:
+            deadline=self.request_deadline()
+            paths=self.choose_paths(pool.hello(deadline), pool.is_local)
+            self._wait_sent(pool, deadline)
+            request_id=(next(self._ids) if paths['pipelining']
+                        else None)
+            shared=[] if paths['shared_memory'] else None
+            try:
+                reply=pool.exchange(self.encode(message, kwargs, shared,
+                                                request_id, paths['codec'],
+                                                progress is not None,
+                                                paths),
+                                    request_id, message, deadline=deadline,
+                                    progress=progress)
+                break
+            except (CommandTimeout, ConnectionError):
+                delay=self.retry_backoff*2**attempt
+                last=self.current_deadline()
+                if (not self.is_idempotent(message)
+                    or attempt>=self.retries
+                    or (last is not None
+                        and time.monotonic()+delay>=last)):
+                    raise
+            finally:
+                release_shared_memory(shared)
+            attempt+=1
+            time.sleep(delay)
+        pool.check_errors()
+        return reply['content']
+    
+    @clientmethod
+    def flush(self):
+        '''Wait until the Blender Server has executed all the commands
+        sent, and raise the first error if some of them failed'''
+        self.flush_writes()
+        with self._pools_lock:
+            pools=list(self._pools.values())
+        deadline=self.request_deadline()
+        for pool in pools:
+            pool.flush(deadline)
+        self._local.sent_priority=None
+    
+    @clientmethod
+    def ask_later(self, message, **kwargs):
+        '''Like ask, but inside a batch the question is queued and a
+        BatchResult is returned instead of the answer. To be used when the
+        answer is only needed as an argument of later commands.
+        
+        Parameters:
+            message: the question to ask
+        
+        Return:
+            the data, or a BatchResult
+        '''
+        self.flush_writes()
+        batch=self.current_batch()
+        if batch is not None:
+            return batch.add(message, kwargs)
+        return self.ask(message, **kwargs)
     
     @staticmethod
     def format_dict(kwargs):
+        '''Convert the numpy arrays of kwargs to lists, for a server that
+        only understands json'''
         res=dict()
         for k,v in kwargs.items():
             if isinstance(v, np.ndarray):
-                if len(v.shape)==2:
-                    res[k]=[list(i) for i in v]
-                elif len(v.shape)==1:
-                    res[k]=[i for i in v]
-                else:
-                    raise NotImplementedError('are you sending 3d matrices ?')
+                res[k]=v.tolist()
             else:
                 res[k]=v
         return res
     
-    @staticmethod
-    def parse(message, **kwargs):
-        '''Format a message to be sent to the Blender Server.
+    @clientmethod
+    def parse(self, message, **kwargs):
+        '''Format a message to be sent to the Blender Server. If
+        binary_arrays is True, the numpy arrays are sent as raw bytes in an
+        array frame instead of json lists.
         
         Parameters:
             message: the question to ask
         
         Return:
-            the data
+            the encoded bytes
+        '''
+        return self.encode(message, kwargs)
+    
+    @clientmethod
+    def encode(self, message, kwargs, shared=None, request_id=None,
+               codec='json', progress=False, paths=None):
+        '''Like parse, with the keyword arguments of the command as a
+        dictionary
+        
+        Parameters:
+            message: the question to ask
+            
+            kwargs: the arguments of the command
+            
+            shared: a list receiving the shared memory blocks holding the
+            large arrays, or None to send everything through the socket.
+            With a list, the server may answer through shared memory too.
+            The blocks must be released with release_shared_memory once the
+            answer is received
+            
+            request_id: the ID of the request. The server replies to every
+            request with an ID, with the same ID
+            
+            codec: the name of the codec writing the message, which the
+            server must know. The server answers with the same codec
+            
+            progress: whether the server should send the progress of the
+            command before its answer
+            
+            paths: the dictionary of choose_paths for the server, or None
+            for a server of the current protocol version
+        
+        Return:
+            the encoded bytes
         '''
+        if paths is None:
+            paths=self.choose_paths()
         res=dict()
         res['command']=message
-        res['kwargs']=Communication.format_dict(kwargs)
-        msg=json.dumps(res)
-        return msg
+        if request_id is not None:
+            res['id']=request_id
+        res['binary']=paths['binary_arrays']
+        res['compressions']=paths['compressions']
+        res['shared_memory']=shared is not None
+        priority=self.current_priority()
+        if priority!=NORMAL and paths['priority']:
+            res['priority']=priority
+        if progress and paths['progress']:
+            res['progress']=True
+        # encode_message converts the arrays to lists if binary_arrays is
+        # False
+        res['kwargs']=kwargs
+        data=encode_message(res, binary=paths['binary_arrays'],
+                            shared=shared, codec=codec)
+        wire=compress(data, paths['compression'],
+                      self.compression_threshold)
+        self.stats.add_sent(len(data), len(wire))
+        return wire
+    
+    @clientmethod
+    def decode(self, data):
+        '''Decode an answer of the Blender Server, decompressing it if
+        needed
+        
+        Parameters:
+            data: the received bytes
+        
+        Return:
+            the decoded message
+        '''
+        raw=decompress(data)
+        self.stats.add_received(len(raw), len(data))
+        return decode_message(raw)
+    
+    @clientmethod
+    def transfer_stats(self):
+        '''Get the number of bytes sent and received by this client and by
+        the Blender Server, before compression (raw) and through the
+        sockets (wire)
+        
+        Return:
+            a dictionary with the counters of the client and the server
+        '''
+        return dict({'client':self.stats.to_dict(),
+                     'server':self.ask('get_transfer_stats')})
     
 class GeometricEntity:
     '''a class encompassing the geometric absolute positioning
@@ -266,13 +1840,16 @@ class Scene:
     
     def __init__(self, use_bloom=True, volumetric_tile_size=2,
                  frame_current=1, frame_start=1,
-                 frame_end=250):
-        self._properties=PropertyDict(func='scene_property')
-        self.use_bloom=use_bloom
-        self.volumetric_tile_size=volumetric_tile_size
-        self.frame_current=frame_current
-        self.frame_start=frame_start
-        self.frame_end=frame_end
+                 frame_end=250, client=None):
+        self.client=Communication.client(client)
+        self._properties=PropertyDict(func='scene_property',
+                                      client=self.client)
+        self._properties.update([(['eevee', 'use_bloom'], use_bloom),
+                                 (['eevee', 'volumetric_tile_size'],
+                                  str(volumetric_tile_size)),
+                                 ('frame_current', frame_current),
+                                 ('frame_start', frame_start),
+                                 ('frame_end', frame_end)])
     
     @property
     def volumetric_tile_size(self):
@@ -329,8 +1906,9 @@ class ShaderDict(dict):
     of the dict class to use the properties as a dictionary 
     with the server'''
     
-    def __init__(self, name, material_name, func, **kwargs):
+    def __init__(self, name, material_name, func, client=None, **kwargs):
         super().__init__()
+        self.client=Communication.client(client)
         self.name=name
         self.material_name=material_name
         self.func=func
@@ -338,38 +1916,59 @@ class ShaderDict(dict):
         
     def __setitem__(self, key, value):
         kwargs=self.params.copy()
+        self.client.invalidate(self._owner())
         if hasattr(value, 'to_dict'):
             kwargs.update(value.to_dict(material_name=self.material_name,
                                         from_name=self.name,
                                        from_key=key))
-            Communication.ask('set_'+self.func, **kwargs)
+            self.client.ask_later('set_'+self.func, **kwargs)
         else:
             kwargs.update(dict({'material_name':self.material_name,
                                 'from_name':self.name,
                                 'from_key':key,
                                 'value':value}))
-            Communication.ask('set_'+self.func, **kwargs)
+            self.client.ask_later('set_'+self.func, **kwargs)
+    
+    def _owner(self):
+        return (self.func, self.name, self.material_name, self.params)
     
     def __getitem__(self, key):
         kwargs=self.params.copy()
         kwargs.update(dict({'material_name':self.material_name,
                      'name':self.name,
                      'key':key}))
-        res=Communication.ask('get_'+self.func, **kwargs)
-        if isinstance(res, dict):
-            node=ShaderNode(**res)
-            return ShaderSocket(material_parent=node.parent_name,
-                                parent=node, 
-                                key=res['socket_name'],
-                                shader_socket_type=res['shader_socket_type'])
-        else:
-            return res
+        if self.func=='shadernode_property':
+            return self.client.cached_read(
+                    self._owner(), key,
+                    lambda: self.client.ask('get_'+self.func, **kwargs))
+        # inputs and outputs are only references to sockets, which do not
+        # need to be known before the end of a batch
+        res=self.client.cached_read(
+                self._owner(), key,
+                lambda: self.client.ask_later('get_'+self.func, **kwargs))
+        # the same node and socket are given by every path leading to them
+        node=self.client.proxies.get(
+                ('SHADERNODE', res['parent'], res['name']),
+                lambda: ShaderNode(parent=res['parent'], name=res['name'],
+                                   client=self.client))
+        return self.client.proxies.get(
+                ('SHADERSOCKET', res['parent'], res['name'],
+                 res['shader_socket_type'], res['socket_name']),
+                lambda: ShaderSocket(
+                        material_parent=node.parent_name,
+                        parent=node,
+                        key=res['socket_name'],
+                        shader_socket_type=res['shader_socket_type']))
+    
+    def _material_renamed(self, material_name):
+        self.client.invalidate(self._owner())
+        self.material_name=material_name
 
 class ShaderSocket:
     '''Class representing the ShaderSocket of a ShaderNode'''
     
     def __init__(self, material_parent=None, shader_socket_type='input',
-                 parent=None, key=None, value=None, **kwargs):
+                 parent=None, key=None, value=None, client=None, **kwargs):
         '''
         Parameters:
             material_parent: a Material object
@@ -381,9 +1980,13 @@ class ShaderSocket:
             key: the key of the socket
             
             value: the value of the socket
+            
+            client: the Communication of the Blender Server. Default to the
+            one of parent
         '''
             
         assert isinstance(parent, ShaderNode)
+        self.client=parent.client if client is None else client
         self.material_parent=material_parent
         self.parent=parent
         self.key=key
@@ -391,6 +1994,7 @@ class ShaderSocket:
         self.shader_socket_type=shader_socket_type
         self._properties=PropertyDict(self.parent.name,
                                       '', func='shadersocket_property',
+                                      client=self.client,
                                       **self.to_dict(socket_key=self.key))
     
     def to_dict(self, **kwargs):
@@ -404,10 +2008,15 @@ class ShaderSocket:
         params.update(kwargs)
         return params
     
+    def _material_renamed(self, material_name):
+        self.material_parent=material_name
+        self._properties.client.invalidate(self._properties._owner())
+        self._properties.params['material_name']=material_name
+    
     def insert_keyframe(self, key, frame='current'):
         '''insert a keyframe for this socket for the parameter 'key' at
         the frame 'frame' '''
-        Communication.ask('insert_keyframe_shadersocket',
+        self.client.ask_later('insert_keyframe_shadersocket',
                    **self.to_dict(key_to_keyframe=key, 
                                   frame=frame))
     
@@ -420,7 +2029,7 @@ class ShaderNode:
     '''Class representing a ShaderNode of a Material'''
     
     def __init__(self, parent=None, shader_type='Emission',
-                 name=None, **kwargs):
+                 name=None, client=None, **kwargs):
         '''
         Parameters:
             parent: a Material object
@@ -431,7 +2040,11 @@ class ShaderNode:
             'Image', 'Glossy', 'Noise', 'Color_Ramp'
             
             name: the name the ShaderNode will receive
+            
+            client: the Communication of the Blender Server, or None for the
+            default one
         '''
+        self.client=Communication.client(client)
         self.shader_type=shader_type
         assert parent is not None
         self._shadertype_dict=dict({'Emission':'ShaderNodeEmission',
@@ -450,16 +2063,19 @@ class ShaderNode:
             kwargs['shader_type']=self._format_type(shader_type)
             kwargs['parent_name']=parent
             self.parent_name=parent
-            self.name=Communication.ask('create_shadernode', **kwargs)
+            self.name=self.client.ask_later('create_shadernode', **kwargs)
         else:
             self.parent_name=parent
             self.name=name
+        self.client.proxies.register(('SHADERNODE', self.parent_name,
+                                      self.name), self)
         self._inputs=ShaderDict(self.name, self.parent_name,
-                                'shadernode_input')
+                                'shadernode_input', client=self.client)
         self._outputs=ShaderDict(self.name, self.parent_name,
-                                 'shadernode_output')
+                                 'shadernode_output', client=self.client)
         self._properties=ShaderDict(self.name, self.parent_name,
-                                    'shadernode_property')
+                                    'shadernode_property',
+                                    client=self.client)
     
     def to_dict(self, **kwargs):
         '''returns a dictionnary representing the ShaderNode
@@ -473,9 +2089,17 @@ class ShaderNode:
         assert key in self._shadertype_dict.keys()
         return self._shadertype_dict[key]
     
+    def _material_renamed(self, material_name):
+        self.parent_name=material_name
+        for shader_dict in (self._inputs, self._outputs, self._properties):
+            shader_dict._material_renamed(material_name)
+    
     def remove(self):
         '''remove the ShaderNode from the material'''
-        Communication.send('remove_shader', **self.to_dict())
+        self.client.clear_cache()
+        for kind in ('SHADERNODE', 'SHADERSOCKET'):
+            self.client.proxies.forget((kind, self.parent_name, self.name))
+        self.client.send('remove_shader', **self.to_dict())
     
     @property
     def inputs(self):
@@ -498,7 +2122,8 @@ class ShaderNode:
 class Constraint:
     '''Class representing a constraint for an object'''
     
-    def __init__(self, parent=None, constraint_type='FOLLOW_PATH', **kwargs):
+    def __init__(self, parent=None, constraint_type='FOLLOW_PATH',
+                 client=None, **kwargs):
         ''': creates a new constraint and link it to an Object
         
         Parameters:
@@ -512,19 +2137,27 @@ class Constraint:
             ‘DAMPED_TRACK’, ‘IK’, ‘LOCKED_TRACK’, ‘SPLINE_IK’, ‘STRETCH_TO’,
             ‘TRACK_TO’, ‘ACTION’, ‘ARMATURE’, ‘CHILD_OF’, ‘FLOOR’,
             ‘FOLLOW_PATH’, ‘PIVOT’, ‘SHRINKWRAP’
+            
+            client: the Communication of the Blender Server, or None for the
+            default one
         '''
+        self.client=Communication.client(client)
         kwargs['constraint_type']=constraint_type
         kwargs['parent_name']=parent
         self.parent_name=parent
-        self.name=Communication.ask('create_constraint', **kwargs)
+        # the constraint moves its parent
+        self.client.clear_cache()
+        self.name=self.client.ask_later('create_constraint', **kwargs)
         self._properties=PropertyDict(self.name, self.parent_name,
-                                      func='constraint_property')
+                                      func='constraint_property',
+                                      client=self.client)
     
     def insert_keyframe(self, key, frame='current'):
         '''insert a keyframe for this constraint for the parameter 'key' at
         the frame 'frame' '''
-        Communication.ask('insert_keyframe_constraint', key=key, frame=frame,
-                          name_obj=self.parent_name, name=self.name)
+        self.client.ask_later('insert_keyframe_constraint', key=key,
+                              frame=frame, name_obj=self.parent_name,
+                              name=self.name)
     
     @property
     def properties(self):
@@ -536,14 +2169,25 @@ class PropertyDict(dict):
     and getter of the dict class to use the properties as a dictionary 
     with the server'''
     
-    def __init__(self, name=None, name_obj=None, func=None, **kwargs):
+    # the properties whose writes can be deferred, see
+    # Communication.deferred
+    deferrable=('object_property', 'light_property', 'camera_property',
+                'scene_property')
+    
+    def __init__(self, name=None, name_obj=None, func=None, client=None,
+                 **kwargs):
         super().__init__()
+        self.client=Communication.client(client)
         self.name=name
         self.name_obj=name_obj
         self.func=func
         self.params=kwargs
         
     def __setitem__(self, key, value):
+        if self.func=='object_property' and key=='name':
+            # the proxies of the object follow its new name
+            _rename_object(self.client, self.name_obj, value, [self])
+            return
         kwargs=self.params.copy()
         kwargs.update(dict({'key':key,
                      'parent_name':self.name,
@@ -551,24 +2195,141 @@ class PropertyDict(dict):
         if hasattr(value, 'to_dict'):
             value=value.to_dict()
         kwargs['value']=value
-        Communication.ask('set_'+self.func,
-                          **kwargs)
+        self._invalidate([key])
+        if (self.func in self.deferrable and self.client.is_deferring()
+            and self.client.defer_write(self._owner(), key,
+                                        'set_'+self.func, kwargs)):
+            return
+        self.client.ask_later('set_'+self.func,
+                              **kwargs)
+    
+    def _owner(self):
+        # a write may change any property of the same object, like
+        # location changing matrix_world
+        return (self.func, self.name, self.name_obj, self.params)
+    
+    def _invalidate(self, keys):
+        # a write may change any property of the same object, and the
+        # position of others
+        self.client.invalidate(self._owner())
+        if self.func=='constraint_property':
+            # a constraint moves the object it belongs to, and its children
+            self.client.invalidate(('object_property', '', self.name_obj,
+                                    dict()))
+            self.client.invalidate_property('object_property',
+                                            'matrix_world')
+        elif self.func=='object_property' and any(
+                isinstance(key, str) and key in _TRANSFORMS for key in keys):
+            # moving an object moves its children, and the objects
+            # constrained by it
+            self.client.invalidate_property('object_property',
+                                            'matrix_world')
+    
+    def _renamed(self, name_obj):
+        self.client.invalidate(self._owner())
+        self.name_obj=name_obj
+    
+    def _proxy(self, res):
+        # a reference to an object gives the proxy already made for it
+        if isinstance(res, dict):
+            return self.client.proxies.get(
+                    ('OBJECT', res['name_obj']),
+                    lambda: Object(client=self.client, **res))
+        return res
     
     def __getitem__(self, key):
         kwargs=self.params.copy()
         kwargs.update(dict({'key':key,
                      'parent_name':self.name,
                      'parent_name_obj':self.name_obj}))
-        res=Communication.ask('get_'+self.func, **kwargs)
-        if isinstance(res, dict):
-            return Object(**res)
-        else:
-            return res
+        res=self.client.deferred_read(
+                self._owner(), key,
+                lambda: self.client.cached_read(
+                        self._owner(), key,
+                        lambda: self.client.ask('get_'+self.func, **kwargs)))
+        return self._proxy(res)
+    
+    def get_many(self, keys):
+        '''Get several properties in a single command
+        
+        Parameters:
+            keys: the list of the keys, each one a name, or a list of names
+            for a nested property like ['eevee', 'use_bloom']
+        
+        Returns:
+            the list of the values
+        '''
+        keys=list(keys)
+        if len(keys)==0:
+            return []
+        values=self.client.cached_read_many(self._owner(), keys,
+                                            self._get_many)
+        return [self._proxy(res) for res in values]
+    
+    def _get_many(self, keys):
+        kwargs=self.params.copy()
+        kwargs.update(dict({'parent_name':self.name,
+                            'parent_name_obj':self.name_obj}))
+        if self.client.active_paths()['properties']:
+            return self.client.ask('get_properties', func=self.func,
+                                   keys=keys, **kwargs)
+        # a server older than get_properties reads them one at a time, in
+        # a single batch
+        with self.client.batch():
+            results=[self.client.ask_later('get_'+self.func, key=key,
+                                           **kwargs) for key in keys]
+        return [res.value for res in results]
+    
+    def update(self, values=(), **kwargs):
+        '''Set several properties in a single command
+        
+        Parameters:
+            values: a dictionary of the values by key, or a list of
+            (key, value) pairs, whose keys can be lists of names for nested
+            properties like ['eevee', 'use_bloom']
+            
+            kwargs: more values by key
+        '''
+        if isinstance(values, dict):
+            values=values.items()
+        pairs=list(values)+list(kwargs.items())
+        if self.func=='object_property' and len(pairs)>1:
+            # renaming the object comes last, as the other properties are
+            # set through the old name
+            pairs=([(key, value) for key, value in pairs if key!='name']
+                   +[(key, value) for key, value in pairs if key=='name'])
+            if pairs[-1][0]=='name':
+                self.update(pairs[:-1])
+                self['name']=pairs[-1][1]
+                return
+        if (len(pairs)<=1 or
+            (self.func in self.deferrable and self.client.is_deferring())):
+            # the writes kept are merged by flush_writes
+            for key, value in pairs:
+                self[key]=value
+            return
+        if not self.client.active_paths()['properties']:
+            # a server older than set_properties
+            with self.client.batch():
+                for key, value in pairs:
+                    self[key]=value
+            return
+        kwargs=self.params.copy()
+        kwargs.update(dict({'parent_name':self.name,
+                            'parent_name_obj':self.name_obj}))
+        self._invalidate([key for key, value in pairs])
+        self.client.ask_later('set_properties', func=self.func,
+                              keys=[key for key, value in pairs],
+                              values=[value.to_dict()
+                                      if hasattr(value, 'to_dict') else value
+                                      for key, value in pairs],
+                              **kwargs)
 
 class Modifier:
     '''Class representing a modifier for an object'''
     
-    def __init__(self, parent=None, modifier_type='CURVE', **kwargs):
+    def __init__(self, parent=None, modifier_type='CURVE', client=None,
+                 **kwargs):
         '''
         Parameters:
             parent: an Object
@@ -586,14 +2347,19 @@ class Modifier:
             ‘SURFACE_DEFORM’, ‘WARP’, ‘WAVE’, ‘VOLUME_DISPLACE’, ‘CLOTH’, 
             ‘COLLISION’, ‘DYNAMIC_PAINT’, ‘EXPLODE’, ‘FLUID’, ‘OCEAN’,
             ‘PARTICLE_INSTANCE’, ‘PARTICLE_SYSTEM’, ‘SOFT_BODY’, ‘SURFACE’
+            
+            client: the Communication of the Blender Server, or None for the
+            default one
         '''
+        self.client=Communication.client(client)
         kwargs['modifier_type']=modifier_type
         kwargs['parent_name']=parent
         self.parent_name=parent
         self.modifier_type=modifier_type
-        self.name=Communication.ask('create_modifier', **kwargs)
+        self.name=self.client.ask_later('create_modifier', **kwargs)
         self._properties=PropertyDict(self.name, self.parent_name,
-                                      func='modifier_property')
+                                      func='modifier_property',
+                                      client=self.client)
     
     @property
     def properties(self):
@@ -605,8 +2371,9 @@ class Modifier:
         kwargs=dict({'name':self.name,
                      'name_obj':self.parent_name,
                      'modifier_type': self.modifier_type})
-        time.sleep(0.1)
-        Communication.ask('apply_modifier', **kwargs)
+        # the mesh of the parent changes
+        self.client.clear_cache()
+        self.client.ask_later('apply_modifier', **kwargs)
         
     
 class Material:
@@ -616,7 +2383,7 @@ class Material:
                  use_screen_refraction=False, refraction_depth=0.,
                  blend_method='OPAQUE', blend_method_shadow='OPAQUE',
                  use_backface_culling=False, create_new=True,
-                 metallic=0.,
+                 metallic=0., client=None,
                  **kwargs):
         '''
         Parameters:
@@ -626,9 +2393,12 @@ class Material:
             
             material with the same name, and if it fails, create a new one
             
+            client: the Communication of the Blender Server, or None for the
+            default one
+            
             other arguments: properties of the Principled BSDF shader
         '''
-    
+        self.client=Communication.client(client)
         if not create_new:
             names = self.get_material_names()
             if name in names:
@@ -637,6 +2407,8 @@ class Material:
                 self.material_object = self.create_material(name)
         else:
             self.material_object = self.create_material(name)
+        self.client.proxies.register(('MATERIAL', self.material_object),
+                                     self)
         self.color=Material.convert_color(color)
         params=dict({'name':self.material_object, 'color':self.color,
                      'alpha':alpha, 'transmission':transmission,
@@ -647,7 +2419,7 @@ class Material:
                      'blend_method_shadow':blend_method_shadow,
                      'metallic':metallic})
         params.update(kwargs)
-        Communication.send('update_material', **params)
+        self.client.send('update_material', **params)
         self.operations=dict({'*':'MULTIPLY',
                          '/':'DIVIDE',
                          '+':'ADD',
@@ -664,7 +2436,8 @@ class Material:
         for name in names:
             self._shadernodes_dimensions[name]=ShaderNode(name=name,
                                        parent=self.material_object,
-                                       shader_type=name).properties['location']
+                                       shader_type=name,
+                                       client=self.client).properties['location']
     
     @property
     def _xmax_shadernode_dimensions(self):
@@ -711,7 +2484,8 @@ class Material:
                     i=int(self._width_shadernode_dimensions)/dx+1
                     break
         res= ShaderNode(shader_type=shader_type,
-                          parent=self.material_object)
+                          parent=self.material_object,
+                          client=self.client)
         res.properties['location']=[i*dx, j*dy]
         self._shadernodes_dimensions[res.name]=[i*dx, j*dy]
         return res
@@ -735,7 +2509,8 @@ class Material:
                         self.operations[find_math_operation]):
                         return node
         else:
-            return ShaderNode(parent=self.material_object, name=name)
+            return ShaderNode(parent=self.material_object, name=name,
+                              client=self.client)
     
     def coordinate_expression(self, exp, special_keys=None):
         '''Construct a tree of Math ShaderNodes representing the math operation
@@ -892,14 +2667,42 @@ class Material:
         add_shader.inputs[1]=emission.outputs['Emission']
 
         
+    def rename(self, name):
+        '''Rename the Material in Blender. Its ShaderNodes and
+        ShaderSockets follow the new name
+        
+        Parameters:
+            name: the new name. Blender adds a suffix like .001 to a name
+            already used
+        
+        Returns:
+            the name given by Blender
+        '''
+        if not self.client.active_paths()['rename']:
+            raise RemoteError('rename', 'the add-on of the Blender Server '
+                              'cannot rename a material', None)
+        new_name=self.client.ask('rename', datablock='materials',
+                                 name=self.material_object, new_name=name)
+        moved=self.client.proxies.rename(
+                _name(self.material_object), new_name,
+                ('MATERIAL', 'SHADERNODE', 'SHADERSOCKET'))
+        if self not in moved:
+            moved.append(self)
+        for proxy in moved:
+            proxy._material_renamed(new_name)
+        return new_name
+    
+    def _material_renamed(self, material_name):
+        self.material_object=material_name
+    
     def get_material(self, name):
-        return Communication.ask('get_material', name=name)
+        return self.client.ask('get_material', name=name)
     
     def create_material(self, name):
-        return Communication.ask('create_material', name=name)
+        return self.client.ask_later('create_material', name=name)
     
     def get_material_names(self):
-        return Communication.ask('get_material_names')
+        return self.client.ask('get_material_names')
     
     @staticmethod
     def convert_color(color, alpha=1):
@@ -1077,7 +2880,7 @@ class Object:
     
     def __init__(self, name_obj=None, filepath=None,
                  location=None, scale=None,
-                 material=None, rotation=None,
+                 material=None, rotation=None, client=None,
                  **kwargs):
         '''
         Parameters:
@@ -1093,21 +2896,31 @@ class Object:
             material: if given, the material of the desired object
             
             rotation: if given, the rotation of the desired object
+            
+            client: the Communication of the Blender Server, or None for the
+            default one
         '''    
         
+        # the subclasses creating their object set the client before
+        if client is not None or not hasattr(self, 'client'):
+            self.client=Communication.client(client)
         if name_obj is not None:
             self.name_obj=name_obj
-        self._properties=PropertyDict('', self.name_obj, func='object_property')
+        self.client.proxies.register(('OBJECT', self.name_obj), self)
+        self._properties=PropertyDict('', self.name_obj,
+                                      func='object_property',
+                                      client=self.client)
         self.constraints=[]
         self.modifiers=[]
+        # the initial properties are set in a single command
+        values=dict()
         if filepath is not None:
-            self.load(filepath)
-        if location is not None:
-            self.location=location
-        if scale is not None:
-            self.scale=scale
-        if rotation is not None:
-            self.rotation=rotation
+            values.update(self._read(filepath))
+        for key, value in (('location', location), ('scale', scale),
+                           ('rotation_euler', rotation)):
+            if value is not None:
+                values[key]=value
+        self.properties.update(values)
         if material is not None:
             self.assign_material(material)
     
@@ -1124,7 +2937,8 @@ class Object:
         else:
             kwargs = dict({'name_obj':self.name_obj,
                            'name_mat':material.material_object})
-        Communication.send('assign_material', **kwargs)
+        self.client.invalidate(self._properties._owner())
+        self.client.send('assign_material', **kwargs)
     
     def load(self, filepath):
         '''Load a Json file with properties to set
@@ -1133,10 +2947,12 @@ class Object:
             filepath: path the Json file
         '''
         
+        self.properties.update(self._read(filepath))
+    
+    @staticmethod
+    def _read(filepath):
         with open(filepath, 'r') as f:
-            data=json.load(f)
-        for k, v in data.items():
-            self.properties[k]=v
+            return json.load(f)
     
     def duplicate(self):
         '''Duplicate the object
@@ -1145,8 +2961,9 @@ class Object:
             the new object
         '''
         
-        return Object(name_obj=Communication.ask('duplicate',
-                                                 name_obj=self.name_obj))
+        return Object(name_obj=self.client.ask_later('duplicate',
+                                                     name_obj=self.name_obj),
+                      client=self.client)
     
     def follow_path(self, target=None, use_curve_follow=True,
                     forward_axis='FORWARD_X'):
@@ -1173,9 +2990,9 @@ class Object:
             frame: the frame at which the keyframe should be set
         '''
         
-        Communication.ask('insert_keyframe_object',
-                          key=key, frame=frame,
-                          name_obj=self.name_obj)
+        self.client.ask_later('insert_keyframe_object',
+                              key=key, frame=frame,
+                              name_obj=self.name_obj)
         
     def assign_constraint(self, constraint_type='FOLLOW_PATH', **kwargs):
         '''Assign a constraint to the object
@@ -1186,6 +3003,7 @@ class Object:
         
         return Constraint(parent=self.name_obj,
                                    constraint_type=constraint_type,
+                                   client=self.client,
                                    **kwargs)
     
     def curve_modifier(self, target=None, deform_axis='POS_X'):
@@ -1213,6 +3031,7 @@ class Object:
         '''
         return Modifier(parent=self.name_obj,
                                    modifier_type=modifier_type,
+                                   client=self.client,
                                    **kwargs)
     
     def surface_subdivisions(self, levels=1, subdivision_type='SIMPLE'):
@@ -1225,9 +3044,7 @@ class Object:
         modifier=self.assign_modifier('SUBSURF')
         modifier.properties['levels']=levels
         modifier.properties['subdivision_type']=subdivision_type
-        time.sleep(0.5)
         modifier.apply()
-        time.sleep(0.5)
     
     def subtract(self, target, apply=True):
         '''Assign and apply a Boolean Modifier for subtraction between
@@ -1274,7 +3091,36 @@ class Object:
     def remove(self):
         '''Delete the Object
         '''
-        Communication.send('remove_object', **self.to_dict())
+        self.client.clear_cache()
+        self.client.proxies.forget(('OBJECT', self.name_obj))
+        self.client.send('remove_object', **self.to_dict())
+    
+    def rename(self, name):
+        '''Rename the Object in Blender. The proxies of the object, like
+        the ones given by the properties of other objects, follow the new
+        name
+        
+        Parameters:
+            name: the new name. Blender adds a suffix like .001 to a name
+            already used
+        
+        Returns:
+            the name given by Blender
+        '''
+        return _rename_object(self.client, self.name_obj, name, [self])
+    
+    def _renamed(self, name_obj):
+        # the properties of the object, of its modifiers and of its
+        # constraints are found in Blender by the name of the object
+        old_name=_name(self.name_obj)
+        self.name_obj=name_obj
+        for child in self.modifiers+self.constraints:
+            child.parent_name=name_obj
+            child.properties._renamed(name_obj)
+        for value in vars(self).values():
+            if (isinstance(value, PropertyDict)
+                and _name(value.name_obj)==old_name):
+                value._renamed(name_obj)
         
     @property
     def properties(self):
@@ -1366,22 +3212,26 @@ class Camera(Object):
     '''
     
     
-    def __init__(self, name='camera',
+    def __init__(self, name='camera', client=None,
                  **kwargs):
         '''
         Parameters:
             name: the name of the camera
+            client: the Communication of the Blender Server, or None for the
+            default one
             kwargs: Object properties
         '''
         
+        self.client=Communication.client(client)
         self._add_camera(name)
         super().__init__(**kwargs)
         self._cam_properties=PropertyDict(self.name, '',
-                                          func='camera_property')
+                                          func='camera_property',
+                                          client=self.client)
     
     def _add_camera(self, name):
-        self.name, self.name_obj=Communication.ask('create_camera',
-                                                   name=name)
+        res=self.client.ask_later('create_camera', name=name)
+        self.name, self.name_obj=res[0], res[1]
     
     @property
     def cam_properties(self):
@@ -1394,39 +3244,40 @@ class Curve(Object):
     '''Class representing a Curve
     '''
     
-    def __init__(self, points, **kwargs):
+    def __init__(self, points, client=None, **kwargs):
         '''Parameters:
             points: a list of 3D coordinates for the points of the curve
+            client: the Communication of the Blender Server, or None for the
+            default one
             kwargs: Object properties
         '''
         
-        self.name, self.name_obj=Communication.ask('create_curve',
-                                                   points=points,
-                                                   **kwargs) 
+        self.client=Communication.client(client)
+        res=self.client.ask_later('create_curve', points=points, **kwargs)
+        self.name, self.name_obj=res[0], res[1]
         super().__init__(**kwargs)
     
     @property
     def points(self):
         '''a numpy array of the points of the curve
         '''
-        return np.array(Communication.ask('get_curve_points',
-                                          name=self.name,
-                                          name_obj=self.name_obj))
+        return np.array(self.client.ask('get_curve_points',
+                                        name=self.name,
+                                        name_obj=self.name_obj),
+                        dtype=float)
     
     @points.setter
     def points(self, val):
-        if hasattr(val, 'tolist'):
-            val=val.tolist()
-        Communication.send('set_curve_points',
-                           name=self.name,
-                           points=val)
+        self.client.send('set_curve_points',
+                         name=self.name,
+                         points=np.asarray(val, dtype=float))
         
 class Light(Object):
     '''Class representing a light'''
     
     def __init__(self, name='light', color='#FFFFFF',
                  power=2, radius=0.25, light_type='POINT',
-                 filepath=None, **kwargs):
+                 filepath=None, client=None, **kwargs):
         '''Parameters:
             name: the name of the Light object
             color: color of the light. Default to white. Expect a string
@@ -1438,15 +3289,20 @@ class Light(Object):
             'AREA'
             filepath: the path to a JSON file with some properties to load in
             this light
+            client: the Communication of the Blender Server, or None for the
+            default one
         '''
+        self.client=Communication.client(client)
         self._add_light(name, light_type=light_type)
         super().__init__(**kwargs)
         self._light_properties=PropertyDict(self.name,
                                            self.name_obj,
-                                           func='light_property')
-        self.power=power
-        self.radius=radius
-        self.color=color
+                                           func='light_property',
+                                           client=self.client)
+        self._light_properties.update(dict({
+                'energy':float(power),
+                'shadow_soft_size':float(radius),
+                'color':Material.convert_color(color)[:3]}))
         if filepath is not None:
             self.load(filepath)
             self._load_light(filepath)
@@ -1458,14 +3314,11 @@ class Light(Object):
         res['args']=[]
         res['command']='create_light'
         res['kwargs']=kwargs
-        self.name, self.name_obj=Communication.ask('create_light',
-                                                   light_type=light_type)
+        res=self.client.ask_later('create_light', light_type=light_type)
+        self.name, self.name_obj=res[0], res[1]
     
     def _load_light(self, filepath):
-        with open(filepath, 'r') as f:
-            data=json.load(f)
-        for k, v in data.items():
-            self.light_properties[k]=v
+        self.light_properties.update(self._read(filepath))
     
     @property
     def power(self):
@@ -1507,7 +3360,7 @@ class Mesh(Object, GeometricEntity):
     '''Class representing a Mesh'''
     
     def __init__(self, cells=None, points=None,
-                 thickness=None, name='mesh', subdivide=1,
+                 thickness=None, name='mesh', subdivide=1, client=None,
                  **kwargs):
         '''Parameters:
             cells: a list of cells consisting in a list of integer point
@@ -1518,34 +3371,79 @@ class Mesh(Object, GeometricEntity):
             None, which means no extrusion
             name: the desired name for the Mesh
             subdivide: the number of division in the extrusion
+            client: the Communication of the Blender Server, or None for the
+            default one
             kwargs: Object properties
         '''
         
+        self.client=Communication.client(client)
         self.subdivide=subdivide
         self.thickness=thickness
         self.cells=cells
         self.points=points
-        self.name_obj, self.name_msh = self._send_mesh(thickness=self.thickness,
-                                                      name=name)
+        res=self._send_mesh(thickness=self.thickness, name=name)
+        self.name_obj, self.name_msh = res[0], res[1]
         super().__init__(**kwargs)
         
-    def _send_mesh(self, thickness=None, name='mesh'):
-        cells=[]
-        points=[[coord for coord in p] for p in self.points]
-        for celltype in self.cells:
+    @classmethod
+    def existing(cls, name_obj, name_msh, client=None):
+        '''Get a Mesh for a mesh that already exists in Blender, without
+        sending anything
+        
+        Parameters:
+            name_obj: the name of the Object
+            
+            name_msh: the name of the mesh data
+            
+            client: the Communication of the Blender Server, or None for the
+            default one
+        
+        Returns:
+            the Mesh
+        '''
+        mesh=cls.__new__(cls)
+        mesh.subdivide=1
+        mesh.thickness=None
+        mesh.cells=None
+        mesh.points=None
+        mesh.name_msh=name_msh
+        Object.__init__(mesh, name_obj=name_obj, client=client)
+        return mesh
+    
+    @staticmethod
+    def format_cells(cells):
+        '''Format cells to be sent to the server: an integer array if all
+        the cells have the same number of points, and a list of lists
+        otherwise
+        
+        Parameters:
+            cells: a list of cells consisting in a list of integer point
+            indices, or of ('triangle', array of triangles) tuples
+        
+        Returns:
+            the formatted cells
+        '''
+        res=[]
+        for celltype in cells:
             if not isinstance(celltype[0], str):
-                cells+=[[int(ind) for ind in celltype]]
+                res.append(np.asarray(celltype, dtype=np.int32))
             elif celltype[0]=='triangle':
-                cells+=[[int(ind) for ind in cell] for cell in celltype[1]]
-        return Communication.ask('create_mesh',
-                                 name=name,
-                                 thickness=thickness,
-                                 subdivide=self.subdivide,
-                                 points=points,
-                                 cells=cells) 
+                res+=list(np.asarray(celltype[1], dtype=np.int32))
+        if len(set(len(cell) for cell in res))==1:
+            return np.array(res, dtype=np.int32)
+        return [cell.tolist() for cell in res]
+    
+    def _send_mesh(self, thickness=None, name='mesh'):
+        return self.client.ask_later('create_mesh',
+                                     name=name,
+                                     thickness=thickness,
+                                     subdivide=self.subdivide,
+                                     points=np.asarray(self.points,
+                                                       dtype=float),
+                                     cells=Mesh.format_cells(self.cells))
     
     def insert_mesh_keyframe(self, frame='current',
-                             waiting_time_between_points=0.01):
+                             waiting_time_between_points=0., progress=None):
         '''
         Insert a keyframe on the position of each vertices of the mesh
         
@@ -1554,16 +3452,24 @@ class Mesh(Object, GeometricEntity):
             'current', which means the current frame. Otherwise should be an
             integer
             waiting_time_between_points: number of seconds to wait between the
-            keyframing of each point. Should be adjusted to maximise speed
-            while not crashing Blender when keyframing a large number of
-            points.
-        '''
-        Communication.ask('insert_keyframe_mesh',
-                           name_msh=self.name_msh,
-                           frame=frame,
-                           waiting_time_between_points=waiting_time_between_points)
-        
-    def cut_mesh(self, plane_points, plane_normals):
+            keyframing of each point. Default to 0, since the commands are
+            executed in the main thread of Blender
+            progress: a function called with the progress of the keyframing,
+            see Communication.ask_with_progress. If given, wait until the
+            keyframes are inserted
+        '''
+        if progress is not None:
+            self.client.ask_with_progress('insert_keyframe_mesh', progress,
+                                          name_msh=self.name_msh,
+                                          frame=frame,
+                                          waiting_time_between_points=waiting_time_between_points)
+            return
+        self.client.ask_later('insert_keyframe_mesh',
+                              name_msh=self.name_msh,
+                              frame=frame,
+                              waiting_time_between_points=waiting_time_between_points)
+        
+    def cut_mesh(self, plane_points, plane_normals, progress=None):
         '''
         Cut the mesh along a list of planes to subdivide it. 
         
@@ -1572,11 +3478,21 @@ class Mesh(Object, GeometricEntity):
             point is a 3D list of coordinates
             plane_normals: a list of 3D vectors that are normal to the plane
             cuts. Each vector is a 3D list of coordinates
-        '''
-        
-        Communication.send('cut_mesh', name_msh=self.name_msh,
-                           planes_co=plane_points,
-                           planes_no=plane_normals)
+            progress: a function called with the progress of the cut, whose
+            partial result is the number of vertices, see
+            Communication.ask_with_progress. If given, wait until the mesh
+            is cut
+        '''
+        self.client.invalidate(self._vertices_owner())
+        if progress is not None:
+            self.client.ask_with_progress('cut_mesh', progress,
+                                          name_msh=self.name_msh,
+                                          planes_co=plane_points,
+                                          planes_no=plane_normals)
+            return
+        self.client.send('cut_mesh', name_msh=self.name_msh,
+                         planes_co=plane_points,
+                         planes_no=plane_normals)
     
     def global_cut_mesh(self, N_cuts=100):
         '''
@@ -1586,16 +3502,17 @@ class Mesh(Object, GeometricEntity):
         Parameters:
             N_cuts: the number of cuts to perform
         '''
-        Communication.send('subdivide_mesh',
-                           name_obj=self.name_obj,
-                           N_cuts=N_cuts)
+        self.client.invalidate(self._vertices_owner())
+        self.client.send('subdivide_mesh',
+                         name_obj=self.name_obj,
+                         N_cuts=N_cuts)
     
     def smooth(self):
         '''
         Use the smooth option
         '''
         
-        Communication.ask('smooth', name_msh=self.name_msh)
+        self.client.ask_later('smooth', name_msh=self.name_msh)
     
     def divide(self, Nx=None, Ny=None, Nz=None, global_cut=False):
         '''Use the cut_mesh method for planes regularly spaced
@@ -1646,22 +3563,31 @@ class Mesh(Object, GeometricEntity):
 
     @property
     def parent(self):
-        '''Get the Object associated with this Mesh'''
-        return Object(self.name_obj)
+        '''Get the Object associated with this Mesh, which is the Mesh
+        itself once it is registered'''
+        return self.client.proxies.get(
+                ('OBJECT', self.name_obj),
+                lambda: Object(self.name_obj, client=self.client))
+
+    def _vertices_owner(self):
+        return ('vertices', self.name_msh)
 
     @property
     def vertices(self):
         '''Get the (local) vertices of this mesh as a numpy array'''
-        return np.array(Communication.ask('get_vertices',
-                                          name_msh=self.name_msh))
+        # np.array copies the cached vertices
+        return np.array(self.client.cached_read(
+                self._vertices_owner(), 'vertices',
+                lambda: self.client.ask('get_vertices',
+                                        name_msh=self.name_msh),
+                copy=False), dtype=float)
     
     @vertices.setter
     def vertices(self, val):
-        if hasattr(val, 'tolist'):
-            val=val.tolist()
-        Communication.send('set_vertices',
-                           name_msh=self.name_msh,
-                           val=val)
+        self.client.invalidate(self._vertices_owner())
+        self.client.send('set_vertices',
+                         name_msh=self.name_msh,
+                         val=np.asarray(val, dtype=float))
         
 
 if __name__=='__main__':
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:05:41 2026
+
+@author: Thibault
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from BlenderPy import sending_data
+from BlenderPy.sending_data import Communication
+from BlenderPy.transport import RemoteError
+
+class _Lease:
+    '''Context manager returned by ServerPool.client, counting the work
+    given to a Blender Server while it is used'''
+
+    def __init__(self, pool, key):
+        self.pool=pool
+        self.key=key
+        self.client=None
+
+    def __enter__(self):
+        self.client=self.pool.acquire(self.key)
+        return self.client
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.pool.release(self.client)
+        return False
+
+class ServerPool:
+    '''Spread independent work over several Blender Servers, for example
+    one Blender instance per scene, frame or material bake. Each work goes
+    to the healthy server with the least work in progress, and the work
+    sharing a key, like the name of a scene, always goes to the same
+    server. The objects created keep the client of their server, so they
+    stay pinned to it:
+
+        pool=ServerPool([20000, 20001, 20002])
+        def build(client, frame):
+            mesh=Mesh(cells, points, client=client)
+            ...
+            return mesh
+        meshes=pool.map(build, range(100))
+        pool.close()
+
+    The servers are checked with an echo command, at most every
+    health_interval seconds, and the ones not answering within
+    health_timeout seconds are not given any new work until they answer
+    again.
+    '''
+
+    def __init__(self, endpoints, host=None, health_interval=5.,
+                 health_timeout=1., workers=None):
+        '''
+        Parameters:
+            endpoints: the Blender Servers, as a list of ports, of
+            (host, port) tuples, or of Communication clients
+
+            host: the address of the servers given by their port. Default
+            to the HOST of sending_data
+
+            health_interval: the time in seconds after which the servers
+            are checked again before giving them work
+
+            health_timeout: the time in seconds given to a server to answer
+            the health check
+
+            workers: the number of threads of submit and map. Default to
+            two per server
+        '''
+        host=sending_data.HOST if host is None else host
+        self.clients=[]
+        for endpoint in endpoints:
+            if isinstance(endpoint, Communication):
+                self.clients.append(endpoint)
+            elif isinstance(endpoint, tuple):
+                self.clients.append(Communication(*endpoint))
+            else:
+                self.clients.append(Communication(host, endpoint))
+        if not self.clients:
+            raise ValueError('a ServerPool needs at least one server')
+        self.health_interval=health_interval
+        self.health_timeout=health_timeout
+        self._lock=threading.Lock()
+        self._health_lock=threading.Lock()
+        # the work in progress, the work given since the start, and the
+        # health of each client, by index
+        self._load=[0]*len(self.clients)
+        self._given=[0]*len(self.clients)
+        self._healthy=[True]*len(self.clients)
+        self._checked=None
+        self._pins=dict()
+        self._executor=ThreadPoolExecutor(workers or 2*len(self.clients))
+
+    def _index(self, client):
+        for i, other in enumerate(self.clients):
+            if other is client:
+                return i
+        raise ValueError('the client is not in this ServerPool')
+
+    def check_health(self):
+        '''Check that every server answers an echo command
+
+        Return:
+            the list of the servers answering, as (host, port, path) tuples
+        '''
+        healthy=[]
+        for client in self.clients:
+            try:
+                with client.deadline(self.health_timeout):
+                    client.ask('echo')
+                healthy.append(True)
+            except RemoteError:
+                # an add-on without echo, which answers anyway
+                healthy.append(True)
+            except OSError:
+                # the CommandTimeout and ConnectionError of a server down
+                healthy.append(False)
+        with self._lock:
+            self._healthy=healthy
+            self._checked=time.monotonic()
+        return [client.endpoint for client, alive in zip(self.clients,
+                                                         healthy) if alive]
+
+    def _is_stale(self):
+        return (self._checked is None
+                or time.monotonic()-self._checked>self.health_interval)
+
+    def _check_if_needed(self):
+        if self._is_stale():
+            # the other threads wait for the same check
+            with self._health_lock:
+                if self._is_stale():
+                    self.check_health()
+
+    def acquire(self, key=None):
+        '''Choose a server for a work, which must be given back with
+        release. Prefer the client context manager
+
+        Parameters:
+            key: the key of the work, or None. The work with the same key
+            always goes to the same server
+
+        Return:
+            the Communication of the server
+        '''
+        self._check_if_needed()
+        with self._lock:
+            if key is not None and key in self._pins:
+                i=self._pins[key]
+                if not self._healthy[i]:
+                    raise ConnectionError('the Blender Server {:} holding '
+                                          '{:} does not answer'.format(
+                                                  self.clients[i].endpoint,
+                                                  key))
+            else:
+                candidates=[i for i, alive in enumerate(self._healthy)
+                            if alive]
+                if not candidates:
+                    raise ConnectionError('none of the Blender Servers of '
+                                          'the ServerPool answers')
+                # the least loaded, then the one given the least work, so
+                # that idle servers take turns
+                i=min(candidates,
+                      key=lambda i: (self._load[i], self._given[i]))
+                if key is not None:
+                    self._pins[key]=i
+            self._load[i]+=1
+            self._given[i]+=1
+            return self.clients[i]
+
+    def release(self, client):
+        '''Give back a client returned by acquire, once its work is done'''
+        with self._lock:
+            self._load[self._index(client)]-=1
+
+    def client(self, key=None):
+        '''Choose a server for a work, while in the context manager:
+
+            with pool.client('scene 1') as client:
+                Scene(frame_end=100, client=client)
+
+        Parameters:
+            key: the key of the work, or None. The work with the same key
+            always goes to the same server
+
+        Return:
+            the context manager, giving the Communication of the server
+        '''
+        return _Lease(self, key)
+
+    def pin(self, key, client):
+        '''Send the work with a key to a server
+
+        Parameters:
+            key: the key of the work
+
+            client: the Communication of the server, or an object created
+            by it, like a Mesh
+        '''
+        if not isinstance(client, Communication):
+            client=client.client
+        with self._lock:
+            self._pins[key]=self._index(client)
+
+    def owner(self, key):
+        '''the Communication of the server of a key, or of an object, or
+        None if it has not been given to a server yet'''
+        client=getattr(key, 'client', None)
+        if isinstance(client, Communication):
+            return client
+        with self._lock:
+            i=self._pins.get(key)
+        return None if i is None else self.clients[i]
+
+    def _run(self, function, key, args, kwargs):
+        with self.client(key) as client:
+            return function(client, *args, **kwargs)
+
+    def submit(self, function, *args, key=None, **kwargs):
+        '''Call a function in a thread with the client of a server, as its
+        first argument
+
+        Parameters:
+            function: the function, called as function(client, *args,
+            **kwargs)
+
+            key: the key of the work, or None
+
+        Return:
+            the concurrent.futures.Future of its result
+        '''
+        return self._executor.submit(self._run, function, key, args, kwargs)
+
+    def map(self, function, items, key=None):
+        '''Call a function for every item in threads, with the client of
+        a server as its first argument, and wait for the results
+
+        Parameters:
+            function: the function, called as function(client, item)
+
+            items: the items
+
+            key: a function giving the key of an item, or None to give the
+            items to any server
+
+        Return:
+            the list of the results, in the order of items
+        '''
+        futures=[self.submit(function, item,
+                             key=None if key is None else key(item))
+                 for item in items]
+        return [future.result() for future in futures]
+
+    def load(self):
+        '''the work in progress of each server, by (host, port, path)'''
+        with self._lock:
+            return dict({client.endpoint:load
+                         for client, load in zip(self.clients, self._load)})
+
+    def flush(self):
+        '''Wait until every server has executed the commands sent, and
+        raise the first error'''
+        for client in self.clients:
+            client.flush()
+
+    def close(self):
+        '''Wait for the work submitted, and close the connections'''
+        self._executor.shutdown(wait=True)
+        for client in self.clients:
+            client.close()
@@ -0,0 +1,1160 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:03 2026
+
+@author: Thibault
+"""
+
+# The messages, their frames and their constants are shared with
+# Blender_addon/transport.py, which cannot import this package inside
+# Blender: the two copies must stay byte-compatible and change together,
+# which check_addon_transport verifies.
+
+import time
+import socket
+import select
+import threading
+import os
+import json
+import zlib
+import importlib.util
+import numpy as np
+try:
+    import lz4.frame
+except ImportError:
+    lz4=None
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory=None
+try:
+    import msgpack
+except ImportError:
+    msgpack=None
+try:
+    import orjson
+except ImportError:
+    orjson=None
+
+ARRAY_FRAME=b'A'
+# maximum number of requests sent without waiting for their reply on a
+# connection
+WINDOW=64
+# the priorities of the commands: the server executes the commands with a
+# lower priority first, and the commands with the same priority in the
+# order they were received
+INTERACTIVE=0
+NORMAL=1
+BULK=2
+# maximum time, in seconds, to open a connection to the Blender Server
+CONNECT_TIMEOUT=10.
+# version of the protocol, exchanged with the hello command. The add-ons
+# answering hello without a version speak the version 1, and the older
+# ones the version 0, with json messages only
+PROTOCOL_VERSION=2
+# what BlenderPy can do beyond the messages of the version 0
+CAPABILITIES=['binary_arrays', 'compression', 'batch', 'shared_memory',
+              'pipelining', 'priority', 'cancel', 'progress', 'properties',
+              'subscribe', 'rename']
+# the capabilities of the add-ons of the version 1
+HELLO_CAPABILITIES=['binary_arrays', 'compression', 'batch', 'shared_memory',
+                    'pipelining']
+
+def _orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # NaN and Infinity, written by the json module, are not valid json
+        return json.loads(bytes(data))
+
+# the codecs writing the structure of the messages: the letter starting
+# the encoded messages, the function encoding a structure into bytes, and
+# the function decoding it. They are listed from the preferred one, and the
+# client chooses one with the hello command. orjson writes the same json as
+# the json module, faster
+CODEC_FRAME=b'M'
+CODECS=dict()
+if msgpack is not None:
+    CODECS['msgpack']=(CODEC_FRAME,
+                       lambda value: msgpack.packb(value, use_bin_type=True),
+                       lambda data: msgpack.unpackb(data, raw=False,
+                                                    strict_map_key=False))
+if orjson is not None:
+    CODECS['orjson']=(b'',
+                      lambda value: orjson.dumps(
+                              value, option=orjson.OPT_NON_STR_KEYS),
+                      _orjson_loads)
+CODECS['json']=(b'', lambda value: json.dumps(value).encode(),
+                lambda data: json.loads(bytes(data)))
+# the codec decoding the messages written in json
+JSON_CODEC='orjson' if orjson is not None else 'json'
+
+def codec_of(data):
+    '''the name of the codec in which encoded bytes are written'''
+    if data[:1]==CODEC_FRAME and 'msgpack' in CODECS:
+        return 'msgpack'
+    return JSON_CODEC
+
+# messages smaller than this, in bytes, are never compressed
+COMPRESSION_THRESHOLD=1<<16
+# size of the sample compressed first, and the ratio it must reach for the
+# whole message to be compressed
+COMPRESSION_SAMPLE=1<<14
+COMPRESSION_RATIO=0.9
+# the available compression methods, from the preferred one: the letter
+# starting the compressed data, the compressor and the decompressor
+COMPRESSIONS=dict()
+if lz4 is not None:
+    COMPRESSIONS['lz4']=(b'L', lz4.frame.compress, lz4.frame.decompress)
+COMPRESSIONS['zlib']=(b'Z', lambda data: zlib.compress(data, 1),
+                      zlib.decompress)
+
+def compress(data, method, threshold=COMPRESSION_THRESHOLD):
+    '''Compress encoded bytes with method if they are larger than
+    threshold and a sample of them compresses well. The compressed data
+    starts with a letter telling the method, and is only used if it is
+    smaller than the original data.
+
+    Parameters:
+        data: the encoded bytes
+
+        method: a key of COMPRESSIONS, or None for no compression
+
+        threshold: the minimum size to compress
+
+    Return:
+        the bytes to send
+    '''
+    if method is None or len(data)<threshold:
+        return data
+    flag, compressor, _=COMPRESSIONS[method]
+    # random floats hardly compress: a sample tells whether it is worth
+    # compressing everything
+    sample=memoryview(data)[len(data)//2:len(data)//2+COMPRESSION_SAMPLE]
+    if len(compressor(sample))>COMPRESSION_RATIO*len(sample):
+        return data
+    compressed=flag+compressor(data)
+    if len(compressed)<len(data):
+        return compressed
+    return data
+
+def decompress(data):
+    '''Undo compress, if the data was compressed'''
+    for flag, _, decompressor in COMPRESSIONS.values():
+        if data[:1]==flag:
+            return decompressor(memoryview(data)[1:])
+    return data
+
+class TransferStats:
+    '''Counters of the bytes sent and received, before compression (raw)
+    and as they went through the socket (wire)'''
+
+    def __init__(self):
+        self._lock=threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.sent_raw=0
+            self.sent_wire=0
+            self.received_raw=0
+            self.received_wire=0
+
+    def add_sent(self, raw, wire):
+        with self._lock:
+            self.sent_raw+=raw
+            self.sent_wire+=wire
+
+    def add_received(self, raw, wire):
+        with self._lock:
+            self.received_raw+=raw
+            self.received_wire+=wire
+
+    def to_dict(self):
+        with self._lock:
+            return dict({'sent_raw':self.sent_raw,
+                         'sent_wire':self.sent_wire,
+                         'received_raw':self.received_raw,
+                         'received_wire':self.received_wire})
+
+# arrays larger than this, in bytes, go through shared memory when it is
+# used instead of the socket
+SHARED_MEMORY_THRESHOLD=1<<20
+
+def _attach_shared_memory(name):
+    # the process creating a block is the one unlinking it, so the
+    # resource tracker of this process must not unlink it at exit
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        block=shared_memory.SharedMemory(name=name)
+        if os.name=='posix':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+def _share_array(array, shared):
+    block=shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared.append(block)
+    view=np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    view[...]=array
+    del view
+    return dict({'__shared__':block.name, 'dtype':array.dtype.str,
+                 'shape':list(array.shape)})
+
+def _map_shared_array(descriptor, shared):
+    block=_attach_shared_memory(descriptor['__shared__'])
+    array=np.ndarray(descriptor['shape'], dtype=np.dtype(descriptor['dtype']),
+                     buffer=block.buf)
+    if shared is not None:
+        shared.append(block)
+        return array
+    copy=array.copy()
+    del array
+    block.close()
+    return copy
+
+def release_shared_memory(blocks, unlink=True):
+    '''Close SharedMemory blocks used by encode_message or decode_message
+
+    Parameters:
+        blocks: the list of the blocks, emptied by this function
+
+        unlink: whether the blocks should be destroyed, which is done by
+        the process that created them
+    '''
+    while blocks:
+        block=blocks.pop()
+        try:
+            block.close()
+        except BufferError:
+            # an array still uses the block, which is closed when the
+            # array is garbage collected
+            pass
+        if unlink:
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+
+def _extract_arrays(value, arrays, binary, shared=None):
+    if isinstance(value, np.ndarray):
+        if (shared is not None and value.dtype.kind in 'biuf'
+            and value.nbytes>=SHARED_MEMORY_THRESHOLD):
+            return _share_array(value, shared)
+        if binary and value.dtype.kind in 'biuf':
+            arrays.append(value)
+            return dict({'__array__':len(arrays)-1})
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, dict):
+        return dict({k:_extract_arrays(v, arrays, binary, shared)
+                     for k,v in value.items()})
+    elif isinstance(value, (list, tuple)):
+        return [_extract_arrays(v, arrays, binary, shared) for v in value]
+    elif hasattr(value, 'to_message'):
+        return _extract_arrays(value.to_message(), arrays, binary,
+                               shared)
+    return value
+
+def _restore_arrays(value, arrays, shared=None):
+    if isinstance(value, dict):
+        if len(value)==1 and '__array__' in value:
+            return arrays[value['__array__']]
+        if len(value)==3 and '__shared__' in value:
+            return _map_shared_array(value, shared)
+        return dict({k:_restore_arrays(v, arrays, shared)
+                     for k,v in value.items()})
+    elif isinstance(value, list):
+        return [_restore_arrays(v, arrays, shared) for v in value]
+    return value
+
+def encode_message(message, binary=True, shared=None, codec='json'):
+    '''Encode a message. If it contains numpy arrays and binary is True,
+    an array frame is built: the letter A, the length of a header written
+    with 10 hexadecimal digits, the header, and then the raw little-endian
+    bytes of the arrays. Otherwise, the message is only the encoded
+    structure. With a codec other than json, the letter of the codec comes
+    first.
+
+    Parameters:
+        message: a json-compatible dictionary, possibly containing numpy
+        arrays, or objects with a to_message method returning what should
+        be sent in their place
+
+        binary: if False, the arrays are converted to lists
+
+        shared: a list receiving new SharedMemory blocks, in which the
+        arrays larger than SHARED_MEMORY_THRESHOLD are copied instead of
+        being sent. The blocks must be kept until the message is decoded,
+        and then released with release_shared_memory. If None, everything
+        is sent through the socket
+
+        codec: the name of the codec, in CODECS, encoding the structure of
+        the message and the header of the array frame
+
+    Return:
+        the encoded bytes
+    '''
+    marker, dumps, _=CODECS[codec]
+    arrays=[]
+    content=_extract_arrays(message, arrays, binary, shared)
+    if len(arrays)==0:
+        return marker+dumps(content)
+    descriptors, buffers, offset=[], [], 0
+    for array in arrays:
+        array=np.ascontiguousarray(array,
+                                   dtype=array.dtype.newbyteorder('<'))
+        descriptors.append(dict({'dtype':array.dtype.str,
+                                 'shape':list(array.shape),
+                                 'offset':offset}))
+        # a flat byte view, so that the bytes are only copied by join
+        buffers.append(array.reshape(-1).view(np.uint8))
+        offset+=array.nbytes
+    header=dumps(dict({'message':content, 'arrays':descriptors}))
+    return b''.join([marker, ARRAY_FRAME,
+                     '{:010x}'.format(len(header)).encode(), header]+buffers)
+
+def decode_message(data, shared=None):
+    '''Decode a message encoded with encode_message. The arrays of an array
+    frame are numpy views on the received data, without any copy.
+
+    Parameters:
+        data: the received bytes
+
+        shared: a list receiving the SharedMemory blocks of the arrays sent
+        through shared memory. The arrays are then views on the blocks,
+        which must be released with release_shared_memory(shared,
+        unlink=False) once the arrays are not needed. If None, the arrays
+        are copied and the blocks closed right away
+
+    Return:
+        the decoded message
+    '''
+    codec=codec_of(data)
+    marker, _, loads=CODECS[codec]
+    body=memoryview(data)[len(marker):]
+    if body[:1]!=ARRAY_FRAME:
+        message=loads(body)
+        if b'__shared__' in data:
+            message=_restore_arrays(message, [], shared)
+        return message
+    header_length=int(bytes(body[1:11]).decode(), 16)
+    header=loads(body[11:11+header_length])
+    blob=body[11+header_length:]
+    arrays=[]
+    for descriptor in header['arrays']:
+        dtype=np.dtype(descriptor['dtype'])
+        shape=descriptor['shape']
+        count=int(np.prod(shape))
+        arrays.append(np.frombuffer(blob, dtype=dtype, count=count,
+                                    offset=descriptor['offset'])\
+                      .reshape(shape))
+    return _restore_arrays(header['message'], arrays, shared)
+
+# a command known by the add-ons older than hello, harmless to execute
+PROBE_COMMAND='get_material_names'
+
+def hello_message(probe=None):
+    '''Encode the hello command, starting the handshake with the server
+
+    Parameters:
+        probe: a block made by shared_memory_probe, that the server reads
+        back if it can access the shared memory of this process, or None
+
+    Return:
+        the encoded bytes
+    '''
+    kwargs=dict({'codecs':list(CODECS), 'version':PROTOCOL_VERSION,
+                 'capabilities':CAPABILITIES,
+                 'compressions':list(COMPRESSIONS)})
+    if probe is not None:
+        kwargs['shared_memory_probe']=probe.name
+    return encode_message(dict({'command':'hello', 'id':0,
+                                'kwargs':kwargs}))
+
+def probe_message():
+    '''Encode the command sent before hello, which every add-on knows. The
+    add-ons older than the request IDs answer it without the ID, and stop
+    serving on a command they do not know, like hello
+
+    Return:
+        the encoded bytes
+    '''
+    return encode_message(dict({'command':PROBE_COMMAND, 'id':0,
+                                'kwargs':dict()}))
+
+def knows_hello(reply):
+    '''Whether the server answering probe_message can be sent hello, or is
+    older than the request IDs'''
+    return 'id' in reply
+
+def shared_memory_probe():
+    '''Create a small SharedMemory block holding random bytes, to check
+    that the server shares the memory of this machine. It must be released
+    with release_shared_memory
+
+    Return:
+        the block, or None if shared memory is not available
+    '''
+    if shared_memory is None:
+        return None
+    block=shared_memory.SharedMemory(create=True, size=16)
+    block.buf[:16]=os.urandom(16)
+    return block
+
+def server_info(content=None, probe=None):
+    '''What the server can do, from its answer to hello
+
+    Parameters:
+        content: the answer to hello, or None if the server does not know
+        the hello command
+
+        probe: the block given to hello_message, or None
+
+    Return:
+        a dictionary with the protocol version of the server, the codec
+        of the messages, the capabilities of the server, its compression
+        methods, and whether it can read the shared memory of this process
+    '''
+    if content is None:
+        return dict({'version':0, 'codec':'json', 'capabilities':[],
+                     'compressions':[], 'shared_memory':False})
+    info=dict({'version':content.get('version', 1),
+               'codec':content['codec'],
+               'capabilities':content.get('capabilities',
+                                          HELLO_CAPABILITIES),
+               # every add-on able to decompress knows zlib
+               'compressions':content.get('compressions', ['zlib']),
+               'shared_memory':False})
+    if probe is not None and 'shared_memory' in info['capabilities']:
+        info['shared_memory']=(content.get('shared_memory_probe')
+                               ==bytes(probe.buf[:16]).hex())
+    return info
+
+def _send_buffers(sock, buffers):
+    # send several buffers without joining them, with a single system call
+    # when possible
+    if not hasattr(sock, 'sendmsg'):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+    views=[memoryview(buffer).cast('B') for buffer in buffers]
+    while views:
+        sent=sock.sendmsg(views)
+        while views and sent>=len(views[0]):
+            sent-=len(views[0])
+            views.pop(0)
+        if sent:
+            views[0]=views[0][sent:]
+
+class RemoteError(RuntimeError):
+    '''An error raised by the Blender Server while executing a command'''
+
+    def __init__(self, command, message, remote_traceback=None):
+        '''
+        Parameters:
+            command: the name of the command
+
+            message: the error, as written by the server
+
+            remote_traceback: the traceback of the error in Blender
+        '''
+        super().__init__('{:} failed in Blender: {:}'.format(command,
+                                                              message))
+        self.command=command
+        self.message=message
+        self.remote_traceback=remote_traceback
+        self.others=[]
+
+class CommandTimeout(TimeoutError):
+    '''Raised when the Blender Server does not answer a command before its
+    deadline'''
+
+    def __init__(self, command, timeout=None):
+        '''
+        Parameters:
+            command: the name of the command
+
+            timeout: the time given to the command, in seconds
+        '''
+        if timeout is None:
+            message='{:} was not answered before its deadline'
+        else:
+            message='{:} was not answered within {:.3g} s'
+        super().__init__(message.format(command, timeout))
+        self.command=command
+        self.timeout=timeout
+
+class Connection:
+    '''A persistent connection to the Blender Server. Messages are framed
+    with their length written as 10 hexadecimal digits at the beginning.
+    The connection goes through a unix domain socket if path is given, and
+    through TCP otherwise'''
+
+    def __init__(self, host, port, path=None, connect_timeout=CONNECT_TIMEOUT):
+        '''
+        Parameters:
+            host: the address of the Blender Server
+
+            port: the port of the Blender Server
+
+            path: the path of the unix domain socket of the Blender Server,
+            when it runs on the same machine
+
+            connect_timeout: the maximum time to open the connection, in
+            seconds, or None to wait as long as the system does
+        '''
+        self.host=host
+        self.port=port
+        self.path=path
+        self.connect_timeout=connect_timeout
+        self.sock=None
+        # the time.monotonic() after which sending and receiving raise
+        # socket.timeout, or None to block as long as needed
+        self.deadline=None
+        # the commands of the requests sent on this connection whose reply
+        # has not been read yet, by request ID
+        self.pending=dict()
+        # the functions receiving the progress of the requests, by request
+        # ID
+        self.progress=dict()
+        # a request can be cancelled by another thread while the connection
+        # is in use, so the frames are written one at a time
+        self._write_lock=threading.Lock()
+
+    def connect(self):
+        '''Open the socket if it is not already open. Raise a
+        ConnectionError if the server does not accept the connection within
+        connect_timeout'''
+        if self.sock is None:
+            try:
+                if self.path is not None:
+                    sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.settimeout(self.connect_timeout)
+                    try:
+                        sock.connect(self.path)
+                    except OSError:
+                        sock.close()
+                        raise
+                else:
+                    sock=socket.create_connection((self.host, self.port),
+                                                  timeout=self.connect_timeout)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (socket.timeout, BlockingIOError):
+                # a unix domain socket whose queue of connections is full
+                # fails right away instead of waiting
+                raise ConnectionError('the Blender Server at {:} did not '
+                                      'accept the connection within {:} s'\
+                                      .format(self.path or '{:}:{:}'.format(
+                                              self.host, self.port),
+                                              self.connect_timeout)) from None
+            sock.settimeout(None)
+            self.sock=sock
+
+    def close(self):
+        '''Close the socket. The connection can be reopened with connect'''
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock=None
+
+    def shutdown(self):
+        '''Make the reads blocked in another thread return, before closing
+        the connection'''
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _set_timeout(self):
+        # make the next socket operation raise socket.timeout at the
+        # deadline
+        if self.deadline is None:
+            if self.sock.gettimeout() is not None:
+                self.sock.settimeout(None)
+            return
+        remaining=self.deadline-time.monotonic()
+        if remaining<=0:
+            raise socket.timeout('timed out')
+        self.sock.settimeout(remaining)
+
+    def readable(self):
+        '''Check, without blocking, whether data or the closing of the
+        connection by the server are waiting to be read'''
+        try:
+            readable, _, _=select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return len(readable)>0
+
+    def is_alive(self):
+        '''Check, without blocking, that an idle connection whose replies
+        have all been read has not been closed by the server and does not
+        hold unread data
+
+        Return:
+            True if the connection can be reused
+        '''
+        if self.sock is None:
+            return False
+        # such a connection should never be readable: either the server
+        # closed it, or an unexpected answer is waiting in the buffer
+        return not self.readable()
+
+    def send_frame(self, data):
+        '''Send a message with its length at the beginning. The length and
+        the message are sent as separate buffers, without copying the
+        message
+
+        Parameters:
+            data: the encoded bytes to send
+        '''
+        with self._write_lock:
+            self._set_timeout()
+            _send_buffers(self.sock, ['{:010x}'.format(len(data)).encode(),
+                                      data])
+
+    def receive_frame(self):
+        '''Receive a full message sent by the server
+
+        Return:
+            the raw data, or None if the server closed the connection
+        '''
+        raw_msglen=self.receive_all(10)
+        if raw_msglen is None:
+            return None
+        return self.receive_all(int(raw_msglen.decode(), 16))
+
+    def receive_all(self, n):
+        '''Receive packets until the amount of data is equal to n. The
+        packets are received directly in a buffer of size n
+
+        Parameters:
+            n: expected length of the data
+
+        Return:
+            data: the raw data, or None if the connection was closed
+        '''
+        data=bytearray(n)
+        view=memoryview(data)
+        received=0
+        while received<n:
+            self._set_timeout()
+            packet_size=self.sock.recv_into(view[received:])
+            if packet_size==0:
+                return None
+            received+=packet_size
+        return data
+
+class ConnectionPool:
+    '''A pool of persistent connections to the same Blender Server.
+    Connections are opened on demand, up to size, and kept open between
+    calls.
+
+    Each request carries an ID, and the server replies to every request.
+    The requests which do not need their answer are pipelined: they go
+    back to the pool without waiting, and their replies are read later,
+    when the connection is used again. At most window of them are waiting
+    for their reply on a connection. Their errors are kept until
+    check_errors or flush raises them.'''
+
+    def __init__(self, host, port, size=4, path=None, window=WINDOW,
+                 decode=decode_message, connect_timeout=CONNECT_TIMEOUT):
+        '''
+        Parameters:
+            host: the address of the Blender Server
+
+            port: the port of the Blender Server
+
+            size: the maximum number of simultaneously open connections
+
+            path: the path of the unix domain socket of the Blender Server,
+            to use instead of TCP
+
+            window: the maximum number of requests waiting for their reply
+            on a connection
+
+            decode: the function decoding the raw replies
+
+            connect_timeout: the maximum time to open a connection, in
+            seconds
+        '''
+        self.host=host
+        self.port=port
+        self.size=size
+        self.path=path
+        self.window=window
+        self.decode=decode
+        self.connect_timeout=connect_timeout
+        # what the server can do, known after the hello command
+        self.info=None
+        self._idle=[]
+        # all the open connections, idle or in use
+        self._open=set()
+        self._n_open=0
+        self._condition=threading.Condition()
+        self._errors=[]
+        self._errors_lock=threading.Lock()
+        self.n_connects=0
+        self.n_reconnects=0
+
+    def acquire(self, deadline=None):
+        '''Take a connection from the pool, opening a new one if none is
+        idle. Block if size connections are already in use.
+
+        Parameters:
+            deadline: the time.monotonic() after which waiting for a
+            connection raises socket.timeout, or None
+
+        Return:
+            (connection, reused): the connection, and whether it was already
+            open before this call
+        '''
+        while True:
+            with self._condition:
+                while not self._idle and self._n_open>=self.size:
+                    if deadline is None:
+                        self._condition.wait()
+                    elif not self._condition.wait(deadline-time.monotonic()):
+                        raise socket.timeout('no connection available')
+                if not self._idle:
+                    self._n_open+=1
+                    break
+                conn=self._idle.pop()
+            if self._poll(conn):
+                return conn, True
+            self.discard(conn)
+        conn=Connection(self.host, self.port, self.path, self.connect_timeout)
+        try:
+            conn.connect()
+        except OSError:
+            self._forget()
+            raise
+        with self._condition:
+            self._open.add(conn)
+        self.n_connects+=1
+        return conn, False
+
+    def _poll(self, conn):
+        # read the replies already received on an idle connection, and
+        # check that it is still usable
+        try:
+            while conn.pending and conn.readable():
+                self._read_reply(conn)
+        except OSError:
+            return False
+        return len(conn.pending)>0 or conn.is_alive()
+
+    def release(self, conn):
+        '''Give back a healthy connection to the pool'''
+        conn.deadline=None
+        with self._condition:
+            self._idle.append(conn)
+            self._condition.notify()
+
+    def discard(self, conn):
+        '''Close a broken connection and remove it from the pool'''
+        if conn.pending:
+            self._add_error(ConnectionError(
+                    'the Blender Server closed the connection before '
+                    'answering to {:}'.format(', '.join(
+                            str(command) for command in conn.pending.values()))))
+            conn.pending.clear()
+        conn.close()
+        with self._condition:
+            self._open.discard(conn)
+        self._forget()
+
+    def _forget(self):
+        with self._condition:
+            self._n_open-=1
+            self._condition.notify()
+
+    def _add_error(self, error):
+        with self._errors_lock:
+            self._errors.append(error)
+
+    def _read_reply(self, conn, request_id=None):
+        # read the next reply on a connection. The errors of the requests
+        # other than request_id are kept for check_errors
+        data=conn.receive_frame()
+        if data is None:
+            raise ConnectionError('the Blender Server closed the connection')
+        reply=self.decode(data)
+        if 'progress' in reply:
+            # the reply is still to come
+            callback=conn.progress.get(reply.get('id'))
+            if callback is not None:
+                callback(dict(reply['progress'], id=reply['id']))
+            return reply
+        conn.progress.pop(reply.get('id'), None)
+        command=conn.pending.pop(reply.get('id'), None)
+        if 'error' in reply and reply.get('id')!=request_id:
+            self._add_error(RemoteError(command, reply['error'],
+                                        reply.get('traceback')))
+        return reply
+
+    def exchange(self, message, request_id, command=None, answer=True,
+                 deadline=None, progress=None):
+        '''Send a message on a pooled connection, and wait for its reply
+        if needed. If a reused connection turns out to have been closed by
+        the server, the message is sent again on a fresh connection.
+
+        Parameters:
+            message: the encoded bytes to send
+
+            request_id: the ID of the request, written in the message
+
+            command: the name of the command, for the error messages
+
+            answer: whether to wait for the reply. If False, the reply is
+            read later
+
+            deadline: the time.monotonic() after which a CommandTimeout is
+            raised, or None to wait as long as needed. The command is then
+            cancelled, and the connection closed
+
+            progress: a function called with the progress messages of the
+            request, as dictionaries with the request ID, if the message
+            asks for them. If it raises an exception, the command is
+            cancelled and the exception raised
+
+        Return:
+            the decoded reply, or None if answer is False
+        '''
+        timeout=None if deadline is None else deadline-time.monotonic()
+        try:
+            conn, reused=self.acquire(deadline)
+        except socket.timeout:
+            raise CommandTimeout(command, timeout) from None
+        conn.deadline=deadline
+        try:
+            conn.send_frame(message)
+        except socket.timeout:
+            # the server may have received a part of the message
+            self.discard(conn)
+            raise CommandTimeout(command, timeout) from None
+        except OSError:
+            self.discard(conn)
+            if not reused:
+                raise
+            self.n_reconnects+=1
+            conn, _=self.acquire(deadline)
+            conn.deadline=deadline
+            try:
+                conn.send_frame(message)
+            except socket.timeout:
+                self.discard(conn)
+                raise CommandTimeout(command, timeout) from None
+            except BaseException:
+                self.discard(conn)
+                raise
+        except BaseException:
+            self.discard(conn)
+            raise
+        # the servers of the version 0 do not reply to commands without
+        # answer, nor give request IDs
+        if answer or request_id is not None:
+            conn.pending[request_id]=command
+        if progress is not None:
+            conn.progress[request_id]=progress
+        reply=None
+        try:
+            if answer:
+                # the replies are matched with the requests by their IDs
+                while (reply is None or reply.get('id')!=request_id
+                       or 'progress' in reply):
+                    reply=self._read_reply(conn, request_id)
+            else:
+                while len(conn.pending)>self.window:
+                    self._read_reply(conn)
+        except BaseException as error:
+            # a reply may be partly read, so the connection cannot be used
+            # anymore, and the server stops working on the request
+            conn.pending.pop(request_id, None)
+            conn.progress.pop(request_id, None)
+            conn.deadline=time.monotonic()+1.
+            self._send_cancel(conn, [request_id])
+            self.discard(conn)
+            if isinstance(error, socket.timeout):
+                raise CommandTimeout(command, timeout) from None
+            raise
+        self.release(conn)
+        if reply is not None and 'error' in reply:
+            raise RemoteError(command, reply['error'], reply.get('traceback'))
+        return reply
+
+    @property
+    def is_local(self):
+        '''Whether the server runs on the same machine'''
+        return (self.path is not None
+                or self.host in ('localhost', '::1')
+                or str(self.host).startswith('127.'))
+
+    def hello(self, deadline=None):
+        '''Exchange the protocol version and the capabilities with the
+        server with the hello command, the first time it is called. On
+        the same machine, the server also checks that it can read the
+        shared memory of this process
+
+        Parameters:
+            deadline: the time.monotonic() after which a CommandTimeout is
+            raised, or None
+
+        Return:
+            the dictionary of server_info
+        '''
+        if self.info is None:
+            # a server that cannot be reached raises here, so that it is not
+            # taken for a server older than the hello command
+            try:
+                conn, _=self.acquire(deadline)
+            except socket.timeout:
+                raise CommandTimeout('hello') from None
+            conn.deadline=deadline
+            try:
+                conn.send_frame(probe_message())
+                data=conn.receive_frame()
+                if data is None:
+                    raise ConnectionError('the Blender Server closed the '
+                                          'connection')
+                reply=self.decode(data)
+            except socket.timeout:
+                self.discard(conn)
+                raise CommandTimeout('hello') from None
+            except BaseException:
+                self.discard(conn)
+                raise
+            self.release(conn)
+            if not knows_hello(reply):
+                # the server would stop serving on hello
+                self.info=server_info()
+                return self.info
+            probe=shared_memory_probe() if self.is_local else None
+            try:
+                reply=self.exchange(hello_message(probe), 0, 'hello',
+                                    deadline=deadline)
+                self.info=server_info(reply['content'], probe)
+            except RemoteError:
+                # a server older than the hello command, while a lost
+                # connection is raised and the handshake done again
+                self.info=server_info()
+            finally:
+                release_shared_memory([probe] if probe is not None else [])
+        return self.info
+
+    def negotiate(self, deadline=None):
+        '''The codec of the messages agreed with the server by hello
+
+        Parameters:
+            deadline: the time.monotonic() after which a CommandTimeout is
+            raised, or None
+
+        Return:
+            the name of the codec, in CODECS
+        '''
+        return self.hello(deadline)['codec']
+
+    def cancel(self, request_id=None):
+        '''Ask the server to cancel a request waiting for its reply, which
+        is then an error. The cancel message is sent on the connection of
+        the request, even if another thread is waiting for the reply on it.
+        A command is cancelled while it waits to be executed, or at the
+        next check of a long command, and its reply is an error
+
+        Parameters:
+            request_id: the ID of the request, or None to cancel all the
+            requests waiting for their reply
+
+        Return:
+            the number of requests whose cancellation was sent
+        '''
+        with self._condition:
+            conns=list(self._open)
+        n_cancelled=0
+        for conn in conns:
+            request_ids=[i for i in list(conn.pending)
+                         if request_id is None or i==request_id]
+            if request_ids and self._send_cancel(conn, request_ids):
+                n_cancelled+=len(request_ids)
+        return n_cancelled
+
+    def _send_cancel(self, conn, request_ids):
+        # send a cancel message. The deadline of the connection is left
+        # unchanged, as another thread may be waiting for a reply on it
+        if (conn.sock is None or self.info is None
+            or 'cancel' not in self.info['capabilities']):
+            return False
+        message=encode_message(dict({'command':'cancel',
+                                     'kwargs':dict({'request_ids':
+                                                    request_ids})}))
+        try:
+            conn.send_frame(message)
+        except OSError:
+            return False
+        return True
+
+    def check_errors(self):
+        '''Raise the first error of the requests sent without waiting for
+        their reply, if any. The following errors are in its others
+        attribute'''
+        with self._errors_lock:
+            errors, self._errors=self._errors, []
+        if errors:
+            errors[0].others=errors[1:]
+            raise errors[0]
+
+    def flush(self, deadline=None):
+        '''Wait for the replies to all the requests sent on the idle
+        connections, and raise their errors
+
+        Parameters:
+            deadline: the time.monotonic() after which a CommandTimeout is
+            raised, or None to wait as long as needed
+        '''
+        with self._condition:
+            conns, self._idle=self._idle, []
+        timed_out=[]
+        for conn in conns:
+            conn.deadline=deadline
+            try:
+                while conn.pending:
+                    self._read_reply(conn)
+            except socket.timeout:
+                timed_out.extend(conn.pending.values())
+                conn.deadline=time.monotonic()+1.
+                self._send_cancel(conn, list(conn.pending))
+                conn.pending.clear()
+                self.discard(conn)
+                continue
+            except OSError:
+                self.discard(conn)
+                continue
+            self.release(conn)
+        if timed_out:
+            raise CommandTimeout(', '.join(str(command)
+                                           for command in timed_out))
+        self.check_errors()
+
+    def close(self):
+        '''Close all the idle connections'''
+        with self._condition:
+            for conn in self._idle:
+                conn.close()
+                self._open.discard(conn)
+                self._n_open-=1
+            self._idle=[]
+            self._condition.notify_all()
+
+# the constants which must be equal in the client and in the add-on
+SHARED_CONSTANTS=['ARRAY_FRAME', 'CODEC_FRAME', 'PROTOCOL_VERSION',
+                  'INTERACTIVE', 'NORMAL', 'BULK', 'COMPRESSION_THRESHOLD',
+                  'COMPRESSION_SAMPLE', 'COMPRESSION_RATIO',
+                  'SHARED_MEMORY_THRESHOLD']
+
+def _same_message(first, second):
+    # whether two decoded messages are equal, arrays included
+    if isinstance(first, np.ndarray) or isinstance(second, np.ndarray):
+        return (isinstance(first, np.ndarray)
+                and isinstance(second, np.ndarray)
+                and first.dtype==second.dtype
+                and np.array_equal(first, second))
+    if isinstance(first, dict) and isinstance(second, dict):
+        return (first.keys()==second.keys()
+                and all(_same_message(first[key], second[key])
+                        for key in first))
+    if isinstance(first, (list, tuple)) and isinstance(second, (list, tuple)):
+        return (len(first)==len(second)
+                and all(_same_message(a, b) for a, b in zip(first, second)))
+    return first==second
+
+def check_addon_transport(path=None):
+    '''Compare this module with the transport module of the add-on: their
+    shared constants, the letters of their codecs and compressions, their
+    capabilities, and the messages each one encodes, decoded by the other.
+    The add-on module does not need Blender to be loaded
+    
+    Parameters:
+        path: the path of the transport.py of the add-on, or None for the
+        Blender_addon folder next to this package
+    
+    Return:
+        the list of the differences, empty if the two modules speak the
+        same protocol
+    '''
+    if path is None:
+        path=os.path.join(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))), 'Blender_addon', 'transport.py')
+    spec=importlib.util.spec_from_file_location('_addon_transport', path)
+    addon=importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(addon)
+    differences=[]
+    for name in SHARED_CONSTANTS:
+        if globals()[name]!=getattr(addon, name, None):
+            differences.append('{}: {!r} in BlenderPy, {!r} in the add-on'
+                               .format(name, globals()[name],
+                                       getattr(addon, name, None)))
+    for name, methods, addon_methods in [
+            ('CODECS', CODECS, addon.CODECS),
+            ('COMPRESSIONS', COMPRESSIONS, addon.COMPRESSIONS)]:
+        for method in set(methods)&set(addon_methods):
+            if methods[method][0]!=addon_methods[method][0]:
+                differences.append('{}[{!r}]: the letter {!r} in BlenderPy, '
+                                   '{!r} in the add-on'.format(
+                                           name, method, methods[method][0],
+                                           addon_methods[method][0]))
+    # the add-on only lists shared_memory where it is available
+    if (set(CAPABILITIES)-set(addon.CAPABILITIES)-set(['shared_memory'])
+        or set(addon.CAPABILITIES)-set(CAPABILITIES)):
+        differences.append('CAPABILITIES: {!r} in BlenderPy, {!r} in the '
+                           'add-on'.format(CAPABILITIES, addon.CAPABILITIES))
+    message=dict({'command':'check', 'id':1, 'priority':NORMAL,
+                  'kwargs':dict({'points':np.arange(12.).reshape(4, 3),
+                                 'cells':np.arange(6, dtype=np.int32),
+                                 'empty':np.zeros((0, 3)),
+                                 'name':'caf\u00e9', 'values':[1, 2.5, None],
+                                 'flag':True})})
+    for codec in [codec for codec in CODECS if codec in addon.CODECS]:
+        for binary in [True, False]:
+            for encode, decode, direction in [
+                    (encode_message, addon.decode_message,
+                     'BlenderPy to the add-on'),
+                    (addon.encode_message, decode_message,
+                     'the add-on to BlenderPy')]:
+                expected=message if binary else decode_message(
+                        encode_message(message, binary=False, codec=codec))
+                try:
+                    decoded=decode(encode(message, binary=binary,
+                                          codec=codec))
+                except Exception as error:
+                    decoded=error
+                if not _same_message(decoded, expected):
+                    differences.append('a message in {} with {}, {}: {!r}'
+                                       .format(direction, codec,
+                                               'binary arrays' if binary
+                                               else 'lists', decoded))
+    data=bytes(range(256))*1024
+    for method in set(COMPRESSIONS)&set(addon.COMPRESSIONS):
+        for compressed, unpack, direction in [
+                (compress(data, method), addon.decompress,
+                 'BlenderPy to the add-on'),
+                (addon.compress(data, method), decompress,
+                 'the add-on to BlenderPy')]:
+            try:
+                unpacked=bytes(unpack(compressed))
+            except Exception:
+                unpacked=None
+            if unpacked!=data:
+                differences.append('data compressed with {} from {}'
+                                   .format(method, direction))
+    return differences
+
+if __name__=='__main__':
+    differences=check_addon_transport()
+    for difference in differences:
+        print(difference)
+    raise SystemExit(1 if differences else 0)
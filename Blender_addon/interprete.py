@@ -4,36 +4,170 @@ import time
 import bmesh 
 from mathutils import Vector
 import numpy as np
+from .transport import (Answer, PROTOCOL_VERSION, CAPABILITIES, COMPRESSIONS,
+                        choose_codec, read_shared_memory_probe)
 
 class Interprete:
     
+    # the properties read and written several at a time by get_properties
+    # and set_properties
+    PROPERTIES=('object_property', 'light_property', 'camera_property',
+                'scene_property', 'modifier_property', 'constraint_property')
+    # the commands answering on the connection of their request, which
+    # the commands of a batch do not have
+    UNBATCHED=('hello', 'cancel', 'subscribe')
+    # the collections of bpy.data whose datablocks can be renamed
+    DATABLOCKS=('objects', 'materials')
+    
     def __init__(self, server):
         self.server=server
     
     def call(self, cmd):
         getattr(self, cmd['command'])(**cmd['kwargs'])
     
+    def check(self, cmd):
+        # called by the decoding thread of the server, so that a malformed
+        # command, or a batch holding one, is refused before anything runs
+        # on the main thread
+        if not isinstance(cmd, dict):
+            raise TypeError('a command must be a dictionary')
+        command=cmd.get('command')
+        if (not isinstance(command, str) or command.startswith('_')
+            or not callable(getattr(self, command, None))):
+            raise AttributeError('unknown command: {}'.format(command))
+        if not isinstance(cmd.get('kwargs'), dict):
+            raise TypeError('the kwargs of {} must be a dictionary'\
+                            .format(command))
+        if command=='batch':
+            commands=cmd['kwargs'].get('commands')
+            if not isinstance(commands, list):
+                raise TypeError('the commands of a batch must be a list')
+            for sub_cmd in commands:
+                self.check(sub_cmd)
+                if sub_cmd['command'] in self.UNBATCHED:
+                    raise ValueError('{} cannot be in a batch'.format(
+                            sub_cmd['command']))
+        if command in ('get_properties', 'set_properties'):
+            if cmd['kwargs'].get('func') not in self.PROPERTIES:
+                raise AttributeError('unknown properties: {}'.format(
+                        cmd['kwargs'].get('func')))
+            if not isinstance(cmd['kwargs'].get('keys'), list):
+                raise TypeError('the keys of {} must be a list'\
+                                .format(command))
+            if (command=='set_properties'
+                and (not isinstance(cmd['kwargs'].get('values'), list)
+                     or len(cmd['kwargs']['values'])
+                     !=len(cmd['kwargs']['keys']))):
+                raise ValueError('set_properties needs as many values as '
+                                 'keys')
+        if (command=='rename'
+            and cmd['kwargs'].get('datablock') not in self.DATABLOCKS):
+            raise AttributeError('unknown datablocks: {}'.format(
+                    cmd['kwargs'].get('datablock')))
+    
+    def batch(self, connection=None, commands=None, **kwargs):
+        results=[]
+        for cmd in commands:
+            self.server.check_cancelled()
+            answer=Answer()
+            cmd['kwargs']=self.resolve_results(cmd['kwargs'], results)
+            cmd['kwargs']['connection']=answer
+            self.call(cmd)
+            results.append(answer.content)
+        self.server.send_answer(connection, results)
+    
+    def resolve_results(self, value, results):
+        # replace the references to the answers of previous commands of
+        # the batch by the answers themselves
+        if isinstance(value, dict):
+            if '__result__' in value:
+                res=results[value['__result__']]
+                for key in value['path']:
+                    res=res[key]
+                return res
+            return dict({k:self.resolve_results(v, results)
+                         for k,v in value.items()})
+        elif isinstance(value, list):
+            return [self.resolve_results(v, results) for v in value]
+        return value
+
+    def get_properties(self, connection=None, func=None, keys=None,
+                       **kwargs):
+        # several properties of the same object, read in one command by the
+        # command reading one of them
+        results=[]
+        for key in keys:
+            answer=Answer()
+            getattr(self, 'get_'+func)(connection=answer, key=key, **kwargs)
+            results.append(answer.content)
+        self.server.send_answer(connection, results)
+    
+    def set_properties(self, connection=None, func=None, keys=None,
+                       values=None, **kwargs):
+        # nothing is written if the request is malformed
+        if len(keys)!=len(values):
+            raise ValueError('set_properties got {} keys and {} values'\
+                             .format(len(keys), len(values)))
+        for key, value in zip(keys, values):
+            getattr(self, 'set_'+func)(connection=Answer(), key=key,
+                                       value=value, **kwargs)
+        self.server.send_answer(connection, 'FINISHED')
+
+    def rename(self, connection=None, datablock=None, name=None,
+               new_name=None, **kwargs):
+        # Blender adds a suffix like .001 to a name already used, so the
+        # client is told the name actually given
+        data=getattr(bpy.data, datablock)[name]
+        data.name=new_name
+        self.server.send_answer(connection, data.name)
+
+    def hello(self, connection=None, codecs=None, version=None,
+              capabilities=None, compressions=None, shared_memory_probe=None,
+              **kwargs):
+        # the client writes its next messages with the chosen codec, and
+        # only uses the capabilities of the oldest side
+        answer=dict({'codec':choose_codec(codecs or []),
+                     'version':PROTOCOL_VERSION,
+                     'capabilities':CAPABILITIES,
+                     'compressions':list(COMPRESSIONS)})
+        if shared_memory_probe is not None:
+            # the client only sends its arrays through shared memory if
+            # this process reads the same bytes in its block
+            answer['shared_memory_probe']=read_shared_memory_probe(
+                    shared_memory_probe)
+        self.server.send_answer(connection, answer)
+
+    def subscribe(self, connection=None, events=None, **kwargs):
+        # the changes of the scene are then sent on the connection of the
+        # request, until the client closes it
+        self.server.subscribe(connection, events)
+
+    def cancel(self, connection=None, request_ids=None, **kwargs):
+        # executed by the decoding thread of the server, without waiting
+        # for the command being executed
+        self.server.cancel(connection, request_ids or [])
+
+    def echo(self, connection=None, **kwargs):
+        self.server.send_answer(connection, kwargs)
+
+    def get_transfer_stats(self, connection=None):
+        self.server.send_answer(connection, self.server.stats.to_dict())
+
     def delete_all(self, connection=None):
         for block in bpy.data.objects:
             bpy.data.objects.remove(block, do_unlink=True)
         for block in bpy.data.lights:
             bpy.data.lights.remove(block, do_unlink=True)
-            time.sleep(0.01)
         for block in bpy.data.cameras:
             bpy.data.cameras.remove(block, do_unlink=True)
-            time.sleep(0.01)
         for block in bpy.data.meshes:
             bpy.data.meshes.remove(block, do_unlink=True)
-            time.sleep(0.01)
         for block in bpy.data.materials:
             bpy.data.materials.remove(block, do_unlink=True)
-            time.sleep(0.01)
         for block in bpy.data.textures:
             bpy.data.textures.remove(block, do_unlink=True)
-            time.sleep(0.01)
         for block in bpy.data.images:
             bpy.data.images.remove(block, do_unlink=True)
-            time.sleep(0.01)
         self.server.send_answer(connection, "DONE")
         
     def get_base_context(self):
@@ -441,13 +575,21 @@ class Interprete:
         self.server.send_answer(kwargs['connection'], [new_curve.name, new_obj.name])
     
     def get_curve_points(self, connection=None, name_obj=None, name=None, **kwargs):
-        curve=bpy.data.curves[name].splines[0]
-        self.server.send_answer(connection, [[v.co.x, v.co.y, v.co.z] for v in curve.points.values()])
+        points=bpy.data.curves[name].splines[0].points
+        co=np.empty(4*len(points), dtype=np.float32)
+        points.foreach_get('co', co)
+        self.server.send_answer(connection, co.reshape(-1, 4)[:,:3])
     
     def set_curve_points(self, name=None, points=None, **kwargs):
-        curve=bpy.data.curves[name].splines[0]
-        for co,v in zip(points, curve.points.values()):
-            v.co=co+[0.]
+        curve_points=bpy.data.curves[name].splines[0].points
+        co=np.empty(4*len(curve_points), dtype=np.float32)
+        curve_points.foreach_get('co', co)
+        co=co.reshape(-1, 4)
+        # only the points given change, the other ones are kept
+        points=np.asarray(points, dtype=np.float32)[:len(co)]
+        co[:len(points),:3]=points
+        co[:len(points),3]=0.
+        curve_points.foreach_set('co', co.ravel())
     
     def get_scene_property(self, key=None,
                            connection=None, **kwargs):
@@ -470,24 +612,37 @@ class Interprete:
     
     def get_vertices(self, name_msh=None,
                      connection=None, **kwargs):
-        self.server.send_answer(connection,
-                                [[v.co.x, v.co.y, v.co.z] for v in bpy.data.meshes[name_msh].vertices.values()])
+        vertices=bpy.data.meshes[name_msh].vertices
+        co=np.empty(3*len(vertices), dtype=np.float32)
+        vertices.foreach_get('co', co)
+        self.server.send_answer(connection, co.reshape(-1, 3))
         
     def set_vertices(self, name_msh=None,
                      connection=None, val=None, **kwargs):
-        for co,v in zip(val, bpy.data.meshes[name_msh].vertices.values()):
-            v.co=co
+        mesh=bpy.data.meshes[name_msh]
+        co=np.empty(3*len(mesh.vertices), dtype=np.float32)
+        mesh.vertices.foreach_get('co', co)
+        co=co.reshape(-1, 3)
+        # only the vertices given change, the other ones are kept
+        val=np.asarray(val, dtype=np.float32).reshape(-1, 3)[:len(co)]
+        co[:len(val)]=val
+        mesh.vertices.foreach_set('co', co.ravel())
+        mesh.update()
     
     def insert_keyframe_mesh(self, name_msh=None,
                      connection=None, frame='current', 
-                     waiting_time_between_points=0.01,
+                     waiting_time_between_points=0.,
                      **kwargs):
         if frame=='current':
             frame=bpy.context.scene.frame_current
-        for i,v in enumerate(bpy.data.meshes[name_msh].vertices.values()):
+        vertices=bpy.data.meshes[name_msh].vertices.values()
+        for i,v in enumerate(vertices):
+            self.server.check_cancelled()
             print('keyframing point nr {:}'.format(i))
             v.keyframe_insert('co', frame=frame)
-            time.sleep(waiting_time_between_points)
+            self.server.report_progress(i+1, len(vertices))
+            if waiting_time_between_points>0:
+                time.sleep(waiting_time_between_points)
         self.server.send_answer(connection, 'FINISHED')
     
     def insert_keyframe_object(self, name_obj=None,
@@ -518,14 +673,11 @@ class Interprete:
         if frame=='current':
             frame=bpy.context.scene.frame_current
         mat=bpy.data.materials[material_name]
-        time.sleep(0.5)
         node=mat.node_tree.nodes[parent_name]
-        time.sleep(0.5)
         if shader_socket_type=='input':
             socket=node.inputs[key]
         elif shader_socket_type=='output':
             socket=node.outputs[key]
-        time.sleep(0.5)
         print(socket.keyframe_insert(key_to_keyframe, frame=frame))
         self.server.send_answer(connection, 'FINISHED')
             
@@ -562,6 +714,7 @@ class Interprete:
             Q=kwargs['Q']
             N_frames_per_oscillation=int(kwargs['N_frames']/kwargs['N_oscillations'])
             for i in range(kwargs['N_oscillations']):
+                self.server.check_cancelled()
                 for j in range(4):
                     
                     scene.frame_current=int(i*N_frames_per_oscillation+j*N_frames_per_oscillation/4)
@@ -581,6 +734,9 @@ class Interprete:
                     obj.keyframe_insert("scale")
                     obj.keyframe_insert("location")
                     obj.keyframe_insert("rotation_euler")
+                self.server.report_progress(i+1, kwargs['N_oscillations'],
+                                            dict({'frame':
+                                                  scene.frame_current}))
         self.server.send_answer(kwargs['connection'], "DONE")
 
         
@@ -721,17 +877,23 @@ class Interprete:
                  planes_no=None, **kwargs):
         mesh=bpy.data.meshes[name_msh]
         bm = bmesh.new()
-        bm.from_mesh(mesh)
-        print('Nverts0: {:}'.format(len(bm.verts)))
-        for i, (co, no) in enumerate(zip(planes_co, planes_no)):
-            print('slicing plane number {:}'.format(i))
-            bmesh.ops.bisect_plane(bm, geom=bm.verts[:]+bm.edges[:]+bm.faces[:],
-                                   dist=1e-6,
-                                   plane_co=co, plane_no=no)
-        print('Nverts1: {:}'.format(len(bm.verts)))
-        bm.normal_update() 
-        bm.to_mesh(mesh) 
-        bm.free()
+        try:
+            bm.from_mesh(mesh)
+            print('Nverts0: {:}'.format(len(bm.verts)))
+            for i, (co, no) in enumerate(zip(planes_co, planes_no)):
+                # the mesh is left untouched if the cut is cancelled
+                self.server.check_cancelled()
+                print('slicing plane number {:}'.format(i))
+                bmesh.ops.bisect_plane(bm, geom=bm.verts[:]+bm.edges[:]+bm.faces[:],
+                                       dist=1e-6,
+                                       plane_co=co, plane_no=no)
+                self.server.report_progress(i+1, len(planes_co),
+                                            dict({'vertices':len(bm.verts)}))
+            print('Nverts1: {:}'.format(len(bm.verts)))
+            bm.normal_update() 
+            bm.to_mesh(mesh) 
+        finally:
+            bm.free()
 
 
 
@@ -789,7 +951,11 @@ class Object:
         self.cells=cells
         self.mesh_data = bpy.data.meshes.new(self.name)
         self.name_msh=self.mesh_data.name
-        self.mesh_data.from_pydata(points, [], cells)
+        if isinstance(cells, np.ndarray) and cells.ndim==2:
+            self.fill_arrays(np.asarray(points, dtype=np.float32), 
+                             cells.astype(np.int32))
+        else:
+            self.mesh_data.from_pydata(points, [], cells)
         self.mesh_data.update()
     
         self.obj = bpy.data.objects.new(self.name, self.mesh_data)
@@ -800,6 +966,25 @@ class Object:
         print(self.name_obj)
         self.extrude()
     
+    def fill_arrays(self, points, cells):
+        # cells of the same size can be given directly to the mesh
+        # buffers, without building python lists like from_pydata
+        mesh=self.mesh_data
+        n_cells, cell_size=cells.shape
+        mesh.vertices.add(len(points))
+        mesh.vertices.foreach_set('co', points.ravel())
+        mesh.loops.add(n_cells*cell_size)
+        mesh.loops.foreach_set('vertex_index', cells.ravel())
+        mesh.polygons.add(n_cells)
+        mesh.polygons.foreach_set('loop_start', 
+                                  np.arange(0, n_cells*cell_size, cell_size,
+                                            dtype=np.int32))
+        if not mesh.polygons.bl_rna.properties['loop_total'].is_readonly:
+            mesh.polygons.foreach_set('loop_total', 
+                                      np.full(n_cells, cell_size,
+                                              dtype=np.int32))
+        mesh.update(calc_edges=True)
+    
     def select_obj(self):
         for obj in bpy.data.objects:
             if self.name_obj==obj.name:
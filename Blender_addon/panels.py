@@ -7,10 +7,15 @@ Created on Thu Aug 27 17:54:45 2020
 
 from .receiving_data import Server
 
+server=None
       
 def register() :
+    global server
     server=Server()
     server.connect()
  
 def unregister() :
-    pass
+    global server
+    if server is not None:
+        server.disconnect()
+        server=None
@@ -5,47 +5,119 @@ Created on Wed Aug 26 10:05:13 2020
 @author: Thibault
 """
 
+import os
 import socket
+import selectors
 import threading
-import json
+import itertools
+import queue
+from collections import deque
 from .interprete import Interprete
+from .transport import (Connection, Reply, Request, TransferStats,
+                        CommandCancelled, codec_of, choose_compression,
+                        decode_message, decompress, release_shared_memory,
+                        shared_memory)
 from mathutils import Vector, Matrix, Euler
 import time
+import traceback
+import bpy
 
 HOST = '127.0.0.1'
 PORT = 20000
+# path of a unix domain socket on which the server also listens, for the
+# clients running on the same machine, or None
+SOCKET_PATH = os.environ.get('BLENDERPY_SOCKET')
+# maximum time, in seconds, spent executing commands in one timer tick,
+# so that the interface of Blender stays responsive
+TICK_BUDGET = 0.05
+# delay, in seconds, between two timer ticks when no command is waiting
+TICK_INTERVAL = 0.01
+# print the length of every message received, for debugging
+LOG_PACKETS = False
+# minimum delay, in seconds, between two progress messages of a command
+PROGRESS_INTERVAL = 0.1
+# minimum delay, in seconds, between two notifications of the changes of
+# the scene to the subscribed clients
+NOTIFY_INTERVAL = 0.1
+# the events a client can subscribe to: the datablocks updated, and the
+# frame changes
+EVENTS = ('update', 'frame')
 
 class Server:
     
-    def __init__(self, host=HOST, port=PORT):
+    def __init__(self, host=HOST, port=PORT, tick_budget=TICK_BUDGET,
+                 tick_interval=TICK_INTERVAL, path=SOCKET_PATH,
+                 log_packets=LOG_PACKETS, progress_interval=PROGRESS_INTERVAL,
+                 notify_interval=NOTIFY_INTERVAL):
         self.host=host
         self.port=port
+        self.path=path
+        self.log_packets=log_packets
+        self.tick_budget=tick_budget
+        self.tick_interval=tick_interval
+        self.progress_interval=progress_interval
+        self.notify_interval=notify_interval
         self.connected=False
+        self.connections=[]
+        # the received messages wait in frames to be decoded, then in
+        # waiting, by connection, to be executed in the order they were
+        # received. The priority only chooses the connection whose next
+        # command is executed: commands holds the next command of each
+        # connection, by priority and then in the order they were received
+        self.frames=queue.Queue()
+        self.waiting=dict()
+        self.commands=queue.PriorityQueue()
+        self._order=itertools.count()
+        self._waiting_lock=threading.Lock()
+        # the connection and the request ID of the command being executed
+        self.current=None
+        # when the command being executed started, if its client follows
+        # its progress, and when its last progress was sent
+        self.progress_start=None
+        self.progress_sent=None
+        # the subscribe requests, as (connection, request ID, events), and
+        # the changes waiting to be notified to them, by (type, name) of
+        # the datablock
+        self.subscriptions=[]
+        self.changes=dict()
+        self.frame=None
+        self.notified=None
+        self.stats=TransferStats()
         self.interprete = Interprete(self)
     
     def __del__(self):
         self.disconnect()
         time.sleep(0.5)
         
-    def connect(self):
+    def connect(self, use_timers=True):
+        # the sockets are handled by a thread and the messages decoded by
+        # another, but the commands are executed by the main thread of
+        # Blender, either with a timer or with serve_forever when Blender
+        # runs in background mode
         if not self.connected:
+            self._wake_r, self._wake_w=socket.socketpair()
+            self._wake_r.setblocking(False)
+            self._wake_w.setblocking(False)
             self.server_thread=threading.Thread(target=self.listen, daemon=True)
+            self.decoding_thread=threading.Thread(target=self.decoding,
+                                                  daemon=True)
             self.connected=True
             self.server_thread.start()
-            
-    def receive_all(self, sock, n):
-        # Helper function to recv n bytes or return None if EOF is hit
-        data = bytearray()
-        i=1
-        while len(data) < n:
-            print('packet number {:}'.format(i))
-            packet = sock.recv(n - len(data))
-            if not packet:
-                return None
-            data.extend(packet)
-            i+=1
-        return data  
+            self.decoding_thread.start()
+            bpy.app.handlers.depsgraph_update_post.append(
+                    self.on_depsgraph_update)
+            bpy.app.handlers.frame_change_post.append(self.on_frame_change)
+            if use_timers:
+                bpy.app.timers.register(self.tick, persistent=True)
     
+    def wake(self):
+        # interrupt the select of the listening thread, so that it takes
+        # the queued answers and the connections to close into account
+        try:
+            self._wake_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+            
     def send(self, message):
         print('len : {:010x}'.format(len(message)))
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -82,41 +154,400 @@ class Server:
                     row_l.append(row.w)
                 message_list.append(row_l)  
             message=message_list
-        message=json.dumps(dict({'content':message}))
-        conn.sendall(('{:010x}'.format(len(message))+message).encode())
+        conn.send_answer(message)
         
     def listen(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind((self.host, self.port))
-            s.listen()
+        selector=selectors.DefaultSelector()
+        listeners=[]
+        try:
+            listeners.append(self.open_listener())
+            if self.path is not None:
+                listeners.append(self.open_unix_listener())
+            for s in listeners:
+                selector.register(s, selectors.EVENT_READ, None)
+            selector.register(self._wake_r, selectors.EVENT_READ, None)
             while self.connected:
-                conn, addr = s.accept()
-                with conn:
-                    print('Connected by', addr)
-                    while True:
-                        raw_msglen = conn.recv(10)
-                        if not raw_msglen:
-                            print("No raw_msglen")
-                            break
-                        msglen = int(raw_msglen.decode(),16)
-                        print('len of packet is {:}'.format(msglen))
-                        data=self.receive_all(conn, msglen)
-                        if data is not None:
-                            self.interpreter(conn, data)
-                        elif len(data)!=msglen:
-                            print('the length and the data did not match')
+                for key, mask in selector.select(timeout=0.5):
+                    if key.fileobj in listeners:
+                        self.accept(key.fileobj, selector)
+                    elif key.fileobj is self._wake_r:
+                        self.drain_wake()
+                    else:
+                        conn=key.data
+                        if mask & selectors.EVENT_READ:
+                            self.read(conn)
+                        if mask & selectors.EVENT_WRITE:
+                            conn.flush()
+                self.update_connections(selector)
             print("we are going to shut down boys")
-            s.shutdown(socket.SHUT_RDWR)
-            s.close()
+            for conn in self.connections:
+                conn.close()
+            self.connections=[]
+        finally:
+            selector.close()
+            for s in listeners:
+                s.close()
+            if self.path is not None and os.path.exists(self.path):
+                os.unlink(self.path)
+    
+    def open_listener(self):
+        s=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((self.host, self.port))
+        s.listen()
+        s.setblocking(False)
+        return s
+    
+    def open_unix_listener(self):
+        # a socket file left by a server that did not shut down properly
+        # would prevent the bind
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        s=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(self.path)
+        s.listen()
+        s.setblocking(False)
+        return s
+    
+    def accept(self, s, selector):
+        try:
+            sock, addr = s.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        print('Connected by', addr)
+        conn=Connection(sock, addr, wake=self.wake, stats=self.stats,
+                        log_packets=self.log_packets)
+        self.connections.append(conn)
+        selector.register(sock, selectors.EVENT_READ, conn)
+    
+    def drain_wake(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+    
+    def read(self, conn):
+        frames=conn.receive()
+        if frames is None:
+            print("No raw_msglen")
+            conn.closing=True
+            conn.discard_output()
+            return
+        # the frames are only assembled here, so that a large upload from
+        # one client does not prevent reading the others
+        for data in frames:
+            self.frames.put((conn, data))
+    
+    def update_connections(self, selector):
+        for conn in list(self.connections):
+            if conn.closing and not conn.pending_output:
+                selector.unregister(conn.sock)
+                conn.close()
+                self.connections.remove(conn)
+                continue
+            if conn.closing:
+                events=selectors.EVENT_WRITE
+            elif conn.pending_output:
+                events=selectors.EVENT_READ | selectors.EVENT_WRITE
+            else:
+                events=selectors.EVENT_READ
+            if selector.get_key(conn.sock).events!=events:
+                selector.modify(conn.sock, events, conn)
+    
+    def tick(self):
+        # execute the waiting commands, for at most tick_budget seconds,
+        # and return the delay before the next call
+        if not self.connected:
+            return None
+        self.notify_changes()
+        start=time.perf_counter()
+        while time.perf_counter()-start<self.tick_budget:
+            try:
+                _, _, conn=self.commands.get_nowait()
+            except queue.Empty:
+                return self.tick_interval
+            self.execute(conn, self.next_command(conn))
+        return 0.
+    
+    def serve_forever(self):
+        # execute the commands in the calling thread until disconnect is
+        # called. Used when Blender runs in background mode without timers
+        while self.connected:
+            self.notify_changes()
+            try:
+                _, _, conn=self.commands.get(timeout=self.notify_interval)
+            except queue.Empty:
+                continue
+            self.execute(conn, self.next_command(conn))
+    
+    def decoding(self):
+        # the messages are decoded by this thread, one at a time in the
+        # order they were received, so that the main thread of Blender only
+        # executes the commands, while the next ones are being decoded
+        while self.connected:
+            try:
+                conn, message=self.frames.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if conn.closed:
+                continue
+            request=self.decode(message)
+            if request.error is None and request.command['command']=='cancel':
+                # executed right away, as the main thread may be busy with
+                # the command to cancel
+                request.command['kwargs']['connection']=conn
+                try:
+                    self.interprete.call(request.command)
+                except Exception:
+                    traceback.print_exc()
+                continue
+            self.schedule(conn, request)
+    
+    def schedule(self, conn, request):
+        # a command with a higher priority goes ahead of the commands of
+        # the other connections, but never of the ones of its connection,
+        # which a client expects to be executed before
+        with self._waiting_lock:
+            commands=self.waiting.setdefault(conn, deque())
+            commands.append((next(self._order), request))
+            if len(commands)==1:
+                self.commands.put((request.priority, commands[0][0], conn))
+    
+    def next_command(self, conn):
+        # take the next command of a connection, and schedule the one after
+        with self._waiting_lock:
+            commands=self.waiting[conn]
+            _, request=commands.popleft()
+            if commands:
+                order, following=commands[0]
+                self.commands.put((following.priority, order, conn))
+            else:
+                del self.waiting[conn]
+        return request
+    
+    def cancel(self, conn, request_ids):
+        # the commands waiting are cancelled when they are taken from the
+        # queue, and the running one at its next call to check_cancelled
+        conn.cancelled.update(request_ids)
+    
+    def check_cancelled(self):
+        '''Raise CommandCancelled if the client cancelled the command being
+        executed. Called by the long commands between their iterations'''
+        if self.current is None:
+            return
+        conn, request_id=self.current
+        if request_id in conn.cancelled:
+            raise CommandCancelled('the request {:} was cancelled'\
+                                   .format(request_id))
+        # nobody is waiting for the answer anymore
+        if conn.closing:
+            raise CommandCancelled('the connection of the request {:} was '
+                                   'closed'.format(request_id))
+    
+    def report_progress(self, done, total=None, partial=None):
+        '''Send the progress of the command being executed, if its client
+        asked for it, at most every progress_interval seconds except for
+        the last step. Called by the long commands between their iterations
+        
+        Parameters:
+            done: the number of steps done
+            
+            total: the total number of steps, if known
+            
+            partial: a partial result, sent with the progress
+        '''
+        if self.current is None or self.progress_start is None:
+            return
+        now=time.perf_counter()
+        if (self.progress_sent is not None and done!=total
+            and now-self.progress_sent<self.progress_interval):
+            return
+        self.progress_sent=now
+        conn, request_id=self.current
+        progress=dict({'done':done, 'total':total,
+                       'elapsed':now-self.progress_start})
+        if partial is not None:
+            progress['partial']=partial
+        conn.send_progress(request_id, progress)
+    
+    def subscribe(self, reply, events=None):
+        '''Notify a client of the changes of the scene, with progress
+        messages of its subscribe request, until it closes the connection
+        
+        Parameters:
+            reply: the Reply of the subscribe request
+            
+            events: the list of the events notified, among EVENTS, or None
+            for all of them
+        '''
+        if not isinstance(reply, Reply):
+            raise ValueError('subscribe needs a request ID, and cannot be '
+                             'in a batch')
+        events=list(EVENTS) if events is None else list(events)
+        self.subscriptions.append((reply.connection, reply.request_id,
+                                   events))
+        reply.send_answer(dict({'events':events}))
+    
+    def on_depsgraph_update(self, scene, depsgraph=None):
+        # called by Blender once the changes made by the interface, the
+        # scripts or the commands are evaluated. Only the kind of change of
+        # each datablock is known, not the properties changed
+        if not self.subscriptions or depsgraph is None:
+            return
+        for update in depsgraph.updates:
+            self.add_change(update)
+        self.notify_changes()
+    
+    def on_frame_change(self, scene, depsgraph=None):
+        if not self.subscriptions:
+            return
+        self.frame=scene.frame_current
+        if depsgraph is not None:
+            for update in depsgraph.updates:
+                self.add_change(update)
+        self.notify_changes(force=True)
+    
+    def add_change(self, update):
+        # the updates are about the evaluated copies of the datablocks
+        block=getattr(update.id, 'original', update.id)
+        changes=self.changes.setdefault((block.id_type, block.name), set())
+        if update.is_updated_transform:
+            changes.add('transform')
+        if update.is_updated_geometry:
+            changes.add('geometry')
+        if update.is_updated_shading:
+            changes.add('shading')
+    
+    def notify_changes(self, force=False):
+        '''Send the changes collected to the subscribed clients, at most
+        every notify_interval seconds unless force is True. Each
+        notification holds the list of the datablocks updated, with their
+        type, name and kind of changes, and the frame if it changed'''
+        if not self.changes and self.frame is None:
+            return
+        now=time.perf_counter()
+        if (not force and self.notified is not None
+            and now-self.notified<self.notify_interval):
+            return
+        self.notified=now
+        updates=[dict({'type':id_type, 'name':name,
+                       'changes':sorted(changes)})
+                 for (id_type, name), changes in self.changes.items()]
+        frame=self.frame
+        self.changes=dict()
+        self.frame=None
+        for subscription in list(self.subscriptions):
+            conn, request_id, events=subscription
+            if conn.closing or conn.closed:
+                self.subscriptions.remove(subscription)
+                continue
+            event=dict()
+            if updates and 'update' in events:
+                event['updates']=updates
+            if frame is not None and 'frame' in events:
+                event['frame']=frame
+            if event:
+                conn.send_progress(request_id, event)
+    
+    def decode(self, message):
+        # decompress, decode and check a message. The errors are kept in the
+        # request, to be reported by the main thread in the order of the
+        # commands
+        request=Request()
+        try:
+            data=decompress(message)
+            self.stats.add_received(len(data), len(message))
+            request.codec=codec_of(data)
+            request.command=decode_message(data, shared=request.blocks)
+            self.interprete.check(request.command)
+        except Exception as error:
+            request.error=error
+            request.traceback=traceback.format_exc()
+        return request
+    
+    def execute(self, conn, request):
+        # the commands of all the clients are executed one at a time, and
+        # the ones of each connection in the order they were received
+        if conn.closed:
+            release_shared_memory(request.blocks, unlink=False)
+            return
+        try:
+            self.interpreter(conn, request)
+        except Exception:
+            # closing the connection lets a client that does not send
+            # request IDs know that its command failed instead of waiting
+            # for an answer
+            traceback.print_exc()
+            conn.close_later()
     
     def disconnect(self):
-        self.connected=False
         if self.connected:
             print('I will disconnect this server')
+            self.connected=False
+            for handlers, handler in ((bpy.app.handlers.depsgraph_update_post,
+                                       self.on_depsgraph_update),
+                                      (bpy.app.handlers.frame_change_post,
+                                       self.on_frame_change)):
+                if handler in handlers:
+                    handlers.remove(handler)
+            self.subscriptions=[]
+            self.wake()
     
-    def interpreter(self, conn, message):
-        cmd = json.loads(message)
-        cmd['kwargs']['connection']=conn
-        self.interprete.call(cmd)
-        
-        
+    def interpreter(self, conn, request):
+        # the client has read the previous answer before sending this message
+        conn.release_shared_memory()
+        try:
+            cmd = request.command
+            request_id = request.id
+            if request.error is not None and request_id is None:
+                print(request.traceback)
+                raise request.error
+            # the answer is written with the codec of the command, and
+            # clients able to decode array frames, compressed answers and
+            # answers in shared memory say so in their messages
+            conn.codec=request.codec
+            conn.binary=cmd.get('binary', False)
+            conn.compression=choose_compression(cmd.get('compressions', []))
+            conn.shared_memory=(cmd.get('shared_memory', False)
+                                and shared_memory is not None)
+            if request.error is not None:
+                conn.send_error(request_id, request.error, request.traceback)
+                return
+            if request_id is None:
+                cmd['kwargs']['connection']=conn
+                self.interprete.call(cmd)
+                return
+            # a request with an ID always gets a reply with the same ID: the
+            # answer of the command, None if it does not answer, or its error
+            reply=Reply(conn, request_id)
+            cmd['kwargs']['connection']=reply
+            self.current=(conn, request_id)
+            if cmd.get('progress', False):
+                # the client learns that the command has started
+                self.progress_start=time.perf_counter()
+                self.report_progress(0)
+            try:
+                self.check_cancelled()
+                self.interprete.call(cmd)
+            except CommandCancelled as error:
+                print('{:} was cancelled'.format(cmd['command']))
+                conn.send_error(request_id, error, None)
+                return
+            except Exception as error:
+                traceback.print_exc()
+                conn.send_error(request_id, error, traceback.format_exc())
+                return
+            finally:
+                self.current=None
+                self.progress_start=None
+                self.progress_sent=None
+                conn.cancelled.discard(request_id)
+            if not reply.answered:
+                reply.send_answer(None)
+        finally:
+            # the arrays of the command are views on the shared memory of
+            # the client, which destroys it after the answer
+            cmd = None
+            request.command = None
+            release_shared_memory(request.blocks, unlink=False)
@@ -0,0 +1,642 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:02:47 2026
+
+@author: Thibault
+"""
+
+# The messages, their frames and their constants are shared with
+# BlenderPy/transport.py, since the add-on cannot import BlenderPy inside
+# Blender: the two copies must stay byte-compatible and change together,
+# which BlenderPy.transport.check_addon_transport verifies.
+
+import os
+import json
+import zlib
+import threading
+import itertools
+from collections import deque
+import numpy as np
+try:
+    import lz4.frame
+except ImportError:
+    lz4=None
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory=None
+try:
+    import msgpack
+except ImportError:
+    msgpack=None
+try:
+    import orjson
+except ImportError:
+    orjson=None
+
+ARRAY_FRAME=b'A'
+# size of the buffer receiving the small messages: larger messages are
+# received directly in a buffer of their own size
+RECEIVE_BUFFER=1<<16
+# maximum number of buffers given to one sendmsg call
+SENDMSG_BUFFERS=64
+# the priorities of the commands: the server executes the commands with a
+# lower priority first, and the commands with the same priority in the
+# order they were received
+INTERACTIVE=0
+NORMAL=1
+BULK=2
+# version of the protocol, answered to the hello command
+PROTOCOL_VERSION=2
+# what this server can do, answered to the hello command
+CAPABILITIES=['binary_arrays', 'compression', 'batch', 'shared_memory',
+              'pipelining', 'priority', 'cancel', 'progress', 'properties',
+              'subscribe', 'rename']
+if shared_memory is None:
+    CAPABILITIES.remove('shared_memory')
+
+def _orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # NaN and Infinity, written by the json module, are not valid json
+        return json.loads(bytes(data))
+
+# the codecs writing the structure of the messages: the letter starting
+# the encoded messages, the function encoding a structure into bytes, and
+# the function decoding it. They are listed from the preferred one, and the
+# client chooses one with the hello command. orjson writes the same json as
+# the json module, faster
+CODEC_FRAME=b'M'
+CODECS=dict()
+if msgpack is not None:
+    CODECS['msgpack']=(CODEC_FRAME,
+                       lambda value: msgpack.packb(value, use_bin_type=True),
+                       lambda data: msgpack.unpackb(data, raw=False,
+                                                    strict_map_key=False))
+if orjson is not None:
+    CODECS['orjson']=(b'',
+                      lambda value: orjson.dumps(
+                              value, option=orjson.OPT_NON_STR_KEYS),
+                      _orjson_loads)
+CODECS['json']=(b'', lambda value: json.dumps(value).encode(),
+                lambda data: json.loads(bytes(data)))
+# the codec decoding the messages written in json
+JSON_CODEC='orjson' if orjson is not None else 'json'
+
+def codec_of(data):
+    '''the name of the codec in which encoded bytes are written'''
+    if data[:1]==CODEC_FRAME and 'msgpack' in CODECS:
+        return 'msgpack'
+    return JSON_CODEC
+
+def choose_codec(codecs):
+    '''the preferred codec among codecs, json if none is available'''
+    for codec in CODECS:
+        if codec in codecs:
+            return codec
+    return 'json'
+
+# messages smaller than this, in bytes, are never compressed
+COMPRESSION_THRESHOLD=1<<16
+# size of the sample compressed first, and the ratio it must reach for the
+# whole message to be compressed
+COMPRESSION_SAMPLE=1<<14
+COMPRESSION_RATIO=0.9
+# the available compression methods, from the preferred one: the letter
+# starting the compressed data, the compressor and the decompressor
+COMPRESSIONS=dict()
+if lz4 is not None:
+    COMPRESSIONS['lz4']=(b'L', lz4.frame.compress, lz4.frame.decompress)
+COMPRESSIONS['zlib']=(b'Z', lambda data: zlib.compress(data, 1),
+                      zlib.decompress)
+
+def choose_compression(methods):
+    '''the preferred compression method among methods, or None'''
+    for method in COMPRESSIONS:
+        if method in methods:
+            return method
+    return None
+
+def compress(data, method, threshold=COMPRESSION_THRESHOLD):
+    '''Compress encoded bytes with method if they are larger than
+    threshold and a sample of them compresses well. The compressed data
+    starts with a letter telling the method, and is only used if it is
+    smaller than the original data.
+
+    Parameters:
+        data: the encoded bytes
+
+        method: a key of COMPRESSIONS, or None for no compression
+
+        threshold: the minimum size to compress
+
+    Return:
+        the bytes to send
+    '''
+    if method is None or len(data)<threshold:
+        return data
+    flag, compressor, _=COMPRESSIONS[method]
+    # random floats hardly compress: a sample tells whether it is worth
+    # compressing everything
+    sample=memoryview(data)[len(data)//2:len(data)//2+COMPRESSION_SAMPLE]
+    if len(compressor(sample))>COMPRESSION_RATIO*len(sample):
+        return data
+    compressed=flag+compressor(data)
+    if len(compressed)<len(data):
+        return compressed
+    return data
+
+def decompress(data):
+    '''Undo compress, if the data was compressed'''
+    for flag, _, decompressor in COMPRESSIONS.values():
+        if data[:1]==flag:
+            return decompressor(memoryview(data)[1:])
+    return data
+
+class TransferStats:
+    '''Counters of the bytes sent and received, before compression (raw)
+    and as they went through the socket (wire)'''
+
+    def __init__(self):
+        self._lock=threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.sent_raw=0
+            self.sent_wire=0
+            self.received_raw=0
+            self.received_wire=0
+
+    def add_sent(self, raw, wire):
+        with self._lock:
+            self.sent_raw+=raw
+            self.sent_wire+=wire
+
+    def add_received(self, raw, wire):
+        with self._lock:
+            self.received_raw+=raw
+            self.received_wire+=wire
+
+    def to_dict(self):
+        with self._lock:
+            return dict({'sent_raw':self.sent_raw,
+                         'sent_wire':self.sent_wire,
+                         'received_raw':self.received_raw,
+                         'received_wire':self.received_wire})
+
+# arrays larger than this, in bytes, go through shared memory when it is
+# used instead of the socket
+SHARED_MEMORY_THRESHOLD=1<<20
+
+def _attach_shared_memory(name):
+    # the process creating a block is the one unlinking it, so the
+    # resource tracker of this process must not unlink it at exit
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        block=shared_memory.SharedMemory(name=name)
+        if os.name=='posix':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+def read_shared_memory_probe(name):
+    '''Read the bytes of the block created by the client to check that
+    this process shares its memory
+
+    Parameters:
+        name: the name of the block
+
+    Return:
+        the 16 first bytes of the block, in hexadecimal, or None if the
+        block cannot be read
+    '''
+    if shared_memory is None or not isinstance(name, str):
+        return None
+    try:
+        block=_attach_shared_memory(name)
+    except (OSError, ValueError):
+        return None
+    try:
+        return bytes(block.buf[:16]).hex()
+    finally:
+        block.close()
+
+def _share_array(array, shared):
+    block=shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared.append(block)
+    view=np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    view[...]=array
+    del view
+    return dict({'__shared__':block.name, 'dtype':array.dtype.str,
+                 'shape':list(array.shape)})
+
+def _map_shared_array(descriptor, shared):
+    block=_attach_shared_memory(descriptor['__shared__'])
+    array=np.ndarray(descriptor['shape'], dtype=np.dtype(descriptor['dtype']),
+                     buffer=block.buf)
+    if shared is not None:
+        shared.append(block)
+        return array
+    copy=array.copy()
+    del array
+    block.close()
+    return copy
+
+def release_shared_memory(blocks, unlink=True):
+    '''Close SharedMemory blocks used by encode_message or decode_message
+
+    Parameters:
+        blocks: the list of the blocks, emptied by this function
+
+        unlink: whether the blocks should be destroyed, which is done by
+        the process that created them
+    '''
+    while blocks:
+        block=blocks.pop()
+        try:
+            block.close()
+        except BufferError:
+            # an array still uses the block, which is closed when the
+            # array is garbage collected
+            pass
+        if unlink:
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+
+def _extract_arrays(value, arrays, binary, shared=None):
+    if isinstance(value, np.ndarray):
+        if (shared is not None and value.dtype.kind in 'biuf'
+            and value.nbytes>=SHARED_MEMORY_THRESHOLD):
+            return _share_array(value, shared)
+        if binary and value.dtype.kind in 'biuf':
+            arrays.append(value)
+            return dict({'__array__':len(arrays)-1})
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, dict):
+        return dict({k:_extract_arrays(v, arrays, binary, shared)
+                     for k,v in value.items()})
+    elif isinstance(value, (list, tuple)):
+        return [_extract_arrays(v, arrays, binary, shared) for v in value]
+    return value
+
+def _restore_arrays(value, arrays, shared=None):
+    if isinstance(value, dict):
+        if len(value)==1 and '__array__' in value:
+            return arrays[value['__array__']]
+        if len(value)==3 and '__shared__' in value:
+            return _map_shared_array(value, shared)
+        return dict({k:_restore_arrays(v, arrays, shared)
+                     for k,v in value.items()})
+    elif isinstance(value, list):
+        return [_restore_arrays(v, arrays, shared) for v in value]
+    return value
+
+def encode_message(message, binary=True, shared=None, codec='json'):
+    '''Encode a message. If it contains numpy arrays and binary is True,
+    an array frame is built: the letter A, the length of a header written
+    with 10 hexadecimal digits, the header, and then the raw little-endian
+    bytes of the arrays. Otherwise, the message is only the encoded
+    structure. With a codec other than json, the letter of the codec comes
+    first.
+
+    Parameters:
+        message: a json-compatible dictionary, possibly containing numpy
+        arrays
+
+        binary: if False, the arrays are converted to lists
+
+        shared: a list receiving new SharedMemory blocks, in which the
+        arrays larger than SHARED_MEMORY_THRESHOLD are copied instead of
+        being sent. The blocks must be kept until the message is decoded,
+        and then released with release_shared_memory. If None, everything
+        is sent through the socket
+
+        codec: the name of the codec, in CODECS, encoding the structure of
+        the message and the header of the array frame
+
+    Return:
+        the encoded bytes
+    '''
+    marker, dumps, _=CODECS[codec]
+    arrays=[]
+    content=_extract_arrays(message, arrays, binary, shared)
+    if len(arrays)==0:
+        return marker+dumps(content)
+    descriptors, buffers, offset=[], [], 0
+    for array in arrays:
+        array=np.ascontiguousarray(array,
+                                   dtype=array.dtype.newbyteorder('<'))
+        descriptors.append(dict({'dtype':array.dtype.str,
+                                 'shape':list(array.shape),
+                                 'offset':offset}))
+        # a flat byte view, so that the bytes are only copied by join
+        buffers.append(array.reshape(-1).view(np.uint8))
+        offset+=array.nbytes
+    header=dumps(dict({'message':content, 'arrays':descriptors}))
+    return b''.join([marker, ARRAY_FRAME,
+                     '{:010x}'.format(len(header)).encode(), header]+buffers)
+
+def decode_message(data, shared=None):
+    '''Decode a message encoded with encode_message. The arrays of an array
+    frame are numpy views on the received data, without any copy.
+
+    Parameters:
+        data: the received bytes
+
+        shared: a list receiving the SharedMemory blocks of the arrays sent
+        through shared memory. The arrays are then views on the blocks,
+        which must be released with release_shared_memory(shared,
+        unlink=False) once the arrays are not needed. If None, the arrays
+        are copied and the blocks closed right away
+
+    Return:
+        the decoded message
+    '''
+    codec=codec_of(data)
+    marker, _, loads=CODECS[codec]
+    body=memoryview(data)[len(marker):]
+    if body[:1]!=ARRAY_FRAME:
+        message=loads(body)
+        if b'__shared__' in data:
+            message=_restore_arrays(message, [], shared)
+        return message
+    header_length=int(bytes(body[1:11]).decode(), 16)
+    header=loads(body[11:11+header_length])
+    blob=body[11+header_length:]
+    arrays=[]
+    for descriptor in header['arrays']:
+        dtype=np.dtype(descriptor['dtype'])
+        shape=descriptor['shape']
+        count=int(np.prod(shape))
+        arrays.append(np.frombuffer(blob, dtype=dtype, count=count,
+                                    offset=descriptor['offset'])\
+                      .reshape(shape))
+    return _restore_arrays(header['message'], arrays, shared)
+
+class Connection:
+    '''A non-blocking connection with a client. Messages are framed with
+    their length written as 10 hexadecimal digits at the beginning. The
+    frames are assembled from what the socket gives, and the answers are
+    queued until the socket can take them'''
+
+    def __init__(self, sock, addr, wake=None, stats=None, log_packets=False):
+        '''
+        Parameters:
+            sock: the accepted socket
+
+            addr: the address of the client
+
+            wake: function called when answers are waiting to be sent
+
+            stats: the TransferStats counting the bytes of the answers
+
+            log_packets: whether to print the length of every message
+        '''
+        self.sock=sock
+        self.sock.setblocking(False)
+        self.addr=addr
+        self.wake=wake
+        self.stats=stats
+        self.log_packets=log_packets
+        self.binary=False
+        self.codec='json'
+        self.compression=None
+        self.compression_threshold=COMPRESSION_THRESHOLD
+        self.shared_memory=False
+        # the shared memory blocks of the last answer, kept until the client
+        # sends its next message
+        self.shared_blocks=[]
+        # the IDs of the requests cancelled by the client
+        self.cancelled=set()
+        self.closing=False
+        self.closed=False
+        # the small messages are received in _scratch and assembled in
+        # _inbox, while a large message is received directly in _body
+        self._scratch=bytearray(RECEIVE_BUFFER)
+        self._scratch_view=memoryview(self._scratch)
+        self._inbox=bytearray()
+        self._body=None
+        self._body_view=None
+        self._received=0
+        # the headers and the messages waiting to be sent, as memoryviews
+        self._outbox=deque()
+        self._lock=threading.Lock()
+
+    def receive(self):
+        '''Read what is available on the socket
+
+        Return:
+            the list of the completed frames, or None if the client closed
+            the connection
+        '''
+        if self._body is not None:
+            target=self._body_view[self._received:]
+        else:
+            target=self._scratch_view
+        try:
+            packet_size=self.sock.recv_into(target)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            return None
+        if packet_size==0:
+            return None
+        if self._body is not None:
+            self._received+=packet_size
+            if self._received<len(self._body):
+                return []
+            frame=self._body
+            self._body, self._body_view=None, None
+            return [frame]
+        self._inbox+=self._scratch_view[:packet_size]
+        frames=[]
+        while len(self._inbox)>=10:
+            size=int(self._inbox[:10].decode(), 16)
+            if len(self._inbox)-10>=size:
+                self._log(size)
+                frames.append(self._inbox[10:10+size])
+                del self._inbox[:10+size]
+                continue
+            if size>len(self._scratch):
+                # the rest of a large message is received in place
+                self._log(size)
+                self._body=bytearray(size)
+                self._body_view=memoryview(self._body)
+                self._received=len(self._inbox)-10
+                with memoryview(self._inbox) as inbox:
+                    self._body_view[:self._received]=inbox[10:]
+                self._inbox.clear()
+            break
+        return frames
+
+    def _log(self, size):
+        if self.log_packets:
+            print('len of packet is {:}'.format(size))
+
+    def send_frame(self, data):
+        '''Queue encoded bytes with their length at the beginning, and
+        send as much as possible right away. The length and the bytes are
+        separate buffers, so that the bytes are not copied'''
+        with self._lock:
+            self._outbox.append(memoryview(
+                    '{:010x}'.format(len(data)).encode()))
+            self._outbox.append(memoryview(data).cast('B'))
+            sent=self._send_queued()
+        if not sent and self.wake is not None:
+            self.wake()
+
+    def send_answer(self, message, request_id=None):
+        '''Encode and send the answer to a command, compressed if the
+        client accepts it and the answer is large enough. The large arrays
+        go through shared memory if the client asked for it'''
+        reply=dict({'content':message})
+        if request_id is not None:
+            reply['id']=request_id
+        shared=self.shared_blocks if self.shared_memory else None
+        self.send_reply(encode_message(reply, binary=self.binary,
+                                       shared=shared, codec=self.codec))
+
+    def send_progress(self, request_id, progress):
+        '''Send the progress of the command of a request, before its
+        answer'''
+        self.send_reply(encode_message(dict({'id':request_id,
+                                             'progress':progress}),
+                                       binary=self.binary, codec=self.codec))
+
+    def send_error(self, request_id, error, remote_traceback):
+        '''Send the error raised by the command of a request'''
+        self.send_reply(encode_message(dict({
+                'id':request_id,
+                'error':'{:}: {:}'.format(type(error).__name__, error),
+                'traceback':remote_traceback}), codec=self.codec))
+
+    def send_reply(self, data):
+        '''Compress if needed, count and send an encoded reply'''
+        wire=compress(data, self.compression, self.compression_threshold)
+        if self.stats is not None:
+            self.stats.add_sent(len(data), len(wire))
+        self.send_frame(wire)
+
+    def flush(self):
+        '''Send the queued answers, as far as the socket accepts them
+
+        Return:
+            True if everything was sent
+        '''
+        with self._lock:
+            return self._send_queued()
+
+    def _send_queued(self):
+        while self._outbox:
+            try:
+                if hasattr(self.sock, 'sendmsg'):
+                    buffers=list(itertools.islice(self._outbox,
+                                                  SENDMSG_BUFFERS))
+                    sent=self.sock.sendmsg(buffers)
+                    offered=sum(len(buffer) for buffer in buffers)
+                else:
+                    sent=self.sock.send(self._outbox[0])
+                    offered=len(self._outbox[0])
+            except (BlockingIOError, InterruptedError):
+                return False
+            except OSError:
+                self._outbox.clear()
+                self.closing=True
+                return False
+            full=sent<offered
+            while sent>0:
+                buffer=self._outbox[0]
+                if sent<len(buffer):
+                    self._outbox[0]=buffer[sent:]
+                    break
+                sent-=len(buffer)
+                self._outbox.popleft()
+            if full:
+                # the socket does not take more for now
+                return not self._outbox
+        return True
+
+    def discard_output(self):
+        with self._lock:
+            self._outbox.clear()
+
+    @property
+    def pending_output(self):
+        return len(self._outbox)>0
+
+    def close_later(self):
+        '''Ask the server to close the connection once the queued answers
+        are sent'''
+        self.closing=True
+        if self.wake is not None:
+            self.wake()
+
+    def release_shared_memory(self):
+        '''Destroy the shared memory blocks of the previous answers, which
+        the client has read once it sends a new message'''
+        release_shared_memory(self.shared_blocks)
+
+    def close(self):
+        self.closed=True
+        self.sock.close()
+        self.release_shared_memory()
+
+class Answer:
+    '''Stand-in for a Connection, keeping the answer of a command instead
+    of sending it. Used to execute the commands of a batch'''
+
+    def __init__(self):
+        self.content=None
+
+    def send_answer(self, message):
+        self.content=message
+
+class Reply:
+    '''Stand-in for a Connection, sending the answer of a command with the
+    ID of its request'''
+
+    def __init__(self, connection, request_id):
+        self.connection=connection
+        self.request_id=request_id
+        self.answered=False
+
+    def send_answer(self, message):
+        self.answered=True
+        self.connection.send_answer(message, request_id=self.request_id)
+
+class Request:
+    '''A message decoded by the decoding thread of the server, waiting to
+    be executed by the main thread of Blender'''
+
+    def __init__(self):
+        self.command=None
+        self.codec='json'
+        # the shared memory blocks of the arrays of the command, released
+        # once it is executed
+        self.blocks=[]
+        self.error=None
+        self.traceback=None
+
+    @property
+    def id(self):
+        if isinstance(self.command, dict):
+            return self.command.get('id')
+        return None
+
+    @property
+    def priority(self):
+        if isinstance(self.command, dict):
+            priority=self.command.get('priority', NORMAL)
+            if isinstance(priority, int):
+                return priority
+        return NORMAL
+
+class CommandCancelled(Exception):
+    '''Raised when a command is cancelled by the client'''